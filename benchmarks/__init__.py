@@ -0,0 +1,8 @@
+"""
+Offline benchmarks for the bot.
+
+The bot's own extensions are loaded into a stand-in bot and driven with synthetic messages, so
+nothing connects to Discord. Run with:
+
+    python -m benchmarks --help
+"""
@@ -0,0 +1,74 @@
+"""
+Command line entry point: python -m benchmarks [options]
+"""
+import argparse
+
+import toastbot.defaultlogger as logger
+import toastbot.botfunctions.logbot as logbot
+
+from benchmarks.runner import BenchmarkRun, DEFAULT_EXPORT_FORMAT, format_report, save_results
+from benchmarks.scaling import format_scaling_report, run_scaling
+from benchmarks.traffic import TrafficProfile
+
+
+def parse_args(args=None):
+    defaults = TrafficProfile()
+    parser = argparse.ArgumentParser(description='Replay synthetic traffic through the bot handlers offline.')
+    parser.add_argument('--channels', type=int, default=defaults.channels)
+    parser.add_argument('--logs', type=int, default=defaults.logs, help='Channel-wide logs to run.')
+    parser.add_argument('--messages', type=int, default=defaults.messages)
+    parser.add_argument('--users-per-channel', type=int, default=defaults.users_per_channel)
+    parser.add_argument('--words-per-message', type=int, default=defaults.words_per_message)
+    parser.add_argument('--roll-fraction', type=float, default=defaults.roll_fraction)
+    parser.add_argument('--large-roll-fraction', type=float, default=defaults.large_roll_fraction)
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='Messages per second to replay at; 0 (the default) is unthrottled.')
+    parser.add_argument('--preset', default='default', choices=sorted(logbot.DATABASE_PRESETS))
+    parser.add_argument('--roll-backend', default='python')
+    parser.add_argument('--export-format', default=DEFAULT_EXPORT_FORMAT)
+    parser.add_argument('--archive', action='store_true',
+                        help='Archive ended logs, so getlog reads them back from segment files.')
+    parser.add_argument('--shards', default=None,
+                        help='Comma-separated shard counts, e.g. 1,2,4: measure chatter throughput of sharded '
+                             'mode at each count instead of running the phases.')
+    parser.add_argument('--output', default=None,
+                        help='JSON results path; a timestamped file under benchmarks/results by default.')
+    parser.add_argument('--log-level', default='WARNING', choices=sorted(logger.LOG_LEVEL_MAP))
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    options = parse_args(args)
+    logger.init_logging(level=logger.LOG_LEVEL_MAP[options.log_level])
+    profile = TrafficProfile(
+        channels=options.channels,
+        logs=options.logs,
+        messages=options.messages,
+        users_per_channel=options.users_per_channel,
+        words_per_message=options.words_per_message,
+        roll_fraction=options.roll_fraction,
+        large_roll_fraction=options.large_roll_fraction,
+        seed=options.seed,
+    )
+    if options.shards:
+        shard_counts = [int(shard_count) for shard_count in options.shards.split(',')]
+        results = run_scaling(profile, shard_counts, database_preset=options.preset,
+                              log_level=logger.LOG_LEVEL_MAP[options.log_level])
+        print(format_scaling_report(results))
+    else:
+        results = BenchmarkRun(
+            profile,
+            rate=options.rate,
+            database_preset=options.preset,
+            roll_backend=options.roll_backend,
+            export_format=options.export_format,
+            archive=options.archive,
+        ).run()
+        print(format_report(results))
+    print('Saved to {}'.format(save_results(results, options.output)))
+    logger.shutdown_logging()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+Minimal stand-ins for the discord.py objects and bot methods the handlers use.
+"""
+import asyncio
+import collections
+import configparser
+import importlib
+import inspect
+import itertools
+import time
+
+import discord.ext.commands as commands
+
+import toastbot.metrics as metrics
+
+#  Message ids, as increasing snowflake strings like Discord's.
+_message_ids = itertools.count(100000000000000000)
+
+
+class FakePermissions:
+    def __init__(self, administrator=False):
+        self.administrator = administrator
+
+
+class FakeServer:
+    def __init__(self, server_id):
+        self.id = server_id
+
+
+class FakeChannel:
+    def __init__(self, channel_id, server):
+        self.id = channel_id
+        self.server = server
+
+
+class FakeMember:
+    def __init__(self, member_id, name, nick=None, administrator=False):
+        self.id = member_id
+        self.name = name
+        self.nick = nick
+        self.server_permissions = FakePermissions(administrator)
+
+    @property
+    def display_name(self):
+        return self.nick if self.nick is not None else self.name
+
+    def __str__(self):
+        return self.name
+
+
+class FakeMessage:
+    def __init__(self, content, author, channel, timestamp):
+        self.id = str(next(_message_ids))
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.server = channel.server
+        self.timestamp = timestamp
+
+
+class FakeContext:
+    def __init__(self, message, command_name):
+        self.message = message
+        self.invoked_with = command_name
+
+
+class FakeBot:
+    """
+    Loads the bot's extensions and dispatches messages to their cogs like ToastBot would.
+
+    Replies are counted rather than sent; every handler call is timed.
+    """
+    def __init__(self, command_prefix='!', config=None, loop=None, shard_id=None, shard_count=None,
+                 log_writer_queues=None):
+        self.command_prefix = command_prefix
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        self.log_writer_queues = log_writer_queues
+        self.settings_watcher = None
+        self.config = config if config is not None else configparser.ConfigParser()
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.metrics = metrics.BotMetrics()
+        self.cogs = collections.OrderedDict()
+        #  Command name -> coroutine function taking the context.
+        self.commands = dict()
+        #  Event name -> list of (handler name, coroutine function).
+        self.listeners = collections.defaultdict(list)
+        #  Handler name -> list of call durations in seconds.
+        self.latencies = collections.defaultdict(list)
+        self.replies = 0
+        self.reply_bytes = 0
+        self.files_sent = 0
+
+    def reset_counters(self):
+        self.latencies.clear()
+        self.replies = 0
+        self.reply_bytes = 0
+        self.files_sent = 0
+
+    def load_extension(self, name):
+        importlib.import_module(name).setup(self)
+
+    def add_cog(self, cog):
+        cog_name = type(cog).__name__
+        self.cogs[cog_name] = cog
+        for member_name, member in inspect.getmembers(cog):
+            if isinstance(member, commands.Command):
+                self.commands[member.name] = _bind(member.callback, cog)
+            elif member_name.startswith('on_'):
+                self.listeners[member_name].append(('{}.{}'.format(cog_name, member_name), member))
+
+    def get_cog(self, name):
+        return self.cogs.get(name)
+
+    def unload_cogs(self):
+        for cog_name, cog in reversed(list(self.cogs.items())):
+            unload = getattr(cog, '_{}__unload'.format(cog_name), None)
+            if unload is not None:
+                unload()
+        self.cogs.clear()
+
+    @asyncio.coroutine
+    def say(self, content=None, **kwargs):
+        self._record_reply(content)
+
+    @asyncio.coroutine
+    def send_message(self, destination, content=None, **kwargs):
+        self._record_reply(content)
+
+    @asyncio.coroutine
+    def send_file(self, destination, fp, filename=None, content=None, **kwargs):
+        self.files_sent += 1
+        self._record_reply(content)
+
+    def _record_reply(self, content):
+        self.replies += 1
+        if content:
+            self.reply_bytes += len(content.encode('utf-8'))
+
+    @asyncio.coroutine
+    def process_message(self, message):
+        """
+        Run the on_message listeners and then, if the message is a command, the command itself.
+        """
+        for listener_name, listener in self.listeners['on_message']:
+            yield from self._timed(listener_name, listener, message)
+        if not message.content.startswith(self.command_prefix):
+            return
+        command_name = message.content[len(self.command_prefix):].split(' ', 1)[0]
+        command = self.commands.get(command_name)
+        if command is not None:
+            yield from self._timed(command_name, command, FakeContext(message, command_name))
+
+    @asyncio.coroutine
+    def _timed(self, name, handler, argument):
+        start = time.perf_counter()
+        yield from handler(argument)
+        self.latencies[name].append(time.perf_counter() - start)
+
+
+def _bind(callback, cog):
+    @asyncio.coroutine
+    def bound(context):
+        yield from callback(cog, context)
+    return bound
@@ -0,0 +1,256 @@
+"""
+Runs the bot's handlers against synthetic traffic and measures them.
+"""
+import asyncio
+import collections
+import configparser
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    #  Not available on Windows; peak RSS is then reported as None.
+    resource = None
+
+import toastbot.cogs as cogs
+
+from benchmarks.fakediscord import FakeBot
+from benchmarks.traffic import TrafficWorld
+
+DEFAULT_RESULTS_DIRECTORY = 'benchmarks/results'
+DEFAULT_EXPORT_FORMAT = 'html'
+DEFAULT_DATABASE_PRESET = 'default'
+DEFAULT_ROLL_BACKEND = 'python'
+
+
+def percentile(sorted_values, percent):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(percent / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def latency_summary(latencies):
+    """
+    :param latencies: Handler name -> list of durations in seconds.
+    :return: Handler name -> dict of call count and mean, p50, p99 and max in milliseconds.
+    """
+    summary = dict()
+    for name, values in sorted(latencies.items()):
+        values = sorted(values)
+        summary[name] = {
+            'calls': len(values),
+            'mean_ms': sum(values) / len(values) * 1000,
+            'p50_ms': percentile(values, 50) * 1000,
+            'p99_ms': percentile(values, 99) * 1000,
+            'max_ms': values[-1] * 1000,
+        }
+    return summary
+
+
+def peak_rss_kib():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #  ru_maxrss is in bytes on macOS and KiB elsewhere.
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def bytes_written():
+    """
+    Bytes this process has passed to write(2) so far, or None where /proc is unavailable.
+    """
+    try:
+        with open('/proc/self/io') as io_file:
+            for line in io_file:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def directory_size(path):
+    if not os.path.isdir(path):
+        return 0
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def database_size(path):
+    return sum(
+        os.path.getsize(file_path)
+        for file_path in (path, '{}-wal'.format(path), '{}-journal'.format(path))
+        if os.path.exists(file_path)
+    )
+
+
+class BenchmarkRun:
+    """
+    One run of every phase against a fresh database in a temporary directory.
+
+    :param rate: Messages per second to replay chatter at; 0 sends as fast as the handlers allow.
+    """
+    def __init__(self, profile, rate=0.0, database_preset=DEFAULT_DATABASE_PRESET, roll_backend=DEFAULT_ROLL_BACKEND,
+                 export_format=DEFAULT_EXPORT_FORMAT, archive=False, loop=None):
+        self.profile = profile
+        self.archive = archive
+        self.rate = rate
+        self.database_preset = database_preset
+        self.roll_backend = roll_backend
+        self.export_format = export_format
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.world = TrafficWorld(profile)
+
+    def run(self):
+        with tempfile.TemporaryDirectory(prefix='toastbot-bench-') as directory:
+            return self.loop.run_until_complete(self._run(directory))
+
+    @asyncio.coroutine
+    def _run(self, directory):
+        database_path = os.path.join(directory, 'bench.db')
+        bot = FakeBot(config=self._config(directory, database_path), loop=self.loop)
+        load_started = time.perf_counter()
+        for extension in (cogs.DICEROLLER_EXTENSION, cogs.LOGBOT_EXTENSION):
+            bot.load_extension(extension)
+        load_seconds = time.perf_counter() - load_started
+        log_cog = bot.get_cog(cogs.LOGBOT_COG)
+        try:
+            phases = collections.OrderedDict()
+            phases['startlog'] = yield from self._replay(bot, self.world.start_logs())
+            phases['chatter'] = yield from self._chatter(bot, log_cog.text_buffer, database_path)
+            #  Half the logs end first, so their exports go through the export cache.
+            phases['endlog'] = yield from self._replay(bot, self.world.end_logs(len(self.world.log_channels) // 2))
+            if log_cog._archiving is not None:
+                #  Ended logs are read back from the archive once they have been moved.
+                yield from asyncio.wait([log_cog._archiving], loop=self.loop)
+            phases['getlog_messages'] = yield from self._replay(bot, self.world.get_logs())
+            phases['getlog_file'] = yield from self._replay(bot, self.world.get_logs(self.export_format))
+            phases['getlog_file_cached'] = yield from self._replay(bot, self.world.get_logs(self.export_format))
+        finally:
+            bot.unload_cogs()
+        return {
+            'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'profile': self.profile.to_dict(),
+            'rate': self.rate,
+            'database_preset': self.database_preset,
+            'roll_backend': self.roll_backend,
+            'archive': self.archive,
+            'extension_load_seconds': load_seconds,
+            'phases': phases,
+            'database_bytes': database_size(database_path),
+            'archive_bytes': directory_size(os.path.join(directory, 'archive')),
+            'peak_rss_kib': peak_rss_kib(),
+        }
+
+    @asyncio.coroutine
+    def _replay(self, bot, messages):
+        bot.reset_counters()
+        start = time.perf_counter()
+        for message in messages:
+            yield from bot.process_message(message)
+        elapsed = time.perf_counter() - start
+        return self._phase_result(bot, len(messages), elapsed)
+
+    def _config(self, directory, database_path):
+        config = configparser.ConfigParser()
+        config.read_dict({
+            'dice': {'RollBackend': self.roll_backend},
+            'database': {'Path': database_path, 'Preset': self.database_preset},
+            'logs': {
+                'ActiveLogsPath': os.path.join(directory, 'active_logs.json'),
+                'ExportDirectory': os.path.join(directory, 'exports'),
+            },
+            'archive': {
+                'ArchiveEndedLogs': str(self.archive),
+                'Directory': os.path.join(directory, 'archive'),
+            },
+        })
+        return config
+
+    @asyncio.coroutine
+    def _chatter(self, bot, text_buffer, database_path):
+        bot.reset_counters()
+        size_before = database_size(database_path)
+        written_before = bytes_written()
+        logical_bytes = 0
+        count = 0
+        start = time.perf_counter()
+        for message, message_bytes in self.world.chatter():
+            if self.rate > 0:
+                delay = start + count / self.rate - time.perf_counter()
+                if delay > 0:
+                    yield from asyncio.sleep(delay, loop=self.loop)
+            yield from bot.process_message(message)
+            logical_bytes += message_bytes
+            count += 1
+        #  Buffered writes are part of the cost of ingesting the traffic.
+        yield from text_buffer.flush()
+        elapsed = time.perf_counter() - start
+        written_after = bytes_written()
+        result = self._phase_result(bot, count, elapsed)
+        result['logical_bytes'] = logical_bytes
+        result['database_growth_bytes'] = database_size(database_path) - size_before
+        result['bytes_written'] = written_after - written_before if written_before is not None else None
+        physical_bytes = result['bytes_written'] if result['bytes_written'] is not None \
+            else result['database_growth_bytes']
+        result['write_amplification'] = physical_bytes / logical_bytes if logical_bytes else None
+        return result
+
+    @staticmethod
+    def _phase_result(bot, count, elapsed):
+        return {
+            'messages': count,
+            'elapsed_seconds': elapsed,
+            'throughput_per_second': count / elapsed if elapsed else None,
+            'handlers': latency_summary(bot.latencies),
+            'replies': bot.replies,
+            'reply_bytes': bot.reply_bytes,
+            'files_sent': bot.files_sent,
+        }
+
+
+def save_results(results, path=None, directory=DEFAULT_RESULTS_DIRECTORY):
+    """
+    Write results as JSON, by default to a timestamped file in the results directory.
+
+    :return: Path written.
+    """
+    if path is None:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'bench-{}.json'.format(datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')))
+    with open(path, 'w', encoding='utf-8') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+    logging.info('Benchmark results saved to {}'.format(path))
+    return path
+
+
+def format_report(results):
+    lines = ['Profile: {}'.format(json.dumps(results['profile'], sort_keys=True))]
+    for phase_name, phase in results['phases'].items():
+        lines.append('{}: {} messages in {:.2f}s ({:.0f}/s)'.format(
+            phase_name, phase['messages'], phase['elapsed_seconds'], phase['throughput_per_second'] or 0
+        ))
+        for handler_name, handler in phase['handlers'].items():
+            lines.append('    {}: n={} p50={:.2f}ms p99={:.2f}ms max={:.2f}ms'.format(
+                handler_name, handler['calls'], handler['p50_ms'], handler['p99_ms'], handler['max_ms']
+            ))
+        if phase.get('write_amplification') is not None:
+            lines.append('    write amplification: {:.2f}x'.format(phase['write_amplification']))
+    lines.append('Extension load: {:.3f}s'.format(results['extension_load_seconds']))
+    lines.append('Database size: {} bytes'.format(results['database_bytes']))
+    if results['archive']:
+        lines.append('Archive size: {} bytes'.format(results['archive_bytes']))
+    lines.append('Peak RSS: {} KiB'.format(results['peak_rss_kib']))
+    return '\n'.join(lines)
@@ -0,0 +1,159 @@
+"""
+Chat throughput against the number of shards.
+
+Each shard is a process with its own stand-in bot and its own channels, sending its log writes
+to one writer process, as in the bot's sharded mode. Every shard replays the full profile, so
+with perfect scaling the combined throughput grows in step with the shard count.
+"""
+import asyncio
+import configparser
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import toastbot.cogs as cogs
+import toastbot.shardrunner as shardrunner
+import toastbot.botfunctions.logwriter as logwriter
+
+from benchmarks.fakediscord import FakeBot
+from benchmarks.runner import DEFAULT_DATABASE_PRESET
+from benchmarks.traffic import TrafficWorld
+
+#  Keeps the ids of different shards' servers, channels and members apart.
+SHARD_ID_SPACING = 1000000
+
+
+def run_scaling(profile, shard_counts, database_preset=DEFAULT_DATABASE_PRESET, log_level=logging.WARNING):
+    """
+    :return: Results dict, with one entry per shard count.
+    """
+    runs = list()
+    for shard_count in shard_counts:
+        with tempfile.TemporaryDirectory(prefix='toastbot-scaling-') as directory:
+            runs.append(_run_shards(profile, shard_count, database_preset, log_level, directory))
+    baseline = runs[0]['throughput_per_second'] / runs[0]['shards'] if runs else None
+    for run in runs:
+        run['speedup_per_shard'] = run['throughput_per_second'] / (baseline * run['shards']) if baseline else None
+    return {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'profile': profile.to_dict(),
+        'database_preset': database_preset,
+        'runs': runs,
+    }
+
+
+def format_scaling_report(results):
+    lines = ['Profile: {} ({} CPUs)'.format(json.dumps(results['profile'], sort_keys=True), results['cpus'])]
+    for run in results['runs']:
+        lines.append('{} shards: {} messages in {:.2f}s ({:.0f}/s, {:.0%} of linear)'.format(
+            run['shards'], run['messages'], run['elapsed_seconds'], run['throughput_per_second'],
+            run['speedup_per_shard'] or 0
+        ))
+    return '\n'.join(lines)
+
+
+def _run_shards(profile, shard_count, database_preset, log_level, directory):
+    config_path = os.path.join(directory, 'config.txt')
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'database': {'Path': os.path.join(directory, 'bench.db'), 'Preset': database_preset},
+        'logs': {
+            'ActiveLogsPath': os.path.join(directory, 'active_logs.json'),
+            'ExportDirectory': os.path.join(directory, 'exports'),
+        },
+        'archive': {'Directory': os.path.join(directory, 'archive')},
+    })
+    with open(config_path, 'w', encoding='utf-8') as config_file:
+        config.write(config_file)
+
+    context = multiprocessing.get_context('spawn')
+    requests = context.Queue()
+    replies = [context.Queue() for shard_id in range(shard_count)]
+    ready = context.Event()
+    #  Every shard and the launcher meet here once the logs are started, so only chatter is timed.
+    start = context.Barrier(shard_count + 1)
+    results = context.Queue()
+    writer = context.Process(
+        target=shardrunner.run_writer, args=(config_path, requests, replies, ready, log_level)
+    )
+    writer.start()
+    try:
+        if not ready.wait(shardrunner.WRITER_START_TIMEOUT):
+            writer.terminate()
+            raise RuntimeError('Log writer did not start within {}s.'.format(shardrunner.WRITER_START_TIMEOUT))
+        shards = [
+            context.Process(
+                target=_run_shard,
+                args=(shard_id, shard_count, (requests, replies[shard_id]), config_path, profile, start, results)
+            )
+            for shard_id in range(shard_count)
+        ]
+        for shard in shards:
+            shard.start()
+        start.wait()
+        started = time.perf_counter()
+        shard_results = [results.get() for shard in shards]
+        elapsed = time.perf_counter() - started
+        for shard in shards:
+            shard.join()
+    finally:
+        requests.put(logwriter.STOP)
+        writer.join()
+    messages = sum(result['messages'] for result in shard_results)
+    return {
+        'shards': shard_count,
+        'messages': messages,
+        'elapsed_seconds': elapsed,
+        'throughput_per_second': messages / elapsed if elapsed else None,
+        'shard_throughputs': [result['throughput_per_second'] for result in shard_results],
+    }
+
+
+def _run_shard(shard_id, shard_count, log_writer_queues, config_path, profile, start, results):
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    bot = FakeBot(config=config, loop=loop, shard_id=shard_id, shard_count=shard_count,
+                  log_writer_queues=log_writer_queues)
+    for extension in (cogs.DICEROLLER_EXTENSION, cogs.LOGBOT_EXTENSION):
+        bot.load_extension(extension)
+    world = TrafficWorld(profile, id_base=shard_id * SHARD_ID_SPACING, log_prefix='shard{}-bench'.format(shard_id))
+    text_buffer = bot.get_cog(cogs.LOGBOT_COG).text_buffer
+    try:
+        loop.run_until_complete(_replay(bot, world.start_logs()))
+        start.wait()
+        started = time.perf_counter()
+        count = loop.run_until_complete(_replay(bot, (message for message, message_bytes in world.chatter())))
+        loop.run_until_complete(text_buffer.flush())
+        elapsed = time.perf_counter() - started
+    finally:
+        bot.unload_cogs()
+        pending = asyncio.Task.all_tasks(loop=loop)
+        if pending:
+            loop.run_until_complete(asyncio.wait(pending, loop=loop))
+        loop.close()
+    results.put({
+        'shard': shard_id,
+        'messages': count,
+        'elapsed_seconds': elapsed,
+        'throughput_per_second': count / elapsed if elapsed else None,
+    })
+
+
+@asyncio.coroutine
+def _replay(bot, messages):
+    count = 0
+    for message in messages:
+        yield from bot.process_message(message)
+        count += 1
+    return count
@@ -0,0 +1,125 @@
+"""
+Synthetic, reproducible Discord traffic.
+"""
+import datetime
+import random
+
+from benchmarks.fakediscord import FakeChannel, FakeMember, FakeMessage, FakeServer
+
+WORDS = (
+    'the', 'dragon', 'sword', 'tavern', 'roll', 'initiative', 'whispers', 'gold', 'door', 'trap',
+    'spell', 'goblin', 'shield', 'north', 'quietly', 'attack', 'cleric', 'heals', 'ale', 'map',
+)
+SMALL_ROLLS = ('!roll 1d20', '!roll 2d6+3', '!roll 1d20+5', '!roll 4d6kh3')
+LARGE_ROLLS = ('!roll 100d100', '!roll 100d6+2', '!roll 10d6!+4d8kh2-3', '!roll 50d20dl10 + 50d4')
+BASE_TIMESTAMP = datetime.datetime(2017, 1, 1)
+
+
+class TrafficProfile:
+    """
+    Shape of the synthetic traffic.
+
+    :param channels: Channels messages are spread across, over servers of channels_per_server each.
+    :param logs: Channel-wide logs started round-robin across the channels; channels beyond this
+        number have no log, so their messages exercise the early-reject path.
+    :param messages: Chat messages and commands sent after the logs start.
+    :param roll_fraction: Share of messages that are !roll commands.
+    :param large_roll_fraction: Share of those rolls that use many dice or long expressions.
+    """
+    def __init__(self, channels=20, logs=20, messages=5000, users_per_channel=5, channels_per_server=10,
+                 words_per_message=12, roll_fraction=0.1, large_roll_fraction=0.1, seed=0):
+        self.channels = channels
+        self.logs = logs
+        self.messages = messages
+        self.users_per_channel = users_per_channel
+        self.channels_per_server = channels_per_server
+        self.words_per_message = words_per_message
+        self.roll_fraction = roll_fraction
+        self.large_roll_fraction = large_roll_fraction
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(vars(self))
+
+
+class TrafficWorld:
+    """
+    Servers, channels and members for a profile, plus which logs run in which channel.
+
+    :param id_base: Added to every server, channel and member id, and log_prefix starts every log
+        name, so that several worlds can share one database.
+    """
+    def __init__(self, profile, id_base=0, log_prefix='bench'):
+        self.profile = profile
+        self.log_prefix = log_prefix
+        servers = [
+            FakeServer(str(id_base + 1000 + index))
+            for index in range((profile.channels + profile.channels_per_server - 1) // profile.channels_per_server)
+        ]
+        self.channels = [
+            FakeChannel(str(id_base + 2000 + index), servers[index // profile.channels_per_server])
+            for index in range(profile.channels)
+        ]
+        self.members = {
+            channel.id: [
+                FakeMember(str(id_base + 3000 + index * profile.users_per_channel + user), 'user{}'.format(user))
+                for user in range(profile.users_per_channel)
+            ]
+            for index, channel in enumerate(self.channels)
+        }
+        self.admin = FakeMember('1', 'admin', administrator=True)
+        self.log_channels = [self.channels[index % len(self.channels)] for index in range(profile.logs)]
+        self._logs_per_channel = dict()
+        for channel in self.log_channels:
+            self._logs_per_channel[channel.id] = self._logs_per_channel.get(channel.id, 0) + 1
+        self._clock = 0
+
+    def log_name(self, index):
+        return '{}{}'.format(self.log_prefix, index)
+
+    def logs_in(self, channel):
+        return self._logs_per_channel.get(channel.id, 0)
+
+    def message(self, content, channel, author=None):
+        self._clock += 1
+        if author is None:
+            author = self.members[channel.id][self._clock % len(self.members[channel.id])]
+        return FakeMessage(content, author, channel, BASE_TIMESTAMP + datetime.timedelta(milliseconds=self._clock))
+
+    def start_logs(self):
+        return [
+            self.message('!startlog {}'.format(self.log_name(index)), channel, self.admin)
+            for index, channel in enumerate(self.log_channels)
+        ]
+
+    def end_logs(self, count=None):
+        count = len(self.log_channels) if count is None else count
+        return [
+            self.message('!endlog {}'.format(self.log_name(index)), self.log_channels[index], self.admin)
+            for index in range(count)
+        ]
+
+    def get_logs(self, export_format=None, count=None):
+        count = len(self.log_channels) if count is None else count
+        suffix = ' {}'.format(export_format) if export_format else ''
+        return [
+            self.message('!getlog {}{}'.format(self.log_name(index), suffix), self.log_channels[index], self.admin)
+            for index in range(count)
+        ]
+
+    def chatter(self):
+        """
+        Yield (message, bytes written to logs) for the profile's messages, reproducibly.
+
+        The byte count is the message text once for each log running in its channel; it is the
+        logical payload that write amplification is measured against.
+        """
+        generator = random.Random(self.profile.seed)
+        for index in range(self.profile.messages):
+            channel = generator.choice(self.channels)
+            if generator.random() < self.profile.roll_fraction:
+                rolls = LARGE_ROLLS if generator.random() < self.profile.large_roll_fraction else SMALL_ROLLS
+                content = generator.choice(rolls)
+            else:
+                content = ' '.join(generator.choice(WORDS) for word in range(self.profile.words_per_message))
+            yield self.message(content, channel), len(content.encode('utf-8')) * self.logs_in(channel)
@@ -1,259 +1,195 @@
-import collections
-import logging
-import asyncio
-import importlib
-import pip
-
-import toastbot.toast as toast
+import time
 
+#  Taken before any other import, so the startup report includes import time.
+STARTED_AT = time.perf_counter()
 
-try:
-    import discord
-    import discord.ext.commands as commands
-except ImportError:
-    print('Installing discord package...')
-    pip.main(['install', 'discord'])
-    import discord
-    import discord.ext.commands as commands
-finally:
-    print('Importing discord package...')
-    globals()['discord'] = importlib.import_module('discord')
-    globals()['commands'] = importlib.import_module('discord.ext.commands')
+import logging
+import os
 
 import toastbot.configuration as botconf
 import toastbot.defaultlogger as logger
-
-import toastbot.botfunctions.diceroller as diceroller
-import toastbot.botfunctions.logbot as logbot
+import toastbot.cogs as cogs
+import toastbot.outbox as outbox
+import toastbot.ratelimit as ratelimit
+import toastbot.sharding as sharding
+import toastbot.toast as toast
 
 
 DEFAULT_API_CREDENTIALS_LOCATION = "configuration/api_keys.txt"
 DEFAULT_CONFIG_LOCATION = "configuration/config.txt"
+#  Configuration paths are relative to this directory. Shard processes are passed them resolved.
+PACKAGE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
 
 DEFAULT_BOT_TOKEN_SECTION = 'discord'
 DEFAULT_BOT_TOKEN_VALUE_NAME = 'BotToken'
 
-DEFAULT_LOGGING_SECTION = 'logging'
-DEFAULT_LOG_LEVEL_VALUE_NAME = 'LogLevel'
+DEFAULT_STARTUP_SECTION = 'startup'
+DEFAULT_STARTUP_BUDGET_VALUE_NAME = 'BudgetSeconds'
 
+DEFAULT_RECONNECT_SECTION = 'reconnect'
+DEFAULT_RECONNECT_BASE_DELAY_VALUE_NAME = 'BaseDelaySeconds'
+DEFAULT_RECONNECT_MAX_DELAY_VALUE_NAME = 'MaxDelaySeconds'
+DEFAULT_STABLE_CONNECTION_VALUE_NAME = 'StableAfterSeconds'
 
-def _monospace_message(str):
-    msg = "`{str}`".format(str=str)
-    return msg
+DEFAULT_RATE_LIMIT_SECTION = 'ratelimit'
+DEFAULT_RATE_LIMIT_ENABLED_VALUE_NAME = 'Enabled'
+DEFAULT_USER_RATE_VALUE_NAME = 'UserRate'
+DEFAULT_USER_BURST_VALUE_NAME = 'UserBurst'
+DEFAULT_CHANNEL_RATE_VALUE_NAME = 'ChannelRate'
+DEFAULT_CHANNEL_BURST_VALUE_NAME = 'ChannelBurst'
+DEFAULT_COMMAND_COSTS_VALUE_NAME = 'CommandCosts'
 
+DEFAULT_OUTBOX_SECTION = 'outbox'
+DEFAULT_MAX_QUEUED_VALUE_NAME = 'MaxQueued'
 
-def _create_roll_response(roll_results, author_name):
-    if len(roll_results.raw_rolls) > 10:
-        msg_template = _create_long_roll_response(roll_results, author_name)
-    else:
-        msg_template = _create_simple_roll_response(roll_results, author_name)
-    return msg_template
 
+def init_logging(settings):
+    logger.init_logging(level=settings.log_level)
+    logging.info('Logging initialized, level: {}'.format(settings.log_level_name))
 
-def _create_simple_roll_response(roll_results, author_name):
-    msg_template = "\nAuthor: {author}\n" \
-                   "{roll_results}".format(author=author_name, roll_results=str(roll_results))
-    return msg_template
 
+def apply_log_level(old, new):
+    if new.log_level != old.log_level:
+        logger.set_level(new.log_level)
+        logging.info('Log level now {}.'.format(new.log_level_name))
 
-def _create_long_roll_response(roll_results, author_name):
-    value_counter = collections.Counter(roll_results.raw_rolls)
-    mod_value_counter = collections.Counter(roll_results.modified_rolls)
-    raw_vals = list(value_counter.keys())
-    raw_vals.sort()
-    mod_vals = list(mod_value_counter.keys())
-    mod_vals.sort()
-    count = [value_counter[value] for value in raw_vals]
 
-    values = [len(str(x)) for x in raw_vals + mod_vals + count]
-    pad_len = max(values)
+def init_startup_budget(config):
+    """
+    :return: Cold-start budget in seconds, or None if none is configured.
+    """
+    if not config.has_section(DEFAULT_STARTUP_SECTION):
+        return None
+    return config[DEFAULT_STARTUP_SECTION].getfloat(DEFAULT_STARTUP_BUDGET_VALUE_NAME)
 
-    results_table = [
-        '{mod_val} ({raw_val}): {count}'.format(
-            mod_val=str(mod).ljust(pad_len, ' '),
-            raw_val=str(raw).ljust(pad_len, ' '),
-            count=str(count).ljust(pad_len, ' ')
-        )
-        for mod, raw, count
-        in zip(mod_vals, raw_vals, count)
-        ]
 
-    formatted_colnames = "Value (Unmodified): Count"
-    msg_base = [
-        "\nAuthor: {author}".format(author=author_name),
-        formatted_colnames
-    ]
-    result_msg = '\n'.join(msg_base + results_table)
-    return result_msg
+def init_reconnect(config):
+    """
+    :return: (ExponentialBackoff, seconds a connection must last before the backoff resets).
+    """
+    if not config.has_section(DEFAULT_RECONNECT_SECTION):
+        return toast.ExponentialBackoff(), toast.DEFAULT_STABLE_CONNECTION_SECONDS
+    reconnect_config = config[DEFAULT_RECONNECT_SECTION]
+    backoff = toast.ExponentialBackoff(
+        base=reconnect_config.getfloat(DEFAULT_RECONNECT_BASE_DELAY_VALUE_NAME, toast.DEFAULT_RECONNECT_BASE_DELAY),
+        maximum=reconnect_config.getfloat(DEFAULT_RECONNECT_MAX_DELAY_VALUE_NAME, toast.DEFAULT_RECONNECT_MAX_DELAY)
+    )
+    stable_after = reconnect_config.getfloat(
+        DEFAULT_STABLE_CONNECTION_VALUE_NAME, toast.DEFAULT_STABLE_CONNECTION_SECONDS
+    )
+    return backoff, stable_after
+
+
+def parse_command_costs(setting):
+    """
+    :param setting: Comma-separated command:cost pairs, e.g. "getlog:4, searchlog:2".
+    :return: Dict of command name -> cost.
+    """
+    costs = dict()
+    for pair in setting.split(','):
+        if not pair.strip():
+            continue
+        command_name, cost = pair.split(':')
+        costs[command_name.strip()] = float(cost)
+    return costs
+
+
+def init_rate_limiter(config):
+    """
+    :return: ratelimit.RateLimiter, or None if rate limiting is turned off.
+    """
+    if not config.has_section(DEFAULT_RATE_LIMIT_SECTION):
+        return ratelimit.RateLimiter()
+    rate_config = config[DEFAULT_RATE_LIMIT_SECTION]
+    if not rate_config.getboolean(DEFAULT_RATE_LIMIT_ENABLED_VALUE_NAME, True):
+        logging.info('Command rate limiting disabled.')
+        return None
+    command_costs = None
+    if DEFAULT_COMMAND_COSTS_VALUE_NAME in rate_config:
+        command_costs = parse_command_costs(rate_config[DEFAULT_COMMAND_COSTS_VALUE_NAME])
+    return ratelimit.RateLimiter(
+        user_rate=rate_config.getfloat(DEFAULT_USER_RATE_VALUE_NAME, ratelimit.DEFAULT_USER_RATE),
+        user_burst=rate_config.getfloat(DEFAULT_USER_BURST_VALUE_NAME, ratelimit.DEFAULT_USER_BURST),
+        channel_rate=rate_config.getfloat(DEFAULT_CHANNEL_RATE_VALUE_NAME, ratelimit.DEFAULT_CHANNEL_RATE),
+        channel_burst=rate_config.getfloat(DEFAULT_CHANNEL_BURST_VALUE_NAME, ratelimit.DEFAULT_CHANNEL_BURST),
+        command_costs=command_costs
+    )
 
 
-def init_logging():
-    config = botconf.read_api_configuration(DEFAULT_CONFIG_LOCATION)
-    logging_level_setting = config[DEFAULT_LOGGING_SECTION][DEFAULT_LOG_LEVEL_VALUE_NAME]
-    logging_level = logger.LOG_LEVEL_MAP[logging_level_setting]
-    logger.init_logging(level=logging_level)
-    logging.info('Logging initialized, level: {}'.format(logging_level_setting))
+def init_max_queued_sends(config):
+    if not config.has_section(DEFAULT_OUTBOX_SECTION):
+        return outbox.DEFAULT_MAX_QUEUED
+    return config[DEFAULT_OUTBOX_SECTION].getint(DEFAULT_MAX_QUEUED_VALUE_NAME, outbox.DEFAULT_MAX_QUEUED)
 
 
-def main():
-    init_logging()
+def read_token():
+    logging.info('Retrieving API details...')
+    credentials = botconf.read_api_configuration(os.path.join(PACKAGE_DIRECTORY, DEFAULT_API_CREDENTIALS_LOCATION))
+    return credentials[DEFAULT_BOT_TOKEN_SECTION][DEFAULT_BOT_TOKEN_VALUE_NAME]
 
+
+def run_bot(settings_watcher, token, started_at, imported_at, **options):
+    """
+    Create the bot, load its extensions and run it until it shuts down.
+
+    :param settings_watcher: configuration.SettingsWatcher of the bot's configuration file.
+    :param options: Extra ToastBot arguments, such as the shard settings.
+    """
+    config = settings_watcher.current.config
+    settings_watcher.subscribe(apply_log_level)
     bot_prefix = "!"
     logging.debug('Bot prefix set to: {}'.format(bot_prefix))
     logging.info('Initializing Discord Bot...')
-    bot = toast.ToastBot(command_prefix=bot_prefix, pm_help=True)
-    logging.info('Initializing Dicebot...')
-    dice = diceroller.Dicebot()
-
-    engine = logbot.initialize_engine()
-    session = logbot.create_session(engine)
-
-    @bot.event
-    @asyncio.coroutine
-    def on_ready():
-        logging.info("Bot online!")
-
-    @bot.command(pass_context=True)
-    @asyncio.coroutine
-    def test(context):
-        author = context.message.author
-        logging.info('Bot received test command from {}'.format(author))
-
-        msg_text = "\nAuthor: {author}\nBot is online.".format(author=author.display_name)
-        msg_text = _monospace_message(msg_text)
-        logging.info('Bot responded to test command.')
-        yield from bot.say(content=msg_text)
-
-    help_roll = ("- Roll dice: !roll <i>d<j>[+-][k] - type !help roll for more details.\n"
-                 "i = # of dice\n"
-                 "j = # of sides per die\n"
-                 "k = # to add or subtract from each die\n"
-                 "Elements in square brackets are optional.\n"
-                 "Ex. !roll 2d10+5, or !roll 1d20"
-                 )
-
-    @bot.command(pass_context=True, help=help_roll)
-    @asyncio.coroutine
-    def roll(context):
-        author = context.message.author
-        logging.info('Bot received roll command from {}.'.format(author))
-        try:
-            results = dice.roll(context.message.content)
-            msg_text = _create_roll_response(results, author.display_name)
-        except diceroller.DiceRollFormatError:
-            msg_text = "Valid dice roll command not found. Command: {}\nType !help roll for dice-rolling help.".format(
-                context.message.content
-            )
-        msg_text = _monospace_message(msg_text)
-        logging.info('Bot responded to roll command.')
-        yield from bot.say(content=msg_text)
-
-    help_startlog = (
-        "- Start logging: !startlog <log name>-<Name 1>-<Name 2>-...-<Name N>\n"
-        "Start logging by naming the log, and adding the displayed names of players.\n"
-        "The log name will be used to end the log at the end of the event."
+    backoff, stable_after = init_reconnect(config)
+    bot = toast.ToastBot(
+        command_prefix=bot_prefix, pm_help=True, settings_watcher=settings_watcher,
+        started_at=started_at, startup_budget=init_startup_budget(config),
+        backoff=backoff, stable_connection_seconds=stable_after,
+        rate_limiter=init_rate_limiter(config), max_queued_sends=init_max_queued_sends(config), **options
     )
+    bot.record_startup('imports', imported_at - started_at)
+    bot.record_startup('setup', time.perf_counter() - imported_at)
+    bot.load_cogs(cogs.DEFAULT_EXTENSIONS)
+    logging.info('Running bot...')
+    bot.run(token)
+
 
-    @bot.command(pass_context=True, help=help_startlog)
-    @asyncio.coroutine
-    def startlog(context):
-        logging.info('Initializing log...')
-        command = context.message.content
-        split_command = command.split(' ')
-        try:
-            command_contents = split_command[1]
-            command_params = command_contents.split('-')
-            command_log_name = command_params[0]
-            command_characters = command_params[1:]
-        except IndexError:
-            error_msg = 'Error: Not all parameters specified for log start. Use !help startlog for more info.'
-            yield from bot.say(content=error_msg)
-        else:
-            log_initialized_timestamp = context.message.timestamp
-
-            initialized_info_string = 'Started log {} at {}\nCharacters: {}.'.format(
-                command_log_name, log_initialized_timestamp, '; '.join(command_characters))
-            logging.info(initialized_info_string)
-            created_session = logbot.create_session(engine)
-            logbot.add_log(created_session, command_log_name, log_initialized_timestamp)
-            log_id = logbot.get_log_id(created_session, command_log_name, log_initialized_timestamp)
-            for name in command_params[1:]:
-                logging.info('Found names in command: {}'.format('; '.join(command_characters)))
-                try:
-                    logbot.LogSessionConfigs.add_log_to_user(name, log_id)
-                except KeyError:
-                    logbot.LogSessionConfigs.add_user(name)
-                    logbot.LogSessionConfigs.add_log_to_user(name, log_id)
-            yield from bot.say(content=initialized_info_string)
-
-
-    @bot.listen('on_message')
-    @asyncio.coroutine
-    def listen_for_text(message):
-        try:
-            author_name = message.author.nick if message.author.nick is not None else message.author.name
-        except AttributeError:
-            author_name = message.author.name
-        logging.info('Heard message from {}.'.format(author_name))
-        if author_name in logbot.LogSessionConfigs.active_logs:
-            logging.info('User in active log.')
-            created_session = logbot.create_session(engine)
-            for log_id in logbot.LogSessionConfigs.active_logs[author_name]:
-                created_session = logbot.add_new_text(
-                    session=created_session,
-                    timestamp=message.timestamp,
-                    character_name=author_name,
-                    username=message.author.name,
-                    text=message.content,
-                    log_id=log_id
-                )
-
-    help_endlog = (
-        "- End logging: !endlog <log name>-<Name 1>-<Name 2>-...-<Name N>\n"
-        "End the log with this command."
+def run_shard(shard_id, shard_count, log_writer_queues):
+    """
+    Entry point of each shard process in sharded mode.
+    """
+    started_at = time.perf_counter()
+    settings_watcher = botconf.SettingsWatcher(
+        botconf.config_file(os.path.join(PACKAGE_DIRECTORY, DEFAULT_CONFIG_LOCATION))
+    )
+    init_logging(settings_watcher.current)
+    logging.info('Shard {} of {} starting.'.format(shard_id, shard_count))
+    run_bot(
+        settings_watcher, read_token(), started_at, started_at,
+        shard_id=shard_id, shard_count=shard_count, log_writer_queues=log_writer_queues
     )
+    logger.shutdown_logging()
 
-    @bot.command(pass_context=True, help=help_endlog)
-    @asyncio.coroutine
-    def endlog(context):
-        try:
-            log_name = context.message.content.split(' ')[1]
-            created_session = logbot.create_session(engine)
-        except IndexError:
-            yield from bot.say('Please specify name of log to end.')
-        else:
-            log_id = logbot.get_log_id(created_session, log_name)
-            for character in list(logbot.LogSessionConfigs.active_logs):
-                if len(logbot.LogSessionConfigs.active_logs[character]) == 1:
-                    del logbot.LogSessionConfigs.active_logs[character]
-                else:
-                    logbot.LogSessionConfigs.active_logs[character].remove(log_id)
-            ended_info_string = 'Ended log {name}.'.format(name=log_name)
-            logging.info(ended_info_string)
-            yield from bot.say(ended_info_string)
-
-    @bot.command(pass_context=True)
-    @asyncio.coroutine
-    def getlog(context):
-        requestor = context.message.author
-        try:
-            log_name = context.message.content.split(' ')[1]
-        except IndexError:
-            yield from bot.say('Please specify log to receive.')
-        else:
-            created_session = logbot.create_session(engine)
-            log_id = logbot.get_log_id(created_session, log_name)
-            responses = logbot.get_text(created_session, log_id)
-            full_text = [str(response) for response in responses]
-            full_text = '\n'.join(full_text)
-            yield from bot.send_message(requestor, full_text)
 
-    logging.info('Retrieving API details...')
-    config = botconf.read_api_configuration(DEFAULT_API_CREDENTIALS_LOCATION)
-    token = config[DEFAULT_BOT_TOKEN_SECTION][DEFAULT_BOT_TOKEN_VALUE_NAME]
-    logging.info('Running bot...')
-    bot.run(token)
+def main():
+    imported_at = time.perf_counter()
+    settings_watcher = botconf.SettingsWatcher(botconf.config_file(DEFAULT_CONFIG_LOCATION))
+    init_logging(settings_watcher.current)
+
+    shard_count = sharding.shard_count_from_config(settings_watcher.current.config)
+    if shard_count > 1:
+        #  Imported only here, so a single-process bot still loads the database code as an extension.
+        import toastbot.shardrunner as shardrunner
+        #  Spawned processes cannot look functions up in __main__; this module under its own name they can.
+        import toastbot.__main__ as entry_point
+        shardrunner.run_sharded(
+            os.path.join(PACKAGE_DIRECTORY, DEFAULT_CONFIG_LOCATION), shard_count, entry_point.run_shard,
+            settings_watcher.current.log_level
+        )
+    else:
+        run_bot(settings_watcher, read_token(), STARTED_AT, imported_at)
     logging.info('Script finished.')
+    logger.shutdown_logging()
 
 if __name__ == "__main__":
     main()
@@ -1,2 +1,3 @@
 from .diceroller import Dicebot, CommandParser, CommandParserConfig
+from .diceroller import DiceExpression, DiceGroup, Constant
 from .diceroller import DiceRollError, DiceRollFormatError
@@ -0,0 +1,229 @@
+"""
+Exact outcome distributions for dice rolls, computed by convolution rather than simulation.
+"""
+import functools
+import itertools
+import math
+
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+#  Rough ceiling on inner-loop steps for one distribution, to keep a single !odds request bounded.
+MAX_ODDS_WORK = 5000000
+
+
+class Distribution:
+    """
+    Probability of every integer outcome between a minimum and a maximum.
+    """
+    def __init__(self, offset, probabilities):
+        #  probabilities[i] is the probability of the value offset + i.
+        self.offset = offset
+        self.probabilities = tuple(probabilities)
+
+    @classmethod
+    def constant(cls, value):
+        return cls(value, (1.0,))
+
+    @property
+    def min_value(self):
+        return self.offset
+
+    @property
+    def max_value(self):
+        return self.offset + len(self.probabilities) - 1
+
+    def items(self):
+        return [(self.offset + i, probability) for i, probability in enumerate(self.probabilities)]
+
+    def probability_of(self, value):
+        index = value - self.offset
+        return self.probabilities[index] if 0 <= index < len(self.probabilities) else 0.0
+
+    def shift(self, amount):
+        return Distribution(self.offset + amount, self.probabilities)
+
+    def negate(self):
+        return Distribution(-self.max_value, reversed(self.probabilities))
+
+    def convolve(self, other):
+        """
+        :return: Distribution of the sum of independent outcomes of self and other.
+        """
+        if len(other.probabilities) == 1:
+            return self.shift(other.offset)
+        if len(self.probabilities) == 1:
+            return other.shift(self.offset)
+        _check_work(len(self.probabilities) * len(other.probabilities))
+        result = [0.0] * (len(self.probabilities) + len(other.probabilities) - 1)
+        for i, left in enumerate(self.probabilities):
+            if left == 0.0:
+                continue
+            for j, right in enumerate(other.probabilities):
+                result[i + j] += left * right
+        return Distribution(self.offset + other.offset, result)
+
+    @property
+    def mean(self):
+        return sum(value * probability for value, probability in self.items())
+
+    @property
+    def variance(self):
+        mean = self.mean
+        return sum((value - mean) ** 2 * probability for value, probability in self.items())
+
+    def percentile(self, percent):
+        """
+        :return: Smallest value with at least `percent` percent of outcomes at or below it.
+        """
+        target = percent / 100.0
+        cumulative = 0.0
+        for value, probability in self.items():
+            cumulative += probability
+            #  Tolerate float rounding so that e.g. the 50th percentile of 1d2 is 1, not 2.
+            if cumulative >= target - 1e-12:
+                return value
+        return self.max_value
+
+    def mode(self):
+        return self.offset + max(range(len(self.probabilities)), key=self.probabilities.__getitem__)
+
+    def summary(self, percentiles=DEFAULT_PERCENTILES):
+        """
+        :return: List of (statistic name, formatted value).
+        """
+        rows = [
+            ('Mean', '{:.2f}'.format(self.mean)),
+            ('Variance', '{:.2f}'.format(self.variance)),
+            ('Std. dev.', '{:.2f}'.format(math.sqrt(self.variance))),
+            ('Min', str(self.min_value)),
+            ('Max', str(self.max_value)),
+            ('Most likely', '{} ({:.2%})'.format(self.mode(), self.probability_of(self.mode()))),
+        ]
+        rows.extend(('{}th percentile'.format(percent), str(self.percentile(percent))) for percent in percentiles)
+        return rows
+
+
+def _check_work(work):
+    if work > MAX_ODDS_WORK:
+        raise ValueError('Roll is too large to compute exact odds for.')
+
+
+@functools.lru_cache(maxsize=256)
+def uniform_sum(num_dice, num_sides):
+    """
+    Distribution of the sum of num_dice fair dice with faces 1..num_sides.
+
+    Each added die is a sliding-window sum over the previous distribution, so it costs one pass
+    rather than a full convolution.
+    """
+    _check_work(num_dice * num_dice * num_sides // 2)
+    face_probability = 1.0 / num_sides
+    probabilities = [1.0]
+    padding = [0.0] * (num_sides - 1)
+    for die in range(num_dice):
+        prefix = [0.0]
+        prefix.extend(itertools.accumulate(probabilities))
+        #  new[i] = prefix[i + 1] - prefix[i + 1 - num_sides], clamped to the ends of prefix.
+        upper = prefix[1:] + [prefix[-1]] * (num_sides - 1)
+        lower = padding + prefix[:-1]
+        probabilities = [(high - low) * face_probability for high, low in zip(upper, lower)]
+    return Distribution(num_dice, probabilities)
+
+
+@functools.lru_cache(maxsize=256)
+def command_distribution(num_dice, num_sides, modifier):
+    """
+    Distribution of the total of a simple NdM roll with `modifier` added to every die.
+    """
+    return uniform_sum(num_dice, num_sides).shift(num_dice * modifier)
+
+
+def reroll_die(num_sides, reroll_at_or_below):
+    """
+    Face probabilities of one die rerolled once if it shows reroll_at_or_below or less.
+    """
+    reroll_probability = reroll_at_or_below / num_sides
+    return tuple(
+        (0.0 if face <= reroll_at_or_below else 1.0 / num_sides) + reroll_probability / num_sides
+        for face in range(1, num_sides + 1)
+    )
+
+
+def repeated_sum(face_probabilities, num_dice):
+    """
+    Distribution of the sum of num_dice independent dice with the given face probabilities, by squaring.
+    """
+    result = Distribution.constant(0)
+    power = Distribution(1, face_probabilities)
+    while num_dice:
+        if num_dice & 1:
+            result = result.convolve(power)
+        num_dice >>= 1
+        if num_dice:
+            power = power.convolve(power)
+    return result
+
+
+def keep_highest(face_probabilities, num_dice, num_kept):
+    """
+    Distribution of the sum of the num_kept highest of num_dice dice.
+
+    Faces are assigned from highest to lowest; the first num_kept dice assigned are the kept ones.
+    States are (dice assigned so far, kept sum).
+    """
+    num_sides = len(face_probabilities)
+    _check_work(num_sides * num_dice * num_dice * (num_kept * num_sides + 1))
+    states = {(0, 0): 1.0}
+    for face in range(num_sides, 0, -1):
+        face_probability = face_probabilities[face - 1]
+        next_states = dict()
+        for (assigned, kept_sum), weight in states.items():
+            remaining = num_dice - assigned
+            face_power = 1.0
+            for count in range(remaining + 1):
+                if count and face_probability == 0.0:
+                    break
+                newly_kept = max(0, min(assigned + count, num_kept) - assigned)
+                key = (assigned + count, kept_sum + newly_kept * face)
+                next_states[key] = next_states.get(key, 0.0) + weight * _binomial(remaining, count) * face_power
+                face_power *= face_probability
+        states = next_states
+    totals = dict()
+    for (assigned, kept_sum), weight in states.items():
+        if assigned == num_dice:
+            totals[kept_sum] = totals.get(kept_sum, 0.0) + weight
+    low = min(totals)
+    return Distribution(low, [totals.get(value, 0.0) for value in range(low, max(totals) + 1)])
+
+
+@functools.lru_cache(maxsize=256)
+def group_distribution(num_dice, num_sides, selection=None, reroll_at_or_below=None):
+    """
+    Distribution of one dice group's value, with optional keep/drop selection and reroll.
+
+    :param selection: (kind, amount) with kind in 'kh', 'kl', 'dh', 'dl', or None.
+    """
+    if reroll_at_or_below is None and selection is None:
+        return uniform_sum(num_dice, num_sides)
+    if reroll_at_or_below is None:
+        face_probabilities = (1.0 / num_sides,) * num_sides
+    else:
+        face_probabilities = reroll_die(num_sides, reroll_at_or_below)
+    if selection is None:
+        return repeated_sum(face_probabilities, num_dice)
+    kind, amount = selection
+    if kind == 'dh':
+        kind, amount = 'kl', num_dice - amount
+    elif kind == 'dl':
+        kind, amount = 'kh', num_dice - amount
+    if amount <= 0:
+        return Distribution.constant(0)
+    if kind == 'kh':
+        return keep_highest(face_probabilities, num_dice, amount)
+    #  Keeping the lowest faces is keeping the highest on a mirrored die: face v becomes num_sides + 1 - v.
+    mirrored = keep_highest(tuple(reversed(face_probabilities)), num_dice, amount)
+    return mirrored.negate().shift(amount * (num_sides + 1))
+
+
+@functools.lru_cache(maxsize=1024)
+def _binomial(n, k):
+    return math.factorial(n) // (math.factorial(k) * math.factorial(n - k))
@@ -1,15 +1,41 @@
 """
 Dicebot functionality
 """
+import collections
+import copy
+import functools
 import random
 import re
 import logging
+import threading
+
+from toastbot.botfunctions import diceodds
 
 ADD = "+"
 SUBTRACT = "-"
 DEFAULT_MAX_DICE = 100
 DEFAULT_MAX_SIDES = 1000
 DEFAULT_MAX_MODIFIER = 1000
+DEFAULT_ROLL_BACKEND = 'python'
+DEFAULT_PARSE_CACHE_SIZE = 256
+DEFAULT_MAX_RNG_STREAMS = 1024
+MAX_EXPRESSION_TERMS = 20
+#  Cap on extra dice added by exploding, so a long run of maximum rolls always terminates.
+MAX_EXPLODED_DICE = 100
+
+KEEP_HIGHEST = 'kh'
+KEEP_LOWEST = 'kl'
+DROP_HIGHEST = 'dh'
+DROP_LOWEST = 'dl'
+KEEP_DROP_ALIASES = {'k': KEEP_HIGHEST}
+
+_COMMAND_WORD_REGEX = re.compile(r'^\s*![a-z_]*')
+_EXPRESSION_WORD_REGEX = re.compile(r'^[0-9dkhlr!%+\-]+$')
+_SIGN_SPACING_REGEX = re.compile(r'\s*([+\-])\s*')
+_TOKEN_REGEX = re.compile(
+    r'(?P<number>[0-9]+)|(?P<keep>k[hl]?)|(?P<drop>d[hl])|(?P<dice>d)|(?P<percent>%)'
+    r'|(?P<explode>!)|(?P<reroll>r)|(?P<sign>[+\-])'
+)
 
 
 class DiceRollError(ValueError):
@@ -32,77 +58,363 @@ class CommandParserConfig:
             permitted_operations="{}{}".format(ADD, SUBTRACT),
             max_num_dice=DEFAULT_MAX_DICE,
             max_num_sides=DEFAULT_MAX_SIDES,
-            max_modifier=DEFAULT_MAX_MODIFIER
+            max_modifier=DEFAULT_MAX_MODIFIER,
+            parse_cache_size=DEFAULT_PARSE_CACHE_SIZE
     ):
         self.permitted_operations = permitted_operations
         self.max_num_dice = max_num_dice
         self.max_num_sides = max_num_sides
         self.max_modifier = max_modifier
+        self.parse_cache_size = parse_cache_size
+        #  Plain NdM[+-K] rolls, which keep their original per-die modifier behaviour.
+        self.simple_command_regex = re.compile(
+            "^([0-9]+)d([0-9]+)(?:([" + re.escape(self.permitted_operations) + "])([0-9]+))?$"
+        )
+
+
+def normalize_command(raw_command):
+    """
+    Reduce a roll command to its bare expression: lowercase, no command word, no whitespace, and
+    nothing from the first word that is not part of a dice expression onwards.
+
+    "!roll 4d6kh3 + 2 for stats" -> "4d6kh3+2"
+
+    Whitespace is only dropped around signs, so "2d10 5" is rejected rather than read as 2d105.
+    """
+    text = _COMMAND_WORD_REGEX.sub('', raw_command.lower(), count=1)
+    words = list()
+    for word in text.split():
+        if not _EXPRESSION_WORD_REGEX.match(word):
+            break
+        words.append(word)
+    return _SIGN_SPACING_REGEX.sub(r'\1', ' '.join(words))
 
 
 class CommandParser:
 
     def __init__(self, command_parser_config=CommandParserConfig()):
-        self.config = command_parser_config
-        self._command_parsing_regex = (
-            "[^0-9]*([0-9]+)d([0-9]+)(?:([" +
-            "{mods}".format(mods=self.config.permitted_operations) +
-            "]{0,1})([0-9]+)){0,1}"
-        )
+        self.reconfigure(command_parser_config)
         logging.info('Command parser initialized.')
-        logging.debug('Allowed operations: {}'.format(self.config.permitted_operations))
-        logging.debug('Maximum dice: {}'.format(self.config.max_num_dice))
-        logging.debug('Maximum sides: {}'.format(self.config.max_num_sides))
-        logging.debug('Maximum modifier: {}'.format(self.config.max_modifier))
-        logging.debug('Command regex: {}'.format(self._command_parsing_regex))
+        logging.debug('Allowed operations: %s', self.config.permitted_operations)
+        logging.debug('Maximum dice: %s', self.config.max_num_dice)
+        logging.debug('Maximum sides: %s', self.config.max_num_sides)
+        logging.debug('Maximum modifier: %s', self.config.max_modifier)
+        logging.debug('Command regex: %s', self.config.simple_command_regex.pattern)
+
+    @property
+    def config(self):
+        return self._state[0]
+
+    def reconfigure(self, command_parser_config):
+        """
+        Switch to new limits, e.g. after the configuration is reloaded.
+
+        The config and the cache of commands validated against it are replaced in one assignment,
+        so a parse on another thread uses either the old limits or the new ones throughout.
+        """
+        parse = functools.lru_cache(maxsize=command_parser_config.parse_cache_size)(
+            functools.partial(self._parse, command_parser_config)
+        )
+        self._state = (command_parser_config, parse)
 
     def parse_command(self, raw_command):
-        logging.info('Command received: {}'.format(raw_command))
-        result = re.match(self._command_parsing_regex, raw_command)
-        if result is None:
-            logging.error('Unparseable command: {}'.format(raw_command))
-            raise DiceRollFormatError("Regex failed to match command. Command: {}".format(raw_command))
-        else:
+        """
+        Parse a roll command into either a simple Command or a DiceExpression.
+
+        Parsing and validation results are cached by normalized expression, so repeated rolls of
+        the same macro skip both.
+        """
+        logging.debug('Command received: %s', raw_command)
+        parse = self._state[1]
+        parsed = copy.copy(parse(normalize_command(raw_command)))
+        parsed.raw_command = raw_command
+        return parsed
+
+    def _parse(self, config, expression_text):
+        result = config.simple_command_regex.match(expression_text)
+        if result is not None:
             #  Group 0 is the entire match.
             num_dice = int(result.group(1))
-            logging.debug('# of dice: {}'.format(num_dice))
             num_sides = int(result.group(2))
-            logging.debug('# of sides: {}'.format(num_sides))
             operation_sign = result.group(3) if result.group(3) else None
-            logging.debug('Operation: {}'.format(operation_sign))
             modifier = int(result.group(4)) if result.group(4) else None
-            logging.debug('Modifier: {}'.format(modifier))
-            command = Command(num_dice, num_sides, modifier, operation_sign, raw_command)
-            self._validate_command(command)
-            logging.info('Command parsed.')
-            return command
-
-    def _validate_command(self, command):
-        if command.modifier is not None and command.modifier > self.config.max_modifier:
+            command = Command(num_dice, num_sides, modifier, operation_sign, expression_text)
+            self._validate_command(config, command)
+        else:
+            command = _ExpressionParser(expression_text).parse()
+            self._validate_expression(config, command)
+        logging.debug('Command parsed.')
+        return command
+
+    def _validate_command(self, config, command):
+        if command.modifier is not None and command.modifier > config.max_modifier:
             exception_msg = "Error: Specified roll modifier is too large. Requested: {}, maximum is {}.".format(
-                command.modifier, self.config.max_modifier
+                command.modifier, config.max_modifier
             )
             raise DiceRollError(exception_msg)
-        elif command.roll_operation is not None and command.roll_operation not in self.config.permitted_operations:
+        elif command.roll_operation is not None and command.roll_operation not in config.permitted_operations:
             #  Provide standard initial output string for error.
             exception_msg = "Error: Specified modifier operation is unsupported.\nSupported operations: {}".format(
-                self.config.permitted_operations
+                config.permitted_operations
             )
             raise DiceRollError(exception_msg)
 
-        elif command.num_dice > self.config.max_num_dice:
+        elif command.num_dice > config.max_num_dice:
             exception_msg = "Error: Specified number of dice is too large. Requested: {}, maximum is {}.".format(
-                command.num_dice, self.config.max_num_dice
+                command.num_dice, config.max_num_dice
             )
             raise DiceRollError(exception_msg)
-        elif command.num_sides > self.config.max_num_sides:
+        elif command.num_sides > config.max_num_sides:
             exception_msg = "Error: Specified size of dice is too large. Requested: {}, maximum is {}.".format(
-                command.num_sides, self.config.max_num_sides
+                command.num_sides, config.max_num_sides
             )
             raise DiceRollError(exception_msg)
+        elif command.num_sides < Dicebot.MIN_NUM_SIDES_ON_DICE or command.num_dice < 1:
+            raise DiceRollError("Error: Dice must have at least one die and one side: {}d{}".format(
+                command.num_dice, command.num_sides
+            ))
         else:
-            logging.info('Command passed validation checks.')
-            pass
+            logging.debug('Command passed validation checks.')
+
+    def _validate_expression(self, config, expression):
+        if len(expression.terms) > MAX_EXPRESSION_TERMS:
+            raise DiceRollError("Error: Roll has too many terms. Requested: {}, maximum is {}.".format(
+                len(expression.terms), MAX_EXPRESSION_TERMS
+            ))
+        total_dice = 0
+        for index, (sign, term) in enumerate(expression.terms):
+            #  A leading term with no sign written is implicitly added, whatever operations are permitted.
+            if (index > 0 or sign != ADD) and sign not in config.permitted_operations:
+                raise DiceRollError("Error: Specified modifier operation is unsupported.\nSupported operations: {}".format(
+                    config.permitted_operations
+                ))
+            if isinstance(term, Constant):
+                if term.value > config.max_modifier:
+                    raise DiceRollError("Error: Specified roll modifier is too large. Requested: {}, maximum is {}.".format(
+                        term.value, config.max_modifier
+                    ))
+                continue
+            total_dice += term.num_dice
+            if term.num_sides > config.max_num_sides:
+                raise DiceRollError("Error: Specified size of dice is too large. Requested: {}, maximum is {}.".format(
+                    term.num_sides, config.max_num_sides
+                ))
+            if term.num_sides < Dicebot.MIN_NUM_SIDES_ON_DICE or term.num_dice < 1:
+                raise DiceRollError("Error: Dice must have at least one die and one side: {}".format(term))
+            if term.selection is not None and term.selection[1] > term.num_dice:
+                raise DiceRollError("Error: Cannot keep or drop more dice than are rolled: {}".format(term))
+            if term.explode and term.num_sides < 2:
+                raise DiceRollError("Error: Only dice with two or more sides can explode: {}".format(term))
+            if term.reroll_at_or_below is not None and term.reroll_at_or_below >= term.num_sides:
+                raise DiceRollError("Error: Reroll threshold must be below the number of sides: {}".format(term))
+        if total_dice > config.max_num_dice:
+            raise DiceRollError("Error: Specified number of dice is too large. Requested: {}, maximum is {}.".format(
+                total_dice, config.max_num_dice
+            ))
+        logging.debug('Command passed validation checks.')
+
+
+class _ExpressionParser:
+    """
+    Recursive-descent parser for dice expressions.
+
+    expression := [sign] term (sign term)*
+    term       := number | [number] "d" (number | "%") modifier*
+    modifier   := ("kh" | "kl" | "k" | "dh" | "dl") [number] | "!" | "r" [number]
+    """
+
+    def __init__(self, expression_text):
+        self.expression_text = expression_text
+        self.tokens = self._tokenize(expression_text)
+        self.position = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise DiceRollFormatError("No dice expression found.")
+        terms = list()
+        sign = self._accept('sign') or ADD
+        terms.append((sign, self._term()))
+        while self.position < len(self.tokens):
+            sign = self._expect('sign')
+            terms.append((sign, self._term()))
+        return DiceExpression(terms, self.expression_text)
+
+    def _term(self):
+        count = self._accept('number')
+        if self._accept('dice') is None:
+            if count is None:
+                self._fail()
+            return Constant(int(count))
+        sides = self._accept('percent')
+        sides = 100 if sides is not None else int(self._expect('number'))
+        group = DiceGroup(int(count) if count is not None else 1, sides)
+        while True:
+            selector = self._accept('keep') or self._accept('drop')
+            if selector is not None:
+                if group.selection is not None:
+                    self._fail()
+                amount = self._accept('number')
+                group.selection = (KEEP_DROP_ALIASES.get(selector, selector), int(amount) if amount else 1)
+            elif self._accept('explode') is not None:
+                group.explode = True
+            elif self._accept('reroll') is not None:
+                threshold = self._accept('number')
+                group.reroll_at_or_below = int(threshold) if threshold else 1
+            else:
+                return group
+
+    def _accept(self, kind):
+        if self.position < len(self.tokens) and self.tokens[self.position][0] == kind:
+            value = self.tokens[self.position][1]
+            self.position += 1
+            return value
+        return None
+
+    def _expect(self, kind):
+        value = self._accept(kind)
+        if value is None:
+            self._fail()
+        return value
+
+    def _fail(self):
+        raise DiceRollFormatError("Could not parse dice expression: {}".format(self.expression_text))
+
+    def _tokenize(self, expression_text):
+        tokens = list()
+        position = 0
+        while position < len(expression_text):
+            match = _TOKEN_REGEX.match(expression_text, position)
+            if match is None:
+                self._fail()
+            tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            position = match.end()
+        return tokens
+
+
+class PythonRollBackend:
+    """
+    Draws a whole batch of dice in one call on a standard library random.Random generator.
+    """
+    name = 'python'
+    #  random.choices arrived in Python 3.6; fall back to one randint per die before that.
+    _has_choices = hasattr(random.Random, 'choices')
+
+    def create_generator(self, seed=None):
+        return random.Random(seed)
+
+    def get_state(self, generator):
+        return generator.getstate()
+
+    def set_state(self, generator, state):
+        generator.setstate(state)
+
+    def roll(self, generator, num_dice, num_sides):
+        if self._has_choices:
+            return generator.choices(range(Dicebot.MIN_NUM_SIDES_ON_DICE, num_sides + 1), k=num_dice)
+        randint = generator.randint
+        return [randint(Dicebot.MIN_NUM_SIDES_ON_DICE, num_sides) for i in range(num_dice)]
+
+    def count(self, raw_rolls):
+        return collections.Counter(raw_rolls)
+
+
+class NumpyRollBackend:
+    """
+    Draws and counts dice with NumPy. Requires the optional numpy package.
+    """
+    name = 'numpy'
+
+    def __init__(self):
+        import numpy
+        self.numpy = numpy
+
+    def create_generator(self, seed=None):
+        if seed is not None and not isinstance(seed, int):
+            #  RandomState only takes integer seeds; derive one deterministically from anything else.
+            seed = random.Random(seed).getrandbits(32)
+        elif seed is not None:
+            seed %= 2 ** 32
+        return self.numpy.random.RandomState(seed)
+
+    def get_state(self, generator):
+        return generator.get_state()
+
+    def set_state(self, generator, state):
+        generator.set_state(state)
+
+    def roll(self, generator, num_dice, num_sides):
+        return generator.randint(Dicebot.MIN_NUM_SIDES_ON_DICE, num_sides + 1, size=num_dice).tolist()
+
+    def count(self, raw_rolls):
+        counts = self.numpy.bincount(raw_rolls)
+        values = self.numpy.nonzero(counts)[0]
+        return dict(zip(values.tolist(), counts[values].tolist()))
+
+
+class RandomStreams:
+    """
+    Independent random generators keyed by stream, e.g. per guild or per user, kept in a bounded LRU.
+
+    Streams are created lazily from OS entropy. A seeded stream that is evicted loses its position;
+    take a snapshot first if it needs to be replayed later.
+    """
+    def __init__(self, roll_backend, max_streams=DEFAULT_MAX_RNG_STREAMS):
+        self.roll_backend = roll_backend
+        self.max_streams = max_streams
+        self._streams = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._streams)
+
+    def get(self, stream_key):
+        with self._lock:
+            try:
+                self._streams.move_to_end(stream_key)
+                return self._streams[stream_key]
+            except KeyError:
+                return self._store(stream_key, self.roll_backend.create_generator())
+
+    def seed(self, stream_key, value):
+        with self._lock:
+            self._store(stream_key, self.roll_backend.create_generator(value))
+
+    def snapshot(self, stream_key):
+        """
+        :return: Opaque generator state that restore() can return the stream to.
+        """
+        return self.roll_backend.get_state(self.get(stream_key))
+
+    def restore(self, stream_key, state):
+        self.roll_backend.set_state(self.get(stream_key), state)
+
+    def _store(self, stream_key, generator):
+        self._streams[stream_key] = generator
+        self._streams.move_to_end(stream_key)
+        while len(self._streams) > self.max_streams:
+            self._streams.popitem(last=False)
+        return generator
+
+
+ROLL_BACKENDS = {
+    PythonRollBackend.name: PythonRollBackend,
+    NumpyRollBackend.name: NumpyRollBackend,
+}
+
+
+def create_roll_backend(name=DEFAULT_ROLL_BACKEND):
+    """
+    Create a dice roll backend by name, falling back to the standard library if NumPy is missing.
+    """
+    try:
+        backend_class = ROLL_BACKENDS[name]
+    except KeyError:
+        raise DiceRollError("Unknown roll backend: {}. Available: {}".format(name, ', '.join(sorted(ROLL_BACKENDS))))
+    try:
+        return backend_class()
+    except ImportError:
+        logging.warning('Roll backend {} unavailable; using {}.'.format(name, PythonRollBackend.name))
+        return PythonRollBackend()
 
 
 class Dicebot:
@@ -111,57 +423,160 @@ class Dicebot:
     """
     MIN_NUM_SIDES_ON_DICE = 1
 
-    def __init__(self, command_parser=CommandParser()):
+    def __init__(self, command_parser=CommandParser(), roll_backend=None, max_rng_streams=DEFAULT_MAX_RNG_STREAMS):
         logging.info('Dicebot initialized.')
         self.command_parser = command_parser
+        self.roll_backend = roll_backend if roll_backend is not None else PythonRollBackend()
+        self.streams = RandomStreams(self.roll_backend, max_rng_streams)
 
-    def set_seed(self, value):
-        random.seed(value)
-        logging.info('Dicebot seed set to {}'.format(value))
+    def set_seed(self, value, stream_key=None):
+        """
+        Seed one random stream, leaving every other stream untouched.
+
+        :param stream_key: Stream to seed, e.g. a guild or user id; None is the default stream.
+        """
+        self.streams.seed(stream_key, value)
+        logging.info('Dicebot seed set to {} for stream {}'.format(value, stream_key))
         return "Dicebot seed set to {}".format(value)
 
-    def roll(self, raw_command):
-        logging.info('Dicebot received command: {}'.format(raw_command))
+    def snapshot(self, stream_key=None):
+        return self.streams.snapshot(stream_key)
+
+    def restore(self, state, stream_key=None):
+        self.streams.restore(stream_key, state)
+
+    def roll(self, raw_command, stream_key=None):
+        logging.debug('Dicebot received command: %s', raw_command)
         command = self.command_parser.parse_command(raw_command)
-        raw_results = self._roll_dice(command)
+        generator = self.streams.get(stream_key)
+        if isinstance(command, DiceExpression):
+            results = self._roll_expression(command, generator)
+            logging.debug('Dicebot returning results for expression.')
+            return results
+        raw_results = self._roll_dice(command, generator)
         modified_results = self._apply_modifier(raw_results, command)
-        results = DiceResults(raw_results, modified_results, command)
-        logging.info('Dicebot returning results for command.')
+        results = DiceResults(raw_results, modified_results, command, self.roll_backend.count)
+        logging.debug('Dicebot returning results for command.')
         return results
 
-    @staticmethod
-    def _roll_dice(command):
-        logging.debug('Rolling dice for command: {}'.format(str(command)))
-        #  List comprehension to generate random numbers for each desired die.
-        raw_results = [random.randint(Dicebot.MIN_NUM_SIDES_ON_DICE, command.num_sides)
-                       for i in range(command.num_dice)]
-        logging.debug('Dicebot returning results: {}.'.format(raw_results))
+    def odds(self, raw_command):
+        """
+        Parse a roll command and compute the exact distribution of its total.
+
+        :return: diceodds.Distribution.
+        """
+        logging.debug('Dicebot received odds command: %s', raw_command)
+        return self.distribution(self.command_parser.parse_command(raw_command))
+
+    def distribution(self, command):
+        """
+        Exact distribution of the total of a parsed Command or DiceExpression.
+
+        For a simple Command the modifier applies to every die, as it does when rolling, and the
+        result is memoized per (num_dice, num_sides, modifier).
+
+        :return: diceodds.Distribution.
+        """
+        try:
+            if isinstance(command, Command):
+                modifier = self._calc_modifier(command.modifier, command.roll_operation)
+                return diceodds.command_distribution(command.num_dice, command.num_sides, modifier)
+            total = diceodds.Distribution.constant(0)
+            for sign, term in command.terms:
+                if isinstance(term, Constant):
+                    term_distribution = diceodds.Distribution.constant(term.value)
+                elif term.explode:
+                    raise DiceRollError("Error: Odds are not available for exploding dice: {}".format(term))
+                else:
+                    term_distribution = diceodds.group_distribution(
+                        term.num_dice, term.num_sides, term.selection, term.reroll_at_or_below
+                    )
+                if sign == SUBTRACT:
+                    term_distribution = term_distribution.negate()
+                total = total.convolve(term_distribution)
+            return total
+        except DiceRollError:
+            raise
+        except ValueError as error:
+            raise DiceRollError("Error: {}".format(error))
+
+    def _roll_dice(self, command, generator):
+        #  One bulk draw for the whole batch rather than one call per die.
+        raw_results = self.roll_backend.roll(generator, command.num_dice, command.num_sides)
+        logging.debug('Dicebot rolled %d dice for command: %s', len(raw_results), command.raw_command)
         return raw_results
 
-    def _apply_modifier(self, raw_results, command):
-        logging.debug('Dicebot applying modifier: {} to results: {}'.format(command.modifier, raw_results))
-        if command.modifier is not None:
-            modified_results = [self._calc_modifier(item, command.modifier, command.roll_operation)
-                                for item in raw_results]
-            logging.debug('Dicebot modified results: {}'.format(modified_results))
+    def _roll_expression(self, expression, generator):
+        term_results = list()
+        for sign, term in expression.terms:
+            if isinstance(term, Constant):
+                term_results.append(TermResult(sign, term, None, None, term.value))
+            else:
+                rolls = self._roll_group(term, generator)
+                kept, dropped = self._select(rolls, term)
+                term_results.append(TermResult(sign, term, rolls, dropped, sum(kept)))
+        return ExpressionResults(term_results, expression)
+
+    def _roll_group(self, group, generator):
+        rolls = self.roll_backend.roll(generator, group.num_dice, group.num_sides)
+        if group.reroll_at_or_below is not None:
+            #  Each low die is rerolled once, all in one batch; the new value stands.
+            low_positions = [i for i, value in enumerate(rolls) if value <= group.reroll_at_or_below]
+            if low_positions:
+                rerolls = self.roll_backend.roll(generator, len(low_positions), group.num_sides)
+                for position, value in zip(low_positions, rerolls):
+                    rolls[position] = value
+        if group.explode:
+            explosions = rolls.count(group.num_sides)
+            exploded_dice = 0
+            while explosions and exploded_dice < MAX_EXPLODED_DICE:
+                explosions = min(explosions, MAX_EXPLODED_DICE - exploded_dice)
+                extra_rolls = self.roll_backend.roll(generator, explosions, group.num_sides)
+                rolls.extend(extra_rolls)
+                exploded_dice += explosions
+                explosions = extra_rolls.count(group.num_sides)
+        return rolls
+
+    @staticmethod
+    def _select(rolls, group):
+        """
+        :return: Tuple of the kept rolls and the dropped rolls.
+        """
+        if group.selection is None:
+            return rolls, []
+        kind, amount = group.selection
+        ordered = sorted(rolls)
+        amount = min(amount, len(ordered))
+        if kind == KEEP_HIGHEST:
+            split = len(ordered) - amount
+            return ordered[split:], ordered[:split]
+        elif kind == KEEP_LOWEST:
+            return ordered[:amount], ordered[amount:]
+        elif kind == DROP_HIGHEST:
+            split = len(ordered) - amount
+            return ordered[:split], ordered[split:]
         else:
-            modified_results = raw_results
-            logging.debug('No modifier applied.')
-        return modified_results
+            return ordered[amount:], ordered[:amount]
+
+    def _apply_modifier(self, raw_results, command):
+        modifier = self._calc_modifier(command.modifier, command.roll_operation)
+        if modifier == 0:
+            return raw_results
+        return [item + modifier for item in raw_results]
 
     @staticmethod
-    def _calc_modifier(value, modifier, roll_operation):
-        logging.debug('Detecting modifier...')
-        if roll_operation == ADD:
-            modified_value = value + modifier
-            logging.debug('Adding modifier.')
+    def _calc_modifier(modifier, roll_operation):
+        """
+        :return: Signed amount to add to every die.
+        """
+        if modifier is None:
+            return 0
+        elif roll_operation == ADD:
+            return modifier
         elif roll_operation == SUBTRACT:
-            modified_value = value - modifier
-            logging.debug('Subtracting modifier.')
+            return -modifier
         else:
             raise DiceRollError("Unsupported modifier type received. Modifier sign: {}".format(roll_operation))
-        logging.debug('Returning modified results.')
-        return modified_value
 
 
 class Command:
@@ -173,11 +588,136 @@ class Command:
         self.raw_command = raw_command
 
 
+class Constant:
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value)
+
+
+class DiceGroup:
+    """
+    One group of identical dice in an expression, with its keep/drop, explode and reroll options.
+    """
+    def __init__(self, num_dice, num_sides, selection=None, explode=False, reroll_at_or_below=None):
+        self.num_dice = num_dice
+        self.num_sides = num_sides
+        #  (kind, amount), kind being one of KEEP_HIGHEST, KEEP_LOWEST, DROP_HIGHEST, DROP_LOWEST.
+        self.selection = selection
+        self.explode = explode
+        self.reroll_at_or_below = reroll_at_or_below
+
+    def __str__(self):
+        text = '{}d{}'.format(self.num_dice, self.num_sides)
+        if self.reroll_at_or_below is not None:
+            text += 'r{}'.format(self.reroll_at_or_below)
+        if self.explode:
+            text += '!'
+        if self.selection is not None:
+            text += '{}{}'.format(*self.selection)
+        return text
+
+
+class DiceExpression:
+    """
+    Parsed dice expression: a list of (sign, term) pairs, each term a DiceGroup or a Constant.
+    """
+    def __init__(self, terms, raw_command):
+        self.terms = terms
+        self.raw_command = raw_command
+
+    def __str__(self):
+        text = ''.join('{}{}'.format(sign, term) for sign, term in self.terms)
+        return text[1:] if text.startswith(ADD) else text
+
+
+class TermResult:
+    def __init__(self, sign, term, rolls, dropped, value):
+        self.sign = sign
+        self.term = term
+        self.rolls = rolls
+        self.dropped = dropped
+        self.value = value
+
+    @property
+    def signed_value(self):
+        return -self.value if self.sign == SUBTRACT else self.value
+
+    def __str__(self):
+        if self.rolls is None:
+            return '{} {}'.format(self.sign, self.value)
+        text = '{} {}: {}'.format(self.sign, self.term, ','.join(str(item) for item in self.rolls))
+        if self.dropped:
+            text += ' (dropped {})'.format(','.join(str(item) for item in self.dropped))
+        return '{} = {}'.format(text, self.value)
+
+
+class ExpressionResults:
+    def __init__(self, term_results, command):
+        self.term_results = term_results
+        self.command = command
+        self.total = sum(term_result.signed_value for term_result in term_results)
+
+    @property
+    def raw_rolls(self):
+        return [value for term_result in self.term_results if term_result.rolls for value in term_result.rolls]
+
+    @property
+    def modified_rolls(self):
+        return [self.total]
+
+    @property
+    def critical_count(self):
+        return sum(
+            term_result.rolls.count(term_result.term.num_sides)
+            for term_result in self.term_results if term_result.rolls
+        )
+
+    @property
+    def fumble_count(self):
+        return sum(term_result.rolls.count(1) for term_result in self.term_results if term_result.rolls)
+
+    def __str__(self):
+        terms = [str(term_result) for term_result in self.term_results]
+        if terms[0].startswith(ADD):
+            terms[0] = terms[0][len(ADD):].lstrip()
+        result_msg = "Roll: {command}\n{terms}\nTotal: {total}".format(
+            command=self.command.raw_command,
+            terms='\n'.join(terms),
+            total=self.total
+        )
+        return result_msg
+
+
 class DiceResults:
-    def __init__(self, raw_rolls, modified_rolls, command):
+    def __init__(self, raw_rolls, modified_rolls, command, count=collections.Counter):
         self.raw_rolls = raw_rolls
         self.modified_rolls = modified_rolls
         self.command = command
+        self._count = count
+
+    @property
+    def total(self):
+        return sum(self.modified_rolls)
+
+    @property
+    def critical_count(self):
+        return self.raw_rolls.count(self.command.num_sides)
+
+    @property
+    def fumble_count(self):
+        return self.raw_rolls.count(1)
+
+    def histogram(self):
+        """
+        Count of each rolled value, computed once over the raw rolls.
+
+        :return: List of (modified value, raw value, count), sorted by raw value.
+        """
+        modifier = Dicebot._calc_modifier(self.command.modifier, self.command.roll_operation)
+        raw_counts = self._count(self.raw_rolls)
+        return [(raw + modifier, raw, raw_counts[raw]) for raw in sorted(raw_counts)]
 
     def __str__(self):
         raw_rolls_for_msg = [str(item) for item in self.raw_rolls]
@@ -0,0 +1,285 @@
+"""
+Asynchronous access to the log database.
+
+Every call runs the synchronous logbot functions on a bounded thread pool so that
+SQLite I/O never blocks the event loop, and records how long each call took.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import logging
+import time
+
+import toastbot.botfunctions.logarchive as logarchive
+import toastbot.botfunctions.logbot as logbot
+import toastbot.defaultlogger as defaultlogger
+
+DEFAULT_MAX_WORKERS = 2
+
+
+class CallTiming:
+    """
+    Running timing totals for a single data-access call.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, elapsed):
+        self.count += 1
+        self.total_seconds += elapsed
+        self.max_seconds = max(self.max_seconds, elapsed)
+
+    @property
+    def mean_seconds(self):
+        return self.total_seconds / self.count if self.count else 0.0
+
+    def __str__(self):
+        return 'calls: {}, mean: {:.2f}ms, max: {:.2f}ms'.format(
+            self.count, self.mean_seconds * 1000, self.max_seconds * 1000
+        )
+
+
+class AsyncLogbot:
+    """
+    Executor-backed wrapper around the logbot functions, for use from coroutines.
+    """
+
+    def __init__(self, engine, max_workers=DEFAULT_MAX_WORKERS, loop=None, bot_metrics=None,
+                 session_leak_threshold=logbot.DEFAULT_SESSION_LEAK_SECONDS, archive=None):
+        """
+        :param bot_metrics: Optional metrics.BotMetrics to record call latencies on.
+        :param session_leak_threshold: Seconds a session may stay open before it is reported as leaked.
+        :param archive: Optional logarchive.LogArchive that ended logs are moved to and read from.
+        """
+        self.engine = engine
+        self.archive = archive
+        #  A LogArchive reads like the logbot module, adding archived lines to those in the database.
+        self.text_reader = archive if archive is not None else logbot
+        self.open_sessions = logbot.open_sessions(engine)
+        self.session_leak_threshold = session_leak_threshold
+        self.metrics = bot_metrics
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.timings = collections.defaultdict(CallTiming)
+        #  Calls submitted from the event loop and not yet finished, including those queued for a worker.
+        self.pending_calls = 0
+        logging.info('Async log database access initialized with {} workers.'.format(max_workers))
+
+    @asyncio.coroutine
+    def run(self, call_name, func, *args):
+        """
+        Run a blocking function on the data-access thread pool.
+
+        :param call_name: Name to record the call's timing under.
+        :param func: Blocking function to run.
+        :return: Whatever func returns.
+        """
+        self.pending_calls += 1
+        try:
+            result = yield from self.loop.run_in_executor(
+                self.executor, functools.partial(self.run_sync, call_name, func, *args)
+            )
+        finally:
+            self.pending_calls -= 1
+        return result
+
+    def run_sync(self, call_name, func, *args):
+        """
+        Run a blocking function in the calling thread, recording its timing.
+        """
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.record_call(call_name, time.perf_counter() - start)
+
+    def record_call(self, call_name, elapsed):
+        self.timings[call_name].record(elapsed)
+        if self.metrics is not None:
+            self.metrics.observe_db_call(call_name, elapsed)
+        defaultlogger.log_event(logging.DEBUG, 'log_db_call', call=call_name, ms=round(elapsed * 1000, 2))
+
+    @asyncio.coroutine
+    def start_log(self, name, timestamp, character_names=()):
+        log_id = yield from self.run('start_log', _start_log, self.engine, name, timestamp, character_names)
+        return log_id
+
+    @asyncio.coroutine
+    def end_log(self, log_id, timestamp):
+        yield from self.run('end_log', _end_log, self.engine, log_id, timestamp)
+
+    @asyncio.coroutine
+    def end_untracked_logs(self, active_log_ids, timestamp):
+        """
+        Mark every log that is not running as ended. Only for a bot that runs every log, i.e. unsharded.
+
+        :return: Number of logs marked.
+        """
+        ended = yield from self.run(
+            'end_untracked_logs', _end_untracked_logs, self.engine, frozenset(active_log_ids), timestamp
+        )
+        return ended
+
+    @asyncio.coroutine
+    def is_log_ended(self, log_id):
+        ended = yield from self.run('is_log_ended', _is_log_ended, self.engine, log_id)
+        return ended
+
+    @asyncio.coroutine
+    def get_log_id(self, name, timestamp=None):
+        log_id = yield from self.run('get_log_id', _get_log_id, self.engine, name, timestamp)
+        return log_id
+
+    @asyncio.coroutine
+    def get_text(self, log_id):
+        responses = yield from self.run('get_text', _get_text, self.engine, self.text_reader, log_id)
+        return responses
+
+    @asyncio.coroutine
+    def get_text_page(self, log_id, after=None, page_size=logbot.DEFAULT_TEXT_PAGE_SIZE):
+        responses = yield from self.run(
+            'get_text_page', _get_text_page, self.engine, self.text_reader, log_id, after, page_size
+        )
+        return responses
+
+    @asyncio.coroutine
+    def write_batch(self, pending_texts, pending_rolls):
+        yield from self.run('write_batch', _write_batch, self.engine, pending_texts, pending_rolls)
+
+    def write_batch_sync(self, pending_texts, pending_rolls):
+        """
+        Blocking variant of write_batch, for draining buffers after the event loop has stopped.
+        """
+        self.run_sync('write_batch', _write_batch, self.engine, pending_texts, pending_rolls)
+
+    @asyncio.coroutine
+    def archive_log(self, log_id):
+        """
+        Move an ended log's text into the archive.
+
+        :return: Number of lines archived.
+        """
+        line_count = yield from self.run('archive_log', _archive_log, self.engine, self.archive, log_id)
+        return line_count
+
+    @asyncio.coroutine
+    def archive_ended_logs(self, active_log_ids):
+        """
+        Archive every log with text in the database that is not running, one log per transaction.
+
+        :return: Number of logs archived.
+        """
+        log_ids = yield from self.run('ended_log_ids', _ended_log_ids, self.engine, frozenset(active_log_ids))
+        for log_id in log_ids:
+            yield from self.archive_log(log_id)
+        return len(log_ids)
+
+    @asyncio.coroutine
+    def search_text(self, terms, character_name=None, log_name=None, since=None, until=None,
+                    limit=logbot.DEFAULT_SEARCH_LIMIT):
+        results = yield from self.run(
+            'search_text', _search_text, self.engine, terms, character_name, log_name, since, until, limit
+        )
+        return results
+
+    @asyncio.coroutine
+    def get_roll_summary(self, kind, key):
+        summary = yield from self.run('get_roll_summary', _get_roll_summary, self.engine, kind, key)
+        return summary
+
+    @asyncio.coroutine
+    def watch_sessions(self, interval):
+        """
+        Report leaked sessions every `interval` seconds until cancelled.
+        """
+        while True:
+            yield from asyncio.sleep(interval, loop=self.loop)
+            logbot.report_leaked_sessions(self.engine, self.session_leak_threshold)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        for call_name, timing in sorted(self.timings.items()):
+            logging.info('Log database {}: {}'.format(call_name, timing))
+        logbot.report_leaked_sessions(self.engine, 0)
+        self.engine.dispose()
+        if self.archive is not None:
+            self.archive.close()
+
+
+def write_calls(engine, archive=None):
+    """
+    The calls that write to the log database, for a process that writes on behalf of others.
+
+    :return: Dict of call name -> blocking function taking the call's arguments.
+    """
+    return {
+        'start_log': functools.partial(_start_log, engine),
+        'end_log': functools.partial(_end_log, engine),
+        'write_batch': functools.partial(_write_batch, engine),
+        'archive_log': functools.partial(_archive_log, engine, archive),
+    }
+
+
+def _start_log(engine, name, timestamp, character_names):
+    with logbot.session_scope(engine) as session:
+        logbot.add_log(session, name, timestamp)
+        logbot.warm_character_cache(session, character_names)
+        return logbot.get_log_id(session, name, timestamp)
+
+
+def _end_log(engine, log_id, timestamp):
+    with logbot.session_scope(engine) as session:
+        logbot.end_log(session, log_id, timestamp)
+
+
+def _end_untracked_logs(engine, active_log_ids, timestamp):
+    with logbot.session_scope(engine) as session:
+        return logbot.end_untracked_logs(session, active_log_ids, timestamp)
+
+
+def _is_log_ended(engine, log_id):
+    with logbot.read_session(engine) as session:
+        return logbot.is_log_ended(session, log_id)
+
+
+def _get_log_id(engine, name, timestamp):
+    with logbot.read_session(engine) as session:
+        return logbot.get_log_id(session, name, timestamp)
+
+
+def _get_text(engine, text_reader, log_id):
+    with logbot.read_session(engine) as session:
+        return text_reader.get_text(session, log_id)
+
+
+def _get_text_page(engine, text_reader, log_id, after, page_size):
+    with logbot.read_session(engine) as session:
+        return text_reader.get_text_page(session, log_id, after, page_size)
+
+
+def _archive_log(engine, archive, log_id):
+    with logbot.session_scope(engine) as session:
+        return archive.archive_log(session, log_id)
+
+
+def _ended_log_ids(engine, active_log_ids):
+    with logbot.read_session(engine) as session:
+        return logarchive.ended_log_ids(session, active_log_ids)
+
+
+def _write_batch(engine, pending_texts, pending_rolls):
+    with logbot.session_scope(engine) as session:
+        logbot.write_batch(session, pending_texts, pending_rolls)
+
+
+def _get_roll_summary(engine, kind, key):
+    with logbot.read_session(engine) as session:
+        return logbot.get_roll_summary(session, kind, key)
+
+
+def _search_text(engine, terms, character_name, log_name, since, until, limit):
+    with logbot.read_session(engine) as session:
+        return logbot.search_text(session, terms, character_name, log_name, since, until, limit)
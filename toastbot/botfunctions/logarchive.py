@@ -0,0 +1,207 @@
+"""
+Archive of ended logs in compressed, append-only segment files.
+
+An archived log is split into chunks of lines. Each chunk is written as a zlib-compressed block
+of JSON lines appended to the current segment file, and an archive_chunk row records the segment,
+offset and length of the block. The log's text rows are deleted in the same transaction that adds
+its chunk rows, so readers see a log either in the database or in the archive, never in both.
+Reads memory-map the segment and decompress only the chunks a page needs.
+
+LogArchive.get_text, get_text_page and iter_text take the same arguments as the logbot functions
+of the same names, and also return any text still in the database for the log, so callers can
+use either interchangeably. All methods block and belong on an executor.
+"""
+import datetime
+import glob
+import json
+import logging
+import mmap
+import os
+import threading
+import zlib
+
+import sqlalchemy
+
+import toastbot.botfunctions.logbot as logbot
+
+DEFAULT_ARCHIVE_DIRECTORY = 'data/archive'
+DEFAULT_MAX_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_CHUNK_LINES = logbot.DEFAULT_TEXT_PAGE_SIZE
+DEFAULT_COMPRESSION_LEVEL = 6
+
+SEGMENT_NAME_FORMAT = 'segment-{:06d}.seg'
+SEGMENT_GLOB = 'segment-*.seg'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def _encode_line(response):
+    timestamp = response.timestamp.strftime(TIMESTAMP_FORMAT) if response.timestamp is not None else None
+    return json.dumps([response.text_id, timestamp, response.name, response.text], ensure_ascii=False)
+
+
+def _decode_line(line):
+    text_id, timestamp, name, text = json.loads(line)
+    if timestamp is not None:
+        timestamp = datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+    return logbot.TextResponse(name=name, timestamp=timestamp, text=text, text_id=text_id)
+
+
+def _chunked(iterable, size):
+    chunk = list()
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+
+class LogArchive:
+    """
+    Segment files in one directory, and the reads and writes of archived logs through them.
+    """
+    def __init__(self, directory=DEFAULT_ARCHIVE_DIRECTORY, max_segment_bytes=DEFAULT_MAX_SEGMENT_BYTES,
+                 chunk_lines=DEFAULT_CHUNK_LINES, compression_level=DEFAULT_COMPRESSION_LEVEL):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.chunk_lines = chunk_lines
+        self.compression_level = compression_level
+        os.makedirs(self.directory, exist_ok=True)
+        self._write_lock = threading.Lock()
+        #  Segment name -> read-only memory map of it.
+        self._maps = dict()
+        self._maps_lock = threading.Lock()
+
+    def archive_log(self, session, log_id):
+        """
+        Move a log's text from the database into the archive.
+
+        The chunk rows and the deletion of the text rows are left for the caller to commit. A
+        failure before commit leaves unreferenced bytes in a segment, which are never read.
+
+        :return: Number of lines archived.
+        """
+        chunk_rows = list()
+        line_count = 0
+        with self._write_lock:
+            for lines in _chunked(logbot.iter_text(session, log_id), self.chunk_lines):
+                block = zlib.compress('\n'.join(_encode_line(line) for line in lines).encode('utf-8'),
+                                      self.compression_level)
+                segment, offset = self._append(block)
+                chunk_rows.append(dict(
+                    log_id=log_id,
+                    segment=segment,
+                    offset=offset,
+                    length=len(block),
+                    line_count=len(lines),
+                    last_timestamp=lines[-1].timestamp,
+                    last_text_id=lines[-1].text_id
+                ))
+                line_count += len(lines)
+        if chunk_rows:
+            session.bulk_insert_mappings(logbot.ArchiveChunk, chunk_rows)
+            session.query(logbot.Text).filter(logbot.Text.log_id == log_id).delete(synchronize_session=False)
+            logging.info('Archived {} lines of log {} in {} chunks.'.format(line_count, log_id, len(chunk_rows)))
+        return line_count
+
+    def get_text(self, session, log_id):
+        return list(self.iter_text(session, log_id))
+
+    def iter_text(self, session, log_id, page_size=logbot.DEFAULT_TEXT_PAGE_SIZE):
+        after = None
+        while True:
+            page = self.get_text_page(session, log_id, after, page_size)
+            for response in page:
+                yield response
+            if len(page) < page_size:
+                return
+            after = page[-1].page_key
+
+    def get_last_text_id(self, session, log_id):
+        """
+        :return: ID of the newest text in the log, or None if it has none. Archived chunks count by
+            the last line of each; they never change, so this still changes only when the log does.
+        """
+        archived = session.query(sqlalchemy.func.max(logbot.ArchiveChunk.last_text_id)).filter(
+            logbot.ArchiveChunk.log_id == log_id
+        ).scalar()
+        live = logbot.get_last_text_id(session, log_id)
+        return max((text_id for text_id in (archived, live) if text_id is not None), default=None)
+
+    def get_text_page(self, session, log_id, after=None, page_size=logbot.DEFAULT_TEXT_PAGE_SIZE):
+        """
+        Read one page of a log, from its archived chunks first and then from the database.
+
+        :return: List of TextResponse.
+        """
+        page = list()
+        chunks = session.query(logbot.ArchiveChunk).filter(
+            logbot.ArchiveChunk.log_id == log_id
+        ).order_by(logbot.ArchiveChunk.id).all()
+        for chunk in chunks:
+            if after is not None and chunk.last_page_key <= after:
+                continue
+            for response in self.read_chunk(chunk):
+                if after is not None and response.page_key <= after:
+                    continue
+                page.append(response)
+                if len(page) == page_size:
+                    return page
+        if page:
+            after = page[-1].page_key
+        page.extend(logbot.get_text_page(session, log_id, after, page_size - len(page)))
+        return page
+
+    def read_chunk(self, chunk):
+        """
+        :param chunk: logbot.ArchiveChunk.
+        :return: List of TextResponse.
+        """
+        segment_map = self._map(chunk.segment, chunk.offset + chunk.length)
+        block = zlib.decompress(segment_map[chunk.offset:chunk.offset + chunk.length])
+        return [_decode_line(line) for line in block.decode('utf-8').split('\n')]
+
+    def close(self):
+        with self._maps_lock:
+            for segment_map in self._maps.values():
+                segment_map.close()
+            self._maps.clear()
+
+    def _append(self, block):
+        """
+        Append a block to the current segment, starting a new one when it is full.
+
+        :return: (segment name, offset of the block).
+        """
+        segments = sorted(glob.glob(os.path.join(self.directory, SEGMENT_GLOB)))
+        if segments and os.path.getsize(segments[-1]) + len(block) <= self.max_segment_bytes:
+            segment = os.path.basename(segments[-1])
+        else:
+            segment = SEGMENT_NAME_FORMAT.format(len(segments) + 1)
+        with open(os.path.join(self.directory, segment), 'ab') as segment_file:
+            offset = segment_file.tell()
+            segment_file.write(block)
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+        return segment, offset
+
+    def _map(self, segment, min_size):
+        with self._maps_lock:
+            segment_map = self._maps.get(segment)
+            #  Segments only grow; remap one that has grown past the current mapping. A replaced
+            #  map may still be read by another thread, so it is left to close when dropped.
+            if segment_map is None or len(segment_map) < min_size:
+                with open(os.path.join(self.directory, segment), 'rb') as segment_file:
+                    segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[segment] = segment_map
+            return segment_map
+
+
+def ended_log_ids(session, active_log_ids):
+    """
+    :param active_log_ids: IDs of logs still running.
+    :return: IDs of logs with text in the database that are not running.
+    """
+    log_ids = session.query(logbot.Text.log_id).distinct()
+    return sorted(log_id for log_id, in log_ids if log_id is not None and log_id not in active_log_ids)
@@ -2,10 +2,17 @@
 Database support for the bot logging functionality.
 """
 
+import array
+import collections
+import contextlib
 import sqlite3
+import threading
+import time
+import weakref
 import sqlalchemy
 import sqlalchemy.ext.declarative as declarative
 import sqlalchemy.orm as orm
+import sqlalchemy.pool as pool
 import sqlalchemy.util as util
 
 import logging
@@ -14,29 +21,289 @@ import logging
 Base = declarative.declarative_base()
 
 
-class DBSessions:
-    DATABASE_SESSION_MAKER = None
+DEFAULT_CHARACTER_CACHE_SIZE = 1024
 
+DEFAULT_DATABASE_PATH = 'data/logdata.db'
 
-class LogSessionConfigs:
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+#  Named bundles of SQLite tuning settings, selectable with Preset in the [database] config section.
+#  "default" favours durability: every commit is fsynced.
+#  "high-throughput" relaxes to synchronous=NORMAL, which in WAL mode can lose the last few commits
+#  on power loss (never corrupts), and gives SQLite a larger page cache and memory-mapped reads.
+DATABASE_PRESETS = {
+    'default': dict(
+        journal_mode='WAL',
+        synchronous='FULL',
+        cache_size_kib=2000,
+        mmap_size=0,
+        busy_timeout_ms=5000
+    ),
+    'high-throughput': dict(
+        journal_mode='WAL',
+        synchronous='NORMAL',
+        cache_size_kib=65536,
+        mmap_size=268435456,
+        busy_timeout_ms=10000
+    ),
+}
+
+#  Stored in SQLite's user_version pragma; bump alongside a new entry in MIGRATIONS.
+SCHEMA_VERSION = 5
+
+#  Roll values are stored as packed arrays of C ints.
+ROLL_VALUE_TYPECODE = 'i'
+
+ROLL_SUMMARY_USER = 'user'
+ROLL_SUMMARY_LOG = 'log'
+
+DEFAULT_TEXT_PAGE_SIZE = 500
+
+#  FTS5 index over text.text. It is an external-content table: it stores only the index, reads
+#  the lines themselves from the text table, and is kept in step with it by triggers.
+TEXT_SEARCH_TABLE = 'text_search'
+TEXT_SEARCH_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS text_search USING fts5(text, content='text', content_rowid='id')"
+)
+TEXT_SEARCH_TRIGGERS = (
+    "CREATE TRIGGER IF NOT EXISTS text_search_insert AFTER INSERT ON text BEGIN"
+    "    INSERT INTO text_search(rowid, text) VALUES (new.id, new.text);"
+    " END",
+    "CREATE TRIGGER IF NOT EXISTS text_search_delete AFTER DELETE ON text BEGIN"
+    "    INSERT INTO text_search(text_search, rowid, text) VALUES ('delete', old.id, old.text);"
+    " END",
+    "CREATE TRIGGER IF NOT EXISTS text_search_update AFTER UPDATE OF text ON text BEGIN"
+    "    INSERT INTO text_search(text_search, rowid, text) VALUES ('delete', old.id, old.text);"
+    "    INSERT INTO text_search(rowid, text) VALUES (new.id, new.text);"
+    " END",
+)
+DEFAULT_SEARCH_LIMIT = 10
+#  Tokens of context shown around the matched terms in a search result.
+DEFAULT_SNIPPET_TOKENS = 12
+SNIPPET_HIGHLIGHT = '**'
+
+#  Pooled connections kept open; enough for the data-access workers plus a shutdown drain.
+DEFAULT_POOL_SIZE = 4
+DEFAULT_POOL_OVERFLOW = 4
+
+#  Sessions open longer than this are reported as leaked.
+DEFAULT_SESSION_LEAK_SECONDS = 60.0
+
+SESSION_READ = 'read'
+SESSION_WRITE = 'write'
+
+
+class OpenSession:
+    def __init__(self, purpose, opened_at, thread_name):
+        self.purpose = purpose
+        self.opened_at = opened_at
+        self.thread_name = thread_name
+        self.reported = False
+
+    def age(self, now=None):
+        return (now if now is not None else time.monotonic()) - self.opened_at
+
+    def __str__(self):
+        return '{} session opened {:.1f}s ago in thread {}'.format(self.purpose, self.age(), self.thread_name)
+
+
+class OpenSessions:
     """
-    Class to hold characters currently active, and lists of logging sessions that they're attached to.
+    Registry of sessions that have been created and not yet closed, for finding leaks.
+
+    Sessions are held by weak reference; one garbage collected without being closed is dropped
+    from the registry and counted as abandoned.
     """
-    active_logs = dict()
+    def __init__(self):
+        self.abandoned = 0
+        self.reported_abandoned = 0
+        self._sessions = dict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def opened(self, session, purpose):
+        key = id(session)
+
+        def abandoned(reference):
+            with self._lock:
+                entry = self._sessions.get(key)
+                if entry is not None and entry[0] is reference:
+                    del self._sessions[key]
+                    self.abandoned += 1
 
-    @staticmethod
-    def add_user(character_name):
-        LogSessionConfigs.active_logs[character_name] = list()
-        logging.info('{} added to current users.'.format(character_name))
+        record = OpenSession(purpose, time.monotonic(), threading.current_thread().name)
+        with self._lock:
+            self._sessions[key] = (weakref.ref(session, abandoned), record)
 
-    @staticmethod
-    def add_log_to_user(character_name, log_id):
-        LogSessionConfigs.active_logs[character_name].append(log_id)
-        logging.info('{} added to log {}.'.format(character_name, log_id))
+    def closed(self, session):
+        with self._lock:
+            self._sessions.pop(id(session), None)
+
+    def older_than(self, seconds):
+        """
+        :return: List of OpenSession open longer than `seconds`, oldest first.
+        """
+        now = time.monotonic()
+        with self._lock:
+            records = [record for reference, record in self._sessions.values()]
+        return sorted(
+            (record for record in records if record.age(now) > seconds), key=lambda record: record.opened_at
+        )
+
+
+class TrackedSession(orm.Session):
+    """
+    Session that stays in an OpenSessions registry from creation until it is closed.
+    """
+    def __init__(self, open_sessions=None, purpose=SESSION_WRITE, **kwargs):
+        super().__init__(**kwargs)
+        self._open_sessions = open_sessions
+        if open_sessions is not None:
+            open_sessions.opened(self, purpose)
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            if self._open_sessions is not None:
+                self._open_sessions.closed(self)
+
+
+class SessionFactory:
+    """
+    Session makers for one engine: one for units of work, and one tuned for reads.
+
+    Read sessions do not autoflush, and keep loaded objects usable after commit and close.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.open_sessions = OpenSessions()
+        self._write_sessions = orm.sessionmaker(
+            bind=engine, class_=TrackedSession, open_sessions=self.open_sessions, purpose=SESSION_WRITE
+        )
+        self._read_sessions = orm.sessionmaker(
+            bind=engine, class_=TrackedSession, open_sessions=self.open_sessions, purpose=SESSION_READ,
+            autoflush=False, expire_on_commit=False
+        )
+
+    def write_session(self):
+        return self._write_sessions()
+
+    def read_session(self):
+        return self._read_sessions()
+
+
+_SESSION_FACTORIES = weakref.WeakKeyDictionary()
+_SESSION_FACTORIES_LOCK = threading.Lock()
+#  Engine -> DatabaseSettings its new connections are tuned with.
+_ENGINE_SETTINGS = weakref.WeakKeyDictionary()
+
+
+class DatabaseSettings:
+    """
+    Location and SQLite tuning pragmas for the log database.
+    """
+    def __init__(
+            self,
+            path=DEFAULT_DATABASE_PATH,
+            journal_mode=DATABASE_PRESETS['default']['journal_mode'],
+            synchronous=DATABASE_PRESETS['default']['synchronous'],
+            cache_size_kib=DATABASE_PRESETS['default']['cache_size_kib'],
+            mmap_size=DATABASE_PRESETS['default']['mmap_size'],
+            busy_timeout_ms=DATABASE_PRESETS['default']['busy_timeout_ms'],
+            pool_size=DEFAULT_POOL_SIZE
+    ):
+        self.path = path
+        self.journal_mode = journal_mode.upper()
+        self.synchronous = synchronous.upper()
+        self.cache_size_kib = int(cache_size_kib)
+        self.mmap_size = int(mmap_size)
+        self.busy_timeout_ms = int(busy_timeout_ms)
+        self.pool_size = int(pool_size)
+        if self.journal_mode not in JOURNAL_MODES:
+            raise ValueError('Unsupported journal mode: {}. Supported: {}'.format(journal_mode, JOURNAL_MODES))
+        if self.synchronous not in SYNCHRONOUS_LEVELS:
+            raise ValueError('Unsupported synchronous level: {}. Supported: {}'.format(
+                synchronous, SYNCHRONOUS_LEVELS))
+
+    @classmethod
+    def from_preset(cls, preset, **overrides):
+        try:
+            settings = dict(DATABASE_PRESETS[preset])
+        except KeyError:
+            raise ValueError('Unknown database preset: {}. Available: {}'.format(
+                preset, ', '.join(sorted(DATABASE_PRESETS))))
+        settings.update(overrides)
+        return cls(**settings)
+
+    @property
+    def url(self):
+        return 'sqlite+pysqlite:///{}'.format(self.path)
+
+    def pragmas(self):
+        #  Negative cache_size is read by SQLite as KiB rather than pages.
+        return [
+            'PRAGMA journal_mode = {}'.format(self.journal_mode),
+            'PRAGMA synchronous = {}'.format(self.synchronous),
+            'PRAGMA cache_size = -{:d}'.format(self.cache_size_kib),
+            'PRAGMA mmap_size = {:d}'.format(self.mmap_size),
+            'PRAGMA busy_timeout = {:d}'.format(self.busy_timeout_ms),
+        ]
+
+
+class CharacterIdCache:
+    """
+    Least-recently-used map of character name to character id, so text inserts can skip the Character lookup.
+
+    Only ids of committed rows belong in here; a character inserted in a transaction that is
+    later rolled back must not be cached.
+    """
+    def __init__(self, max_size=DEFAULT_CHARACTER_CACHE_SIZE):
+        self.max_size = max_size
+        self._ids = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def get(self, character_name):
+        with self._lock:
+            try:
+                self._ids.move_to_end(character_name)
+            except KeyError:
+                return None
+            return self._ids[character_name]
+
+    def put(self, character_name, character_id):
+        with self._lock:
+            self._ids[character_name] = character_id
+            self._ids.move_to_end(character_name)
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+
+    def update(self, character_ids):
+        for character_name, character_id in character_ids.items():
+            self.put(character_name, character_id)
+
+    def invalidate(self, character_name=None):
+        with self._lock:
+            if character_name is None:
+                self._ids.clear()
+            else:
+                self._ids.pop(character_name, None)
+
+
+CHARACTER_ID_CACHE = CharacterIdCache()
 
 
 class Character(Base):
     __tablename__='character'
+    __table_args__ = (
+        sqlalchemy.Index('ix_character_name', 'name', unique=True),
+    )
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
     name = sqlalchemy.Column(sqlalchemy.String)
     username = sqlalchemy.Column(sqlalchemy.String)
@@ -44,6 +311,11 @@ class Character(Base):
 
 class Text(Base):
     __tablename__='text'
+    __table_args__ = (
+        sqlalchemy.Index('ix_text_log_id_timestamp', 'log_id', 'timestamp'),
+        #  Ids of archived (deleted) text must never be handed out again.
+        {'sqlite_autoincrement': True},
+    )
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
     timestamp = sqlalchemy.Column(sqlalchemy.DateTime)
     user_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('character.id'))
@@ -53,34 +325,213 @@ class Text(Base):
 
 class Log(Base):
     __tablename__='log'
+    __table_args__ = (
+        sqlalchemy.Index('ix_log_name_timestamp', 'name', 'timestamp'),
+    )
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
     name = sqlalchemy.Column(sqlalchemy.String)
     timestamp = sqlalchemy.Column(sqlalchemy.DateTime)
+    #  None while the log is running. Kept here rather than only in a bot's running log index, which
+    #  in sharded mode holds just that shard's logs.
+    ended_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=True)
+
+
+class Roll(Base):
+    __tablename__='roll'
+    __table_args__ = (
+        sqlalchemy.Index('ix_roll_log_id_timestamp', 'log_id', 'timestamp'),
+        sqlalchemy.Index('ix_roll_author_id_timestamp', 'author_id', 'timestamp'),
+    )
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    timestamp = sqlalchemy.Column(sqlalchemy.DateTime)
+    author_id = sqlalchemy.Column(sqlalchemy.String)
+    author_name = sqlalchemy.Column(sqlalchemy.String)
+    log_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('log.id'), nullable=True)
+    command = sqlalchemy.Column(sqlalchemy.String)
+    raw_values = sqlalchemy.Column(sqlalchemy.LargeBinary)
+    modified_values = sqlalchemy.Column(sqlalchemy.LargeBinary)
+    total = sqlalchemy.Column(sqlalchemy.Integer)
+
+
+class ArchiveChunk(Base):
+    """
+    Location of one compressed chunk of an archived log's lines in a segment file.
+    """
+    __tablename__='archive_chunk'
+    __table_args__ = (
+        sqlalchemy.Index('ix_archive_chunk_log_id', 'log_id', 'id'),
+    )
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    log_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('log.id'))
+    segment = sqlalchemy.Column(sqlalchemy.String)
+    offset = sqlalchemy.Column(sqlalchemy.Integer)
+    length = sqlalchemy.Column(sqlalchemy.Integer)
+    line_count = sqlalchemy.Column(sqlalchemy.Integer)
+    last_timestamp = sqlalchemy.Column(sqlalchemy.DateTime)
+    last_text_id = sqlalchemy.Column(sqlalchemy.Integer)
+
+    @property
+    def last_page_key(self):
+        return make_page_key(self.last_timestamp, self.last_text_id)
+
+
+class RollSummary(Base):
+    """
+    Running roll totals per user or per log, updated with every batch of rolls written.
+    """
+    __tablename__='roll_summary'
+    __table_args__ = (
+        sqlalchemy.Index('ix_roll_summary_kind_key', 'kind', 'key', unique=True),
+    )
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+    kind = sqlalchemy.Column(sqlalchemy.String)
+    key = sqlalchemy.Column(sqlalchemy.String)
+    roll_count = sqlalchemy.Column(sqlalchemy.Integer, default=0)
+    dice_count = sqlalchemy.Column(sqlalchemy.Integer, default=0)
+    total_sum = sqlalchemy.Column(sqlalchemy.Integer, default=0)
+    die_sum = sqlalchemy.Column(sqlalchemy.Integer, default=0)
+    critical_count = sqlalchemy.Column(sqlalchemy.Integer, default=0)
+    fumble_count = sqlalchemy.Column(sqlalchemy.Integer, default=0)
+
+    @property
+    def average_total(self):
+        return self.total_sum / self.roll_count if self.roll_count else 0.0
+
+    @property
+    def average_die(self):
+        return self.die_sum / self.dice_count if self.dice_count else 0.0
+
+    @property
+    def critical_rate(self):
+        return self.critical_count / self.dice_count if self.dice_count else 0.0
+
+    @property
+    def fumble_rate(self):
+        return self.fumble_count / self.dice_count if self.dice_count else 0.0
+
+
+def make_page_key(timestamp, text_id):
+    """
+    Position of a line in a log, ordered as lines are read: by timestamp, then by id.
+
+    Lines without a timestamp come first, as SQLite sorts NULL first, and compare without error.
+    """
+    return timestamp is not None, timestamp, text_id
 
 
 class TextResponse:
-    def __init__(self, name, timestamp, text):
+    def __init__(self, name, timestamp, text, text_id=None):
         self.name = name
         self.timestamp = timestamp
         self.text = text
+        self.text_id = text_id
+
+    @property
+    def page_key(self):
+        """
+        Position of this line in a log, for resuming paginated reads after it.
+        """
+        return make_page_key(self.timestamp, self.text_id)
 
     def __str__(self):
         result = '{name}: {timestamp}\n{text}\n'.format(name=self.name, timestamp=self.timestamp, text=self.text)
         return result
 
 
-def initialize_engine():
+class SearchResult:
+    def __init__(self, log_name, name, timestamp, snippet, text_id):
+        self.log_name = log_name
+        self.name = name
+        self.timestamp = timestamp
+        self.snippet = snippet
+        self.text_id = text_id
+
+    def __str__(self):
+        return '[{log_name}] {name}, {timestamp}: {snippet}'.format(
+            log_name=self.log_name, name=self.name, timestamp=self.timestamp, snippet=self.snippet
+        )
+
+
+class SearchUnavailable(Exception):
+    """
+    Raised when searching a database without a full-text index.
+    """
+
+
+def initialize_engine(settings=None):
     """
     Initialize sqlalchemy engine for database access.
+    :param settings: DatabaseSettings; defaults to the "default" preset at the default path.
     :return: sqalchemy SQLite engine.
     """
-    engine = sqlalchemy.create_engine('sqlite+pysqlite:///data/logdata.db', module=sqlite3)
+    if settings is None:
+        settings = DatabaseSettings()
+    #  Pooled connections move between data-access threads, one thread at a time.
+    engine = sqlalchemy.create_engine(
+        settings.url,
+        module=sqlite3,
+        poolclass=pool.QueuePool,
+        pool_size=settings.pool_size,
+        max_overflow=DEFAULT_POOL_OVERFLOW,
+        pool_pre_ping=True,
+        connect_args={'check_same_thread': False}
+    )
+    _install_pragmas(engine, settings)
+    logging.info('Log database at {} using journal mode {}, synchronous {}.'.format(
+        settings.path, settings.journal_mode, settings.synchronous))
     inspector = sqlalchemy.inspect(engine)
     if 'text' not in inspector.get_table_names():
         initialize_database(engine)
+    else:
+        migrate_database(engine)
     return engine
 
 
+def _install_pragmas(engine, settings):
+    _ENGINE_SETTINGS[engine] = settings
+
+    @sqlalchemy.event.listens_for(engine, 'connect')
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in _ENGINE_SETTINGS[engine].pragmas():
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+
+
+def retune_engine(engine, settings):
+    """
+    Switch an engine to new tuning pragmas without a restart.
+
+    Idle pooled connections are closed, so each connection is reopened with the new pragmas;
+    connections in use keep the old ones until they are returned and dropped. The path, pool size
+    and journal mode stay as the engine was created with; changes to them need a restart.
+
+    :param settings: DatabaseSettings with the new tuning.
+    """
+    current = _ENGINE_SETTINGS[engine]
+    for setting_name in ('path', 'pool_size', 'journal_mode'):
+        if getattr(settings, setting_name) != getattr(current, setting_name):
+            logging.warning('Database {} change to {} takes effect after a restart.'.format(
+                setting_name, getattr(settings, setting_name)))
+    retuned = DatabaseSettings(
+        path=current.path,
+        journal_mode=current.journal_mode,
+        synchronous=settings.synchronous,
+        cache_size_kib=settings.cache_size_kib,
+        mmap_size=settings.mmap_size,
+        busy_timeout_ms=settings.busy_timeout_ms,
+        pool_size=current.pool_size
+    )
+    if retuned.pragmas() == current.pragmas():
+        return
+    _ENGINE_SETTINGS[engine] = retuned
+    engine.dispose()
+    logging.info('Log database retuned: synchronous {}, cache {} KiB, mmap {}, busy timeout {}ms.'.format(
+        retuned.synchronous, retuned.cache_size_kib, retuned.mmap_size, retuned.busy_timeout_ms))
+
+
 def initialize_database(engine):
     """
     If necessary, create needed tables for the database. Run this against the engine
@@ -91,14 +542,204 @@ def initialize_database(engine):
     """
 
     Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        _create_text_search(connection)
+        _set_schema_version(connection, SCHEMA_VERSION)
+    return engine
+
+
+def migrate_database(engine):
+    """
+    Upgrade an existing database in place to the current schema version.
+
+    Migrations are idempotent, so a migration interrupted part-way is simply rerun on the next start.
+
+    :param engine: SQLAlchemy engine.
+    :return: The same engine passed into the function.
+    """
+    with engine.begin() as connection:
+        version = _get_schema_version(connection)
+        for target_version, migration in MIGRATIONS:
+            if version < target_version:
+                logging.info('Migrating log database from version {} to {}...'.format(version, target_version))
+                migration(connection)
+                _set_schema_version(connection, target_version)
+                version = target_version
     return engine
 
 
+def _get_schema_version(connection):
+    return connection.execute('PRAGMA user_version').scalar()
+
+
+def _set_schema_version(connection, version):
+    connection.execute('PRAGMA user_version = {:d}'.format(version))
+
+
+def _create_missing_indexes(connection, tables):
+    """
+    :param tables: The tables a migration owns. Others may not exist yet at that schema version.
+    """
+    inspector = sqlalchemy.inspect(connection)
+    for table in tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(connection)
+                logging.info('Created index {}.'.format(index.name))
+
+
+def _migrate_add_indexes(connection):
+    #  Merge duplicate characters onto their oldest row before the name becomes unique.
+    connection.execute(
+        'UPDATE text SET user_id = ('
+        '    SELECT MIN(duplicate.id) FROM character AS original'
+        '    JOIN character AS duplicate ON duplicate.name = original.name'
+        '    WHERE original.id = text.user_id'
+        ') WHERE user_id NOT IN (SELECT MIN(id) FROM character GROUP BY name)'
+    )
+    connection.execute('DELETE FROM character WHERE id NOT IN (SELECT MIN(id) FROM character GROUP BY name)')
+    _create_missing_indexes(connection, [Character.__table__, Text.__table__, Log.__table__])
+
+
+def _migrate_add_roll_history(connection):
+    Base.metadata.create_all(connection, tables=[Roll.__table__, RollSummary.__table__])
+    _create_missing_indexes(connection, [Roll.__table__, RollSummary.__table__])
+
+
+def _create_text_search(connection):
+    """
+    Create the full-text index and its triggers, and index any text already stored.
+
+    :return: False if this SQLite build lacks FTS5, in which case search is unavailable.
+    """
+    try:
+        connection.execute(TEXT_SEARCH_DDL)
+    except sqlalchemy.exc.OperationalError as error:
+        logging.warning('Full-text search disabled; SQLite lacks FTS5: {}'.format(error))
+        return False
+    _create_text_search_triggers(connection)
+    connection.execute("INSERT INTO text_search(text_search) VALUES ('rebuild')")
+    return True
+
+
+def _create_text_search_triggers(connection):
+    for trigger in TEXT_SEARCH_TRIGGERS:
+        connection.execute(trigger)
+
+
+def _migrate_add_text_search(connection):
+    _create_text_search(connection)
+
+
+def _migrate_add_archive(connection):
+    Base.metadata.create_all(connection, tables=[ArchiveChunk.__table__])
+    _rebuild_text_table(connection)
+    _create_missing_indexes(connection, [ArchiveChunk.__table__, Text.__table__])
+
+
+def _rebuild_text_table(connection):
+    #  SQLite can only add AUTOINCREMENT by recreating the table. Row ids are kept, so the
+    #  full-text index stays valid; its triggers go with the old table and are recreated.
+    connection.execute('ALTER TABLE text RENAME TO text_old')
+    for index in Text.__table__.indexes:
+        connection.execute('DROP INDEX IF EXISTS {}'.format(index.name))
+    Text.__table__.create(connection, checkfirst=True)
+    connection.execute(
+        'INSERT INTO text (id, timestamp, user_id, log_id, text)'
+        ' SELECT id, timestamp, user_id, log_id, text FROM text_old'
+    )
+    connection.execute('DROP TABLE text_old')
+    if TEXT_SEARCH_TABLE in sqlalchemy.inspect(connection).get_table_names():
+        _create_text_search_triggers(connection)
+
+
+def _migrate_add_log_end(connection):
+    #  Logs from before the column are taken to be running until shown otherwise; see end_untracked_logs.
+    columns = set(column['name'] for column in sqlalchemy.inspect(connection).get_columns(Log.__tablename__))
+    if 'ended_at' not in columns:
+        connection.execute('ALTER TABLE log ADD COLUMN ended_at DATETIME')
+
+
+MIGRATIONS = [
+    (1, _migrate_add_indexes),
+    (2, _migrate_add_roll_history),
+    (3, _migrate_add_text_search),
+    (4, _migrate_add_archive),
+    (5, _migrate_add_log_end),
+]
+
+
+def session_factory(engine):
+    with _SESSION_FACTORIES_LOCK:
+        factory = _SESSION_FACTORIES.get(engine)
+        if factory is None:
+            factory = _SESSION_FACTORIES[engine] = SessionFactory(engine)
+        return factory
+
+
 def create_session(engine):
-    if not DBSessions.DATABASE_SESSION_MAKER:
-        DBSessions.DATABASE_SESSION_MAKER = orm.sessionmaker(bind=engine)
-    session = DBSessions.DATABASE_SESSION_MAKER()
-    return session
+    """
+    Create a session the caller must close; prefer session_scope or read_session.
+    """
+    return session_factory(engine).write_session()
+
+
+@contextlib.contextmanager
+def session_scope(engine):
+    """
+    Unit of work: a session that is committed if the block succeeds, rolled back if it raises,
+    and closed either way.
+    """
+    session = session_factory(engine).write_session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+@contextlib.contextmanager
+def read_session(engine):
+    """
+    Session for queries only, closed after the block. Objects it loaded remain readable afterwards.
+    """
+    session = session_factory(engine).read_session()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+def open_sessions(engine):
+    """
+    :return: OpenSessions registry of the engine's unclosed sessions.
+    """
+    return session_factory(engine).open_sessions
+
+
+def report_leaked_sessions(engine, threshold=DEFAULT_SESSION_LEAK_SECONDS):
+    """
+    Log a warning for each of the engine's sessions newly found open longer than threshold seconds,
+    and for sessions garbage collected without being closed since the last report.
+
+    :return: List of every OpenSession open longer than threshold seconds.
+    """
+    registry = open_sessions(engine)
+    leaked = registry.older_than(threshold)
+    for record in leaked:
+        if not record.reported:
+            record.reported = True
+            logging.warning('Possible session leak: {}.'.format(record))
+    abandoned = registry.abandoned
+    if abandoned > registry.reported_abandoned:
+        logging.warning('{} sessions were garbage collected without being closed.'.format(
+            abandoned - registry.reported_abandoned))
+        registry.reported_abandoned = abandoned
+    return leaked
 
 
 def add_log(session, name, timestamp):
@@ -109,7 +750,7 @@ def add_log(session, name, timestamp):
 
 
 def get_log_id(session, name, timestamp=None):
-    logging.info("Requested log {}".format(name))
+    logging.debug('Requested log %s', name)
     try:
         if timestamp is not None:
             log_id = session.query(Log).filter_by(name=name, timestamp=timestamp).one().id
@@ -117,38 +758,347 @@ def get_log_id(session, name, timestamp=None):
             log_id = session.query(Log).filter_by(name=name).one().id
     except orm.exc.NoResultFound:
         log_id = None
-    logging.info('Found log {}'.format(log_id))
+    logging.debug('Found log %s', log_id)
     return log_id
 
 
+def end_log(session, log_id, timestamp):
+    session.query(Log).filter(Log.id == log_id, Log.ended_at.is_(None)).update(
+        {Log.ended_at: timestamp}, synchronize_session=False
+    )
+
+
+def end_untracked_logs(session, active_log_ids, timestamp):
+    """
+    Mark every log not among active_log_ids as ended, for a bot that knows of every running log.
+
+    :return: Number of logs marked.
+    """
+    query = session.query(Log).filter(Log.ended_at.is_(None))
+    if active_log_ids:
+        query = query.filter(Log.id.notin_(active_log_ids))
+    return query.update({Log.ended_at: timestamp}, synchronize_session=False)
+
+
+def is_log_ended(session, log_id):
+    ended_at = session.query(Log.ended_at).filter(Log.id == log_id).scalar()
+    return ended_at is not None
+
+
 def add_new_text(session, timestamp, character_name, username, text, log_id):
+    new_characters = dict()
     try:
-        user_id = session.query(Character).filter_by(name=character_name).one().id
-    except orm.exc.NoResultFound:
-        add_new_character(session, character_name, username)
-        user_id = session.query(Character).filter_by(name=character_name).one().id
-    new_text = Text(timestamp=timestamp, user_id=user_id, text=text, log_id=log_id)
-    session.add(new_text)
-    session.commit()
-    logging.info('Text added for log ID {}, character {}'.format(log_id, character_name))
+        user_id = _get_character_id(session, character_name, username, new_characters)
+        new_text = Text(timestamp=timestamp, user_id=user_id, text=text, log_id=log_id)
+        session.add(new_text)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    CHARACTER_ID_CACHE.update(new_characters)
+    logging.debug('Text added for log ID %s, character %s', log_id, character_name)
     return session
 
 
-def add_new_character(session, character_name, username):
-    new_character = Character(name=character_name, username=username)
-    session.add(new_character)
-    session.commit()
-    logging.info('Name added: {} for {}'.format(character_name, username))
+def add_texts(session, pending_texts):
+    """
+    Bulk insert buffered text lines in a single transaction.
+
+    :param session: SQLAlchemy session.
+    :param pending_texts: Iterable of objects with timestamp, character_name, username, text and log_id.
+    :return: The same session passed into the function.
+    """
+    return write_batch(session, pending_texts, [])
+
+
+def write_batch(session, pending_texts, pending_rolls):
+    """
+    Bulk insert buffered text lines and dice rolls, and update roll summaries, in a single transaction.
+
+    :param session: SQLAlchemy session.
+    :param pending_texts: Iterable of objects with timestamp, character_name, username, text and log_id.
+    :param pending_rolls: Iterable of writebuffer.PendingRoll.
+    :return: The same session passed into the function.
+    """
+    try:
+        new_characters = _insert_texts(session, pending_texts)
+        _insert_rolls(session, pending_rolls)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    CHARACTER_ID_CACHE.update(new_characters)
     return session
 
 
+def _insert_texts(session, pending_texts):
+    """
+    :return: Names and ids of characters inserted along the way, to cache once committed.
+    """
+    character_ids = dict()
+    new_characters = dict()
+    rows = list()
+    for pending in pending_texts:
+        if pending.character_name not in character_ids:
+            character_ids[pending.character_name] = _get_character_id(
+                session, pending.character_name, pending.username, new_characters
+            )
+        rows.append(dict(
+            timestamp=pending.timestamp,
+            user_id=character_ids[pending.character_name],
+            text=pending.text,
+            log_id=pending.log_id
+        ))
+    if rows:
+        session.bulk_insert_mappings(Text, rows)
+        logging.info('%d lines added for %d characters', len(rows), len(character_ids))
+    return new_characters
+
+
+def pack_roll_values(values):
+    return array.array(ROLL_VALUE_TYPECODE, values).tobytes()
+
+
+def unpack_roll_values(packed):
+    values = array.array(ROLL_VALUE_TYPECODE)
+    values.frombytes(packed)
+    return values.tolist()
+
+
+def _insert_rolls(session, pending_rolls):
+    rows = list()
+    summaries = dict()
+    for pending in pending_rolls:
+        raw_values = pack_roll_values(pending.raw_values)
+        modified_values = pack_roll_values(pending.modified_values)
+        for log_id in pending.log_ids or (None,):
+            rows.append(dict(
+                timestamp=pending.timestamp,
+                author_id=pending.author_id,
+                author_name=pending.author_name,
+                log_id=log_id,
+                command=pending.command,
+                raw_values=raw_values,
+                modified_values=modified_values,
+                total=pending.total
+            ))
+        #  A roll counts once towards its author, and once towards each log it was made in.
+        summary_keys = [(ROLL_SUMMARY_USER, str(pending.author_id))]
+        summary_keys.extend((ROLL_SUMMARY_LOG, str(log_id)) for log_id in pending.log_ids)
+        for summary_key in summary_keys:
+            summary = summaries.setdefault(summary_key, collections.Counter())
+            summary['roll_count'] += 1
+            summary['dice_count'] += pending.num_dice
+            summary['total_sum'] += pending.total
+            summary['die_sum'] += sum(pending.raw_values)
+            summary['critical_count'] += pending.critical_count
+            summary['fumble_count'] += pending.fumble_count
+    if rows:
+        session.bulk_insert_mappings(Roll, rows)
+    for (kind, key), increments in summaries.items():
+        _increment_roll_summary(session, kind, key, increments)
+    if rows:
+        logging.info('%d rolls added, %d summaries updated', len(rows), len(summaries))
+
+
+def _increment_roll_summary(session, kind, key, increments):
+    table = RollSummary.__table__
+    columns = ('roll_count', 'dice_count', 'total_sum', 'die_sum', 'critical_count', 'fumble_count')
+    result = session.execute(
+        table.update().where(sqlalchemy.and_(table.c.kind == kind, table.c.key == key)).values(
+            **{column: table.c[column] + increments[column] for column in columns}
+        )
+    )
+    if result.rowcount == 0:
+        session.execute(table.insert().values(
+            kind=kind, key=key, **{column: increments[column] for column in columns}
+        ))
+
+
+def get_roll_summary(session, kind, key):
+    """
+    :param kind: ROLL_SUMMARY_USER or ROLL_SUMMARY_LOG.
+    :param key: Author id or log id.
+    :return: RollSummary, or None if nothing has been rolled.
+    """
+    return session.query(RollSummary).filter_by(kind=kind, key=str(key)).one_or_none()
+
+
+def warm_character_cache(session, character_names):
+    """
+    Load ids of already known characters into the cache with a single query.
+
+    :param session: SQLAlchemy session.
+    :param character_names: Names of the characters expected to post.
+    :return: Number of characters cached.
+    """
+    character_names = list(set(character_names))
+    if not character_names:
+        return 0
+    results = session.query(Character.name, Character.id).filter(Character.name.in_(character_names)).all()
+    CHARACTER_ID_CACHE.update(dict(results))
+    logging.info('Cached ids for {} of {} characters.'.format(len(results), len(character_names)))
+    return len(results)
+
+
+def _get_character_id(session, character_name, username, new_characters):
+    """
+    Resolve a character id, inserting the character if needed.
+
+    Ids of characters inserted here are collected in new_characters rather than cached, since
+    they are only valid once the caller's transaction commits.
+    """
+    user_id = CHARACTER_ID_CACHE.get(character_name)
+    if user_id is not None:
+        return user_id
+    try:
+        user_id = session.query(Character).filter_by(name=character_name).one().id
+    except orm.exc.NoResultFound:
+        new_character = Character(name=character_name, username=username)
+        session.add(new_character)
+        session.flush()
+        user_id = new_character.id
+        new_characters[character_name] = user_id
+        logging.info('Name added: {} for {}'.format(character_name, username))
+    else:
+        CHARACTER_ID_CACHE.put(character_name, user_id)
+    return user_id
+
+
 def get_text(session, log_id):
-    raw_results = session.query(Text, Character).filter(Text.log_id == log_id).order_by(Text.timestamp).all()
-    processed_results = [TextResponse(name=result.Character.name,
-                                      text=result.Text.text,
-                                      timestamp=result.Text.timestamp
-                                      )
-                         for result in raw_results
-                         ]
-    logging.info('{} lines found'.format(len(processed_results)))
+    processed_results = list(iter_text(session, log_id))
+    logging.debug('%d lines found', len(processed_results))
     return processed_results
+
+
+def iter_text(session, log_id, page_size=DEFAULT_TEXT_PAGE_SIZE):
+    """
+    Lazily yield every line of a log in order, reading one page at a time.
+
+    :param session: SQLAlchemy session.
+    :param log_id: ID of the log to read.
+    :param page_size: Number of rows to fetch per query.
+    :return: Generator of TextResponse.
+    """
+    after = None
+    while True:
+        page = get_text_page(session, log_id, after, page_size)
+        for response in page:
+            yield response
+        if len(page) < page_size:
+            return
+        after = page[-1].page_key
+
+
+def get_last_text_id(session, log_id):
+    """
+    :return: ID of the newest text in the log, or None if it has none. Text IDs are never reused,
+        so this changes whenever a line is added.
+    """
+    return session.query(sqlalchemy.func.max(Text.id)).filter(Text.log_id == log_id).scalar()
+
+
+def get_text_page(session, log_id, after=None, page_size=DEFAULT_TEXT_PAGE_SIZE):
+    """
+    Read one page of a log, using keyset pagination on (timestamp, id) so every page is an index seek.
+
+    :param session: SQLAlchemy session.
+    :param log_id: ID of the log to read.
+    :param after: page_key of the last line already read, or None to start from the beginning.
+    :param page_size: Maximum number of lines to return.
+    :return: List of TextResponse.
+    """
+    query = session.query(Text.id, Text.timestamp, Text.text, Character.name).join(
+        Character, Text.user_id == Character.id
+    ).filter(Text.log_id == log_id)
+    if after is not None:
+        after_has_timestamp, after_timestamp, after_id = after
+        if after_has_timestamp:
+            query = query.filter(sqlalchemy.or_(
+                Text.timestamp > after_timestamp,
+                sqlalchemy.and_(Text.timestamp == after_timestamp, Text.id > after_id)
+            ))
+        else:
+            query = query.filter(sqlalchemy.or_(Text.timestamp.isnot(None), Text.id > after_id))
+    raw_results = query.order_by(Text.timestamp, Text.id).limit(page_size).all()
+    return [
+        TextResponse(name=result.name, text=result.text, timestamp=result.timestamp, text_id=result.id)
+        for result in raw_results
+    ]
+
+
+def search_match_expression(terms):
+    """
+    Build an FTS5 query matching lines containing every term.
+
+    Terms are quoted, so punctuation in user input is searched for rather than parsed as query
+    syntax; a trailing * on a term still matches it as a prefix.
+    """
+    phrases = list()
+    for term in terms:
+        prefix = term.endswith('*')
+        term = term.rstrip('*')
+        if term:
+            phrases.append('"{}"{}'.format(term.replace('"', '""'), '*' if prefix else ''))
+    return ' '.join(phrases)
+
+
+def search_text(session, terms, character_name=None, log_name=None, since=None, until=None,
+                limit=DEFAULT_SEARCH_LIMIT):
+    """
+    Search logged text through the full-text index, best matches first.
+
+    :param session: SQLAlchemy session.
+    :param terms: Iterable of words, all of which must appear in a line.
+    :param character_name: Only lines by this character.
+    :param log_name: Only lines in logs with this name.
+    :param since: Only lines at or after this datetime.
+    :param until: Only lines before this datetime.
+    :param limit: Maximum number of results.
+    :return: List of SearchResult.
+    """
+    match = search_match_expression(terms)
+    if not match:
+        return []
+    if not session.execute(
+            sqlalchemy.text("SELECT 1 FROM sqlite_master WHERE name = :name"), {'name': TEXT_SEARCH_TABLE}
+    ).scalar():
+        raise SearchUnavailable('Full-text search is not available for this database.')
+
+    conditions = ['text_search MATCH :match']
+    parameters = dict(match=match, limit=limit)
+    bind_types = []
+    if character_name is not None:
+        conditions.append('character.name = :character_name')
+        parameters['character_name'] = character_name
+    if log_name is not None:
+        conditions.append('log.name = :log_name')
+        parameters['log_name'] = log_name
+    if since is not None:
+        conditions.append('text.timestamp >= :since')
+        parameters['since'] = since
+        bind_types.append(sqlalchemy.bindparam('since', type_=sqlalchemy.DateTime))
+    if until is not None:
+        conditions.append('text.timestamp < :until')
+        parameters['until'] = until
+        bind_types.append(sqlalchemy.bindparam('until', type_=sqlalchemy.DateTime))
+
+    query = sqlalchemy.text(
+        "SELECT text.id, text.timestamp, character.name AS character_name, log.name AS log_name,"
+        " snippet(text_search, 0, :highlight, :highlight, '...', :snippet_tokens) AS snippet"
+        " FROM text_search"
+        " JOIN text ON text.id = text_search.rowid"
+        " JOIN character ON character.id = text.user_id"
+        " JOIN log ON log.id = text.log_id"
+        " WHERE " + ' AND '.join(conditions) +
+        " ORDER BY text_search.rank LIMIT :limit"
+    ).bindparams(*bind_types).columns(timestamp=sqlalchemy.DateTime)
+    parameters.update(highlight=SNIPPET_HIGHLIGHT, snippet_tokens=DEFAULT_SNIPPET_TOKENS)
+    rows = session.execute(query, parameters).fetchall()
+    return [
+        SearchResult(
+            log_name=row.log_name, name=row.character_name, timestamp=row.timestamp, snippet=row.snippet,
+            text_id=row.id
+        )
+        for row in rows
+    ]
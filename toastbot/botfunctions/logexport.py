@@ -0,0 +1,526 @@
+"""
+Export of logged sessions back to Discord.
+
+Logs are read a page at a time and either packed into messages no longer than Discord allows,
+or rendered to a file in one of the export formats, so memory use does not depend on how long
+the log is. Rendered files of ended logs are kept in an on-disk cache.
+"""
+import asyncio
+import collections
+import csv
+import glob
+import html
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import toastbot.botfunctions.logbot as logbot
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+DEFAULT_EXPORT_CACHE_DIRECTORY = 'data/exports'
+DEFAULT_EXPORT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_EXPORT_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+#  Cache entries served or written this recently are never evicted.
+EVICTION_GRACE_SECONDS = 60
+
+_UNKNOWN = object()
+
+
+class ExportFormat:
+    """
+    Base export format: one rendered entry per logged line, with optional header and footer.
+    """
+    name = None
+    extension = None
+
+    def header(self, log_name):
+        return None
+
+    def render(self, response):
+        raise NotImplementedError
+
+    def footer(self):
+        return None
+
+
+class PlainTextFormat(ExportFormat):
+    name = 'txt'
+    extension = 'txt'
+
+    def render(self, response):
+        return str(response)
+
+
+class MarkdownFormat(ExportFormat):
+    name = 'md'
+    extension = 'md'
+
+    def header(self, log_name):
+        return '# {}\n'.format(log_name)
+
+    def render(self, response):
+        return '**{name}** _{timestamp}_  \n{text}\n'.format(
+            name=response.name, timestamp=response.timestamp, text=response.text
+        )
+
+
+class HtmlFormat(ExportFormat):
+    name = 'html'
+    extension = 'html'
+
+    def header(self, log_name):
+        return (
+            '<!DOCTYPE html>\n<html>\n<head><meta charset="utf-8"><title>{name}</title></head>\n'
+            '<body>\n<h1>{name}</h1>'.format(name=html.escape(log_name))
+        )
+
+    def render(self, response):
+        return '<p><b>{name}</b> <time>{timestamp}</time><br>\n{text}</p>'.format(
+            name=html.escape(response.name),
+            timestamp=response.timestamp,
+            text=html.escape(response.text).replace('\n', '<br>\n')
+        )
+
+    def footer(self):
+        return '</body>\n</html>'
+
+
+class JsonLinesFormat(ExportFormat):
+    name = 'jsonl'
+    extension = 'jsonl'
+
+    def render(self, response):
+        return json.dumps({
+            'name': response.name,
+            'timestamp': response.timestamp.isoformat() if response.timestamp is not None else None,
+            'text': response.text
+        })
+
+
+class CsvFormat(ExportFormat):
+    name = 'csv'
+    extension = 'csv'
+
+    def header(self, log_name):
+        return self._row(['name', 'timestamp', 'text'])
+
+    def render(self, response):
+        timestamp = response.timestamp.isoformat() if response.timestamp is not None else ''
+        return self._row([response.name, timestamp, response.text])
+
+    @staticmethod
+    def _row(values):
+        row = io.StringIO()
+        csv.writer(row, lineterminator='').writerow(values)
+        return row.getvalue()
+
+
+EXPORT_FORMATS = {
+    export_format.name: export_format
+    for export_format in (PlainTextFormat(), MarkdownFormat(), HtmlFormat(), JsonLinesFormat(), CsvFormat())
+}
+
+
+def get_export_format(format_name):
+    try:
+        return EXPORT_FORMATS[format_name.lower()]
+    except KeyError:
+        raise ValueError('Unknown export format: {}. Available: {}'.format(
+            format_name, ', '.join(sorted(EXPORT_FORMATS))))
+
+
+def render_lines(export_format, log_name, responses):
+    """
+    Lazily render a log in the given format.
+
+    :return: Generator of rendered lines.
+    """
+    header = export_format.header(log_name)
+    if header is not None:
+        yield header
+    for response in responses:
+        yield export_format.render(response)
+    footer = export_format.footer()
+    if footer is not None:
+        yield footer
+
+
+def render_log_file(engine, log_id, log_name, export_format, file_obj, text_reader=logbot):
+    """
+    Render a whole log into an open text file, one page of rows at a time. Blocking.
+
+    :param text_reader: logbot, or a logarchive.LogArchive to also read archived lines through.
+    :return: ID of the newest text in the log as rendered, or None if the log is empty.
+    """
+    with logbot.read_session(engine) as session:
+        #  Read in the same session as the lines, so it names exactly the version rendered.
+        last_text_id = text_reader.get_last_text_id(session, log_id)
+        for line in render_lines(export_format, log_name, text_reader.iter_text(session, log_id)):
+            file_obj.write(line)
+            file_obj.write('\n')
+    return last_text_id
+
+
+class ExportCache:
+    """
+    On-disk cache of rendered exports of ended logs.
+
+    Entries are named <log id>-<last text id>.<extension>, and lookup only serves the entry named
+    for the log's last text id, so an entry can never be served for a log that has grown since it
+    was rendered. The last text id of each log is kept in memory once read or rendered, so a hit
+    does not touch the database; ended logs no longer grow, and invalidate drops the id for a log
+    that does change. Entries are evicted once older than max_age seconds, and least recently
+    served entries go first once the cache exceeds max_bytes. Entries handed out by lookup or
+    render are never evicted until released.
+    All methods but release and invalidate block on the filesystem and belong on an executor.
+    """
+    def __init__(self, directory=DEFAULT_EXPORT_CACHE_DIRECTORY, max_bytes=DEFAULT_EXPORT_CACHE_MAX_BYTES,
+                 max_age=DEFAULT_EXPORT_CACHE_MAX_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        #  Log id -> last text id, as last read or rendered.
+        self._last_text_ids = dict()
+        #  Path -> number of requests still using it.
+        self._in_use = collections.Counter()
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def lookup(self, engine, log_id, export_format, text_reader=logbot):
+        """
+        :param text_reader: logbot, or a logarchive.LogArchive to also read archived lines through.
+            Only read from the first time a log is looked up.
+        :return: Path of the cached export of the log as it stands now, which the caller must
+            release, or None.
+        """
+        last_text_id = self._last_text_ids.get(log_id, _UNKNOWN)
+        if last_text_id is _UNKNOWN:
+            with logbot.read_session(engine) as session:
+                last_text_id = self._last_text_ids[log_id] = text_reader.get_last_text_id(session, log_id)
+        path = self.path_for(log_id, last_text_id, export_format)
+        with self._lock:
+            if not os.path.exists(path):
+                return None
+            self._in_use[path] += 1
+            #  Bump the modification time so eviction treats it as recently used.
+            os.utime(path, None)
+        logging.info('Export cache hit: {}'.format(path))
+        return path
+
+    def release(self, path):
+        """
+        Let a path returned by lookup or render be evicted again.
+        """
+        with self._lock:
+            self._in_use[path] -= 1
+            if self._in_use[path] <= 0:
+                del self._in_use[path]
+
+    def invalidate(self, log_id):
+        """
+        Forget the last text id of a log that has changed, so the next lookup reads it again.
+        """
+        self._last_text_ids.pop(log_id, None)
+
+    def path_for(self, log_id, last_text_id, export_format):
+        return os.path.join(self.directory, '{}-{}.{}'.format(log_id, last_text_id or 0, export_format.extension))
+
+    def render(self, engine, log_id, log_name, export_format, text_reader=logbot):
+        """
+        Render a log and store it in the cache.
+
+        :return: Path of the cached export, which the caller must release.
+        """
+        temp_path, last_text_id = self.render_temporary(engine, log_id, log_name, export_format, text_reader)
+        path = self.path_for(log_id, last_text_id, export_format)
+        with self._lock:
+            os.replace(temp_path, path)
+            self._in_use[path] += 1
+            self._last_text_ids[log_id] = last_text_id
+            for stale_key, stale_path in self._entries_for(log_id, export_format):
+                if stale_path != path and stale_path not in self._in_use:
+                    os.remove(stale_path)
+        logging.info('Export cached: {}'.format(path))
+        self.evict()
+        return path
+
+    def render_temporary(self, engine, log_id, log_name, export_format, text_reader=logbot):
+        """
+        Render a log to an uncached file, for logs that are still being written. The caller removes it.
+
+        :return: Tuple of the file path and the ID of the last text rendered.
+        """
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.' + export_format.extension)
+        try:
+            with open(file_descriptor, 'w', encoding='utf-8', newline='') as file_obj:
+                last_text_id = render_log_file(engine, log_id, log_name, export_format, file_obj, text_reader)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        return temp_path, last_text_id
+
+    def evict(self):
+        """
+        Drop expired entries, then least recently used ones until the cache fits in max_bytes.
+
+        Entries in use are kept, and so are entries touched in the last EVICTION_GRACE_SECONDS,
+        which another process sharing the directory may be about to send.
+
+        :return: Number of entries removed.
+        """
+        now = time.time()
+        entries = list()
+        removed = 0
+        total_bytes = 0
+        with self._lock:
+            for path in glob.glob(os.path.join(self.directory, '*-*.*')):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                total_bytes += stat.st_size
+                if path in self._in_use or now - stat.st_mtime < EVICTION_GRACE_SECONDS:
+                    continue
+                if now - stat.st_mtime > self.max_age:
+                    os.remove(path)
+                    total_bytes -= stat.st_size
+                    removed += 1
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            entries.sort()
+            while entries and total_bytes > self.max_bytes:
+                mtime, size, path = entries.pop(0)
+                os.remove(path)
+                total_bytes -= size
+                removed += 1
+        if removed:
+            logging.info('Evicted {} cached exports.'.format(removed))
+        return removed
+
+    def _entries_for(self, log_id, export_format):
+        pattern = os.path.join(self.directory, '{}-*.{}'.format(log_id, export_format.extension))
+        entries = list()
+        for path in glob.glob(pattern):
+            last_text_id = os.path.basename(path)[len(str(log_id)) + 1:-len(export_format.extension) - 1]
+            entries.append((int(last_text_id) if last_text_id.isdigit() else -1, path))
+        entries.sort()
+        return entries
+
+
+class MessageChunker:
+    """
+    Packs rendered lines into messages of at most `limit` characters.
+
+    Messages with nothing but whitespace in them are dropped, since Discord rejects them.
+    """
+
+    def __init__(self, limit=DISCORD_MESSAGE_LIMIT, separator='\n'):
+        self.limit = limit
+        self.separator = separator
+        self._parts = list()
+        self._length = 0
+
+    def feed(self, lines):
+        """
+        Add lines, yielding every message that fills up along the way.
+
+        :param lines: Iterable of rendered lines.
+        :return: Generator of complete messages.
+        """
+        for line in lines:
+            for piece in self._split_long_line(line):
+                added_length = len(piece) + (len(self.separator) if self._parts else 0)
+                if self._length + added_length > self.limit:
+                    message = self._take()
+                    if message is not None:
+                        yield message
+                    added_length = len(piece)
+                self._parts.append(piece)
+                self._length += added_length
+
+    def close(self):
+        """
+        :return: The final partly-filled message, or None if nothing is left.
+        """
+        return self._take()
+
+    def _take(self):
+        message = self.separator.join(self._parts)
+        self._parts = list()
+        self._length = 0
+        return message if message.strip() else None
+
+    def _split_long_line(self, line):
+        if len(line) <= self.limit:
+            return [line]
+        return [line[start:start + self.limit] for start in range(0, len(line), self.limit)]
+
+
+def chunk_lines(lines, limit=DISCORD_MESSAGE_LIMIT):
+    """
+    Pack an iterable of lines into messages of at most `limit` characters.
+
+    :return: Generator of messages.
+    """
+    chunker = MessageChunker(limit)
+    for message in chunker.feed(lines):
+        yield message
+    remainder = chunker.close()
+    if remainder is not None:
+        yield remainder
+
+
+class SharedRender:
+    """
+    A render of a log in flight or done, shared by every request for it that arrived meanwhile.
+    """
+    def __init__(self, task, temporary):
+        """
+        :param task: asyncio.Task resolving to the rendered file's path.
+        :param temporary: Whether the file is removed once the last request using it is done;
+            otherwise it is a cache entry, released back to the cache.
+        """
+        self.task = task
+        self.temporary = temporary
+        self.users = 0
+        #  Whether the file is let go of once the render finishes, every request having given up.
+        self.abandoned = False
+
+
+class LogExporter:
+    """
+    Sends logs to Discord, serving ended logs from the export cache.
+
+    Identical requests for a log that arrive while it is being rendered wait for that render
+    rather than reading and rendering the log again.
+    """
+    def __init__(self, log_access, export_cache, limit=DISCORD_MESSAGE_LIMIT):
+        self.log_access = log_access
+        self.export_cache = export_cache
+        self.limit = limit
+        self.coalesced = 0
+        #  (log ID, export format name, ended) -> SharedRender still rendering.
+        self._renders = dict()
+
+    @asyncio.coroutine
+    def send_messages(self, log_id, log_name, ended, send):
+        """
+        Send a log as plain text messages.
+
+        :param ended: Whether the log has ended and may be served from the cache.
+        :param send: Coroutine function taking the message text.
+        :return: Number of messages sent.
+        """
+        shared = self._shared_render(log_id, log_name, EXPORT_FORMATS[PlainTextFormat.name], ended)
+        try:
+            path = yield from asyncio.shield(shared.task, loop=self.log_access.loop)
+            messages_sent = 0
+            with open(path, encoding='utf-8', newline='') as file_obj:
+                lines = (line[:-1] if line.endswith('\n') else line for line in file_obj)
+                for message in chunk_lines(lines, self.limit):
+                    yield from send(message)
+                    messages_sent += 1
+        finally:
+            yield from self._release(shared)
+        logging.info('Sent log {} in {} messages.'.format(log_id, messages_sent))
+        return messages_sent
+
+    @asyncio.coroutine
+    def send_file(self, log_id, log_name, export_format, ended, send_file):
+        """
+        Send a log as a rendered file attachment.
+
+        :param send_file: Coroutine function taking the file path and the attachment filename.
+        :return: None
+        """
+        filename = '{}.{}'.format(log_name, export_format.extension)
+        shared = self._shared_render(log_id, log_name, export_format, ended)
+        try:
+            path = yield from asyncio.shield(shared.task, loop=self.log_access.loop)
+            yield from send_file(path, filename)
+        finally:
+            yield from self._release(shared)
+
+    def _shared_render(self, log_id, log_name, export_format, ended):
+        """
+        Join the render of this log already in flight, or start one.
+
+        Ended logs are rendered into the export cache, or found there; running logs are rendered
+        to a temporary file, removed once every request sharing it has released it.
+
+        :return: SharedRender, which the caller must pass to _release when done with the file.
+        """
+        key = (log_id, export_format.name, ended)
+        shared = self._renders.get(key)
+        if shared is not None:
+            self.coalesced += 1
+        else:
+            if ended:
+                render = self._cached_export(log_id, log_name, export_format)
+            else:
+                render = self._temporary_export(log_id, log_name, export_format)
+            shared = SharedRender(asyncio.ensure_future(render, loop=self.log_access.loop), temporary=not ended)
+            self._renders[key] = shared
+            #  Requests after the render has finished start a new one, which sees any newer lines.
+            shared.task.add_done_callback(lambda task: self._renders.pop(key, None))
+        shared.users += 1
+        return shared
+
+    @asyncio.coroutine
+    def _release(self, shared):
+        shared.users -= 1
+        if shared.users > 0:
+            return
+        if not shared.task.done():
+            #  Every request sharing it gave up before it was rendered; let go of the file once it is.
+            if not shared.abandoned:
+                shared.abandoned = True
+                shared.task.add_done_callback(lambda task: self._release_unused(shared))
+            return
+        if shared.task.cancelled() or shared.task.exception() is not None:
+            return
+        if shared.temporary:
+            yield from self.log_access.run('export_remove', os.remove, shared.task.result())
+        else:
+            self.export_cache.release(shared.task.result())
+
+    def _release_unused(self, shared):
+        #  A request may have joined after the others gave up; it then releases the file itself.
+        if shared.users > 0 or shared.task.cancelled() or shared.task.exception() is not None:
+            return
+        if shared.temporary:
+            os.remove(shared.task.result())
+        else:
+            self.export_cache.release(shared.task.result())
+
+    def invalidate(self, log_id):
+        """
+        Stop serving cached exports of a log that has changed, such as one that has just ended.
+        """
+        self.export_cache.invalidate(log_id)
+
+    @asyncio.coroutine
+    def _temporary_export(self, log_id, log_name, export_format):
+        path, last_text_id = yield from self.log_access.run(
+            'export_render', self.export_cache.render_temporary,
+            self.log_access.engine, log_id, log_name, export_format, self.log_access.text_reader
+        )
+        return path
+
+    @asyncio.coroutine
+    def _cached_export(self, log_id, log_name, export_format):
+        path = yield from self.log_access.run(
+            'export_lookup', self.export_cache.lookup,
+            self.log_access.engine, log_id, export_format, self.log_access.text_reader
+        )
+        if path is None:
+            path = yield from self.log_access.run(
+                'export_render', self.export_cache.render,
+                self.log_access.engine, log_id, log_name, export_format, self.log_access.text_reader
+            )
+        return path
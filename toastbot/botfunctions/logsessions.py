@@ -0,0 +1,166 @@
+"""
+Routing of incoming messages to the logs that are currently running.
+"""
+import json
+import logging
+import os
+
+DEFAULT_ACTIVE_LOGS_PATH = 'data/active_logs.json'
+
+_NO_LOGS = frozenset()
+
+
+class ActiveLog:
+    """
+    A running log, bound to the guild and channel it was started in.
+
+    With no character names, every message in the channel is logged; otherwise only messages
+    from the named characters are.
+    """
+    def __init__(self, log_id, name, guild_id, channel_id, character_names):
+        self.log_id = log_id
+        self.name = name
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.character_names = frozenset(character_names)
+
+    @property
+    def channel_wide(self):
+        return not self.character_names
+
+    def route_keys(self):
+        return [(self.guild_id, self.channel_id, name) for name in self.character_names]
+
+    def to_dict(self):
+        return {
+            'log_id': self.log_id,
+            'name': self.name,
+            'guild_id': self.guild_id,
+            'channel_id': self.channel_id,
+            'character_names': sorted(self.character_names)
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**values)
+
+
+class ActiveLogIndex:
+    """
+    Bidirectional index between characters and the logs they are active in.
+
+    Messages from channels without a running log are rejected by checking the channel id against
+    active_channels. Otherwise routes are keyed by (guild id, channel id, character name), so
+    resolving an incoming message is a single dict lookup. Ending a log only touches that log's
+    own characters. The index is saved to disk on every change and reloaded on start, so a
+    restart keeps running logs.
+    """
+    def __init__(self, path=DEFAULT_ACTIVE_LOGS_PATH, owns_guild=None, fallback_path=None):
+        """
+        :param owns_guild: For a shard, a predicate on guild ids selecting the logs it keeps.
+        :param fallback_path: State file to take this index's logs from when `path` does not exist
+            yet, such as the single file written before the bot was sharded.
+        """
+        self.path = path
+        self.owns_guild = owns_guild
+        self.fallback_path = fallback_path
+        #  Channel id -> IDs of the logs running in it.
+        self.active_channels = dict()
+        self._routes = dict()
+        self._channel_wide_routes = dict()
+        self._logs = dict()
+
+    def __len__(self):
+        return len(self._logs)
+
+    def __contains__(self, log_id):
+        return log_id in self._logs
+
+    def log_ids(self):
+        return frozenset(self._logs)
+
+    def logs_for(self, guild_id, channel_id, character_name):
+        """
+        :return: Set of IDs of the logs this character's message belongs to; empty if none.
+        """
+        named_logs = self._routes.get((guild_id, channel_id, character_name), _NO_LOGS)
+        channel_wide_logs = self._channel_wide_routes.get((guild_id, channel_id))
+        if not channel_wide_logs:
+            return named_logs
+        return channel_wide_logs | named_logs if named_logs else channel_wide_logs
+
+    def find(self, guild_id, log_name):
+        """
+        :return: The running log with this name in the guild, or None.
+        """
+        for active_log in self._logs.values():
+            if active_log.guild_id == guild_id and active_log.name == log_name:
+                return active_log
+        return None
+
+    def start_log(self, active_log):
+        self._add(active_log)
+        self.save()
+        logging.info('Log {} active for {} characters.'.format(active_log.log_id, len(active_log.character_names)))
+
+    def end_log(self, log_id):
+        """
+        :return: The ended ActiveLog, or None if the log was not running.
+        """
+        active_log = self._logs.pop(log_id, None)
+        if active_log is None:
+            return None
+        if active_log.channel_wide:
+            self._discard_route(self._channel_wide_routes, (active_log.guild_id, active_log.channel_id), log_id)
+        for key in active_log.route_keys():
+            self._discard_route(self._routes, key, log_id)
+        self._discard_route(self.active_channels, active_log.channel_id, log_id)
+        self.save()
+        logging.info('Log {} no longer active.'.format(log_id))
+        return active_log
+
+    def _add(self, active_log):
+        self._logs[active_log.log_id] = active_log
+        self.active_channels.setdefault(active_log.channel_id, set()).add(active_log.log_id)
+        if active_log.channel_wide:
+            self._channel_wide_routes.setdefault(
+                (active_log.guild_id, active_log.channel_id), set()
+            ).add(active_log.log_id)
+        for key in active_log.route_keys():
+            self._routes.setdefault(key, set()).add(active_log.log_id)
+
+    @staticmethod
+    def _discard_route(routes, key, log_id):
+        log_ids = routes[key]
+        log_ids.discard(log_id)
+        if not log_ids:
+            del routes[key]
+
+    def save(self):
+        temp_path = '{}.tmp'.format(self.path)
+        with open(temp_path, 'w', encoding='utf-8') as state_file:
+            json.dump([active_log.to_dict() for active_log in self._logs.values()], state_file)
+        os.replace(temp_path, self.path)
+
+    def load(self):
+        """
+        Restore logs saved by a previous run.
+
+        :return: Number of logs restored.
+        """
+        path = self.path
+        if not os.path.exists(path) and self.fallback_path is not None:
+            path = self.fallback_path
+        try:
+            with open(path, encoding='utf-8') as state_file:
+                saved_logs = [ActiveLog.from_dict(values) for values in json.load(state_file)]
+        except FileNotFoundError:
+            return 0
+        if self.owns_guild is not None:
+            saved_logs = [active_log for active_log in saved_logs if self.owns_guild(active_log.guild_id)]
+        for active_log in saved_logs:
+            self._add(active_log)
+        if path != self.path:
+            self.save()
+        logging.info('Restored {} active logs.'.format(len(saved_logs)))
+        return len(saved_logs)
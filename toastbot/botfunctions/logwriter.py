@@ -0,0 +1,221 @@
+"""
+A single writer of the log database, serving several shard processes.
+
+Shards send write calls over one shared multiprocessing queue and get each reply back on a queue
+of their own. Reads do not go through the writer: SQLite's WAL journal lets every shard read the
+database directly while the writer commits. With one process writing there is no lock contention
+between shards, and text batches that arrive together from different shards share a transaction.
+"""
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import pickle
+import queue
+import threading
+import time
+
+import toastbot.botfunctions.logaccess as logaccess
+
+#  Requests taken off the queue at once; consecutive text batches among them share a transaction.
+DEFAULT_MAX_COALESCED_REQUESTS = 64
+
+WRITE_BATCH_CALL = 'write_batch'
+
+#  Put on the request queue to stop the writer, or on a shard's reply queue to stop its reader.
+STOP = None
+
+
+class LogWriterClient:
+    """
+    A shard's end of the connection to the writer. Calls may be made from any thread.
+
+    A reader thread waits on the shard's reply queue and completes each call's future.
+    """
+    def __init__(self, shard_id, requests, replies):
+        self.shard_id = shard_id
+        self.requests = requests
+        self.replies = replies
+        self._call_ids = itertools.count()
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(
+            target=self._read_replies, name='log-writer-replies-{}'.format(shard_id), daemon=True
+        )
+        self._reader.start()
+
+    def submit(self, call_name, *args):
+        """
+        :return: concurrent.futures.Future of the call's result.
+        """
+        future = concurrent.futures.Future()
+        with self._lock:
+            call_id = next(self._call_ids)
+            self._pending[call_id] = future
+        self.requests.put((self.shard_id, call_id, call_name, args))
+        return future
+
+    @asyncio.coroutine
+    def call(self, call_name, *args, loop=None):
+        result = yield from asyncio.wrap_future(self.submit(call_name, *args), loop=loop)
+        return result
+
+    def call_sync(self, call_name, *args):
+        return self.submit(call_name, *args).result()
+
+    def close(self):
+        self.replies.put(STOP)
+        self._reader.join()
+
+    def _read_replies(self):
+        while True:
+            reply = self.replies.get()
+            if reply is STOP:
+                return
+            call_id, error, result = reply
+            with self._lock:
+                future = self._pending.pop(call_id)
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+class ShardedLogbot(logaccess.AsyncLogbot):
+    """
+    AsyncLogbot for a shard process: reads run on the local thread pool, writes go to the writer.
+    """
+    def __init__(self, engine, log_writer, **kwargs):
+        """
+        :param log_writer: LogWriterClient connected to the writer process.
+        """
+        super().__init__(engine, **kwargs)
+        self.log_writer = log_writer
+
+    @asyncio.coroutine
+    def remote(self, call_name, *args):
+        """
+        Make a write call in the writer process, recording its round-trip time.
+        """
+        self.pending_calls += 1
+        start = time.perf_counter()
+        try:
+            result = yield from self.log_writer.call(call_name, *args, loop=self.loop)
+        finally:
+            self.pending_calls -= 1
+            self.record_call(call_name, time.perf_counter() - start)
+        return result
+
+    @asyncio.coroutine
+    def start_log(self, name, timestamp, character_names=()):
+        log_id = yield from self.remote('start_log', name, timestamp, tuple(character_names))
+        return log_id
+
+    @asyncio.coroutine
+    def end_log(self, log_id, timestamp):
+        yield from self.remote('end_log', log_id, timestamp)
+
+    @asyncio.coroutine
+    def write_batch(self, pending_texts, pending_rolls):
+        yield from self.remote(WRITE_BATCH_CALL, pending_texts, pending_rolls)
+
+    def write_batch_sync(self, pending_texts, pending_rolls):
+        start = time.perf_counter()
+        try:
+            self.log_writer.call_sync(WRITE_BATCH_CALL, pending_texts, pending_rolls)
+        finally:
+            self.record_call(WRITE_BATCH_CALL, time.perf_counter() - start)
+
+    @asyncio.coroutine
+    def archive_log(self, log_id):
+        line_count = yield from self.remote('archive_log', log_id)
+        return line_count
+
+    def shutdown(self):
+        super().shutdown()
+        self.log_writer.close()
+
+
+class LogWriter:
+    """
+    The writer's end: performs write calls from the request queue, one at a time, and replies.
+    """
+    def __init__(self, engine, replies, archive=None, max_coalesced=DEFAULT_MAX_COALESCED_REQUESTS):
+        """
+        :param replies: Reply queues, indexed by shard id.
+        :param archive: logarchive.LogArchive for archive_log calls.
+        """
+        self.calls = logaccess.write_calls(engine, archive)
+        self.replies = replies
+        self.max_coalesced = max_coalesced
+        self.requests_handled = 0
+        self.transactions = 0
+
+    def serve(self, requests):
+        """
+        Handle requests until STOP is received.
+        """
+        while True:
+            batch = [requests.get()]
+            while batch[-1] is not STOP and len(batch) < self.max_coalesced:
+                try:
+                    batch.append(requests.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is STOP
+            if stopping:
+                batch.pop()
+            self.handle(batch)
+            if stopping:
+                logging.info('Log writer handled {} requests in {} transactions.'.format(
+                    self.requests_handled, self.transactions))
+                return
+
+    def handle(self, requests):
+        """
+        Perform requests in the order received, merging runs of text batches into one transaction.
+        """
+        text_batches = list()
+        for request in requests:
+            if request[2] == WRITE_BATCH_CALL:
+                text_batches.append(request)
+                continue
+            self._write_batches(text_batches)
+            text_batches = list()
+            self._reply(request, *self._call(request[2], request[3]))
+        self._write_batches(text_batches)
+
+    def _write_batches(self, requests):
+        if len(requests) > 1:
+            pending_texts = [pending for request in requests for pending in request[3][0]]
+            pending_rolls = [pending for request in requests for pending in request[3][1]]
+            error, result = self._call(WRITE_BATCH_CALL, (pending_texts, pending_rolls))
+            if error is None:
+                for request in requests:
+                    self._reply(request, None, result)
+                return
+            #  Write them one by one, so only the shards whose batch fails see the error.
+            logging.warning('Merged write of {} batches failed; retrying separately.'.format(len(requests)))
+        for request in requests:
+            self._reply(request, *self._call(WRITE_BATCH_CALL, request[3]))
+
+    def _call(self, call_name, args):
+        """
+        :return: (exception or None, result).
+        """
+        self.transactions += 1
+        try:
+            return None, self.calls[call_name](*args)
+        except Exception as error:
+            logging.exception('Log writer call {} failed.'.format(call_name))
+            return error, None
+
+    def _reply(self, request, error, result):
+        shard_id, call_id, call_name, args = request
+        self.requests_handled += 1
+        if error is not None:
+            try:
+                pickle.dumps(error)
+            except Exception:
+                error = RuntimeError('{}: {!r}'.format(call_name, error))
+        self.replies[shard_id].put((call_id, error, result))
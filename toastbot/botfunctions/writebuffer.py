@@ -0,0 +1,181 @@
+"""
+Write-behind buffer for logged chat text and dice rolls.
+
+Handlers hand lines and rolls to the buffer without touching the database; the buffer
+then writes them out in bulk, one transaction per flush, once either the batch size or
+the batch age threshold is reached.
+"""
+import asyncio
+import collections
+import logging
+
+DEFAULT_MAX_BATCH_SIZE = 200
+DEFAULT_MAX_BATCH_AGE = 2.0
+#  Writes held while the database is failing; more are dropped rather than held in memory.
+DEFAULT_MAX_PENDING = 100000
+DEFAULT_RETRY_BASE_DELAY = 1.0
+DEFAULT_RETRY_MAX_DELAY = 60.0
+
+
+PendingText = collections.namedtuple(
+    'PendingText',
+    ['timestamp', 'character_name', 'username', 'text', 'log_id']
+)
+
+PendingRoll = collections.namedtuple(
+    'PendingRoll',
+    ['timestamp', 'author_id', 'author_name', 'command', 'raw_values', 'modified_values', 'total',
+     'num_dice', 'critical_count', 'fumble_count', 'log_ids']
+)
+
+
+class LogWriteBuffer:
+    """
+    Collects text lines and dice rolls and flushes them to the log database in batches.
+
+    A failed flush keeps its batch and is retried after a delay that doubles with each further
+    failure. While the database stays down, at most max_pending writes are held; later ones are
+    dropped and counted in dropped.
+    """
+
+    def __init__(self, log_access, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_batch_age=DEFAULT_MAX_BATCH_AGE,
+                 loop=None, max_pending=DEFAULT_MAX_PENDING, retry_base_delay=DEFAULT_RETRY_BASE_DELAY,
+                 retry_max_delay=DEFAULT_RETRY_MAX_DELAY):
+        self.log_access = log_access
+        self.max_batch_size = max_batch_size
+        self.max_batch_age = max_batch_age
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.max_pending = max_pending
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.dropped = 0
+        #  Consecutive failed flushes; while non-zero, only the retry timer starts a flush.
+        self._failures = 0
+        #  Whether writes have been dropped since the last successful flush.
+        self._full = False
+        self._pending = list()
+        self._flush_timer = None
+        self._flush_lock = asyncio.Lock(loop=self.loop)
+        logging.info('Log write buffer initialized.')
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add_text(self, timestamp, character_name, username, text, log_id):
+        """
+        Queue a line for writing. Never blocks on the database.
+
+        :return: None
+        """
+        self._add(PendingText(timestamp, character_name, username, text, log_id))
+
+    def add_roll(self, timestamp, author_id, author_name, roll_results, log_ids):
+        """
+        Queue a dice roll for the roll history. Never blocks on the database.
+
+        :param roll_results: DiceResults or ExpressionResults from Dicebot.roll.
+        :param log_ids: IDs of the logs running where the roll was made; may be empty.
+        :return: None
+        """
+        self._add(PendingRoll(
+            timestamp=timestamp,
+            author_id=author_id,
+            author_name=author_name,
+            command=roll_results.command.raw_command,
+            raw_values=roll_results.raw_rolls,
+            modified_values=roll_results.modified_rolls,
+            total=roll_results.total,
+            num_dice=len(roll_results.raw_rolls),
+            critical_count=roll_results.critical_count,
+            fumble_count=roll_results.fumble_count,
+            log_ids=tuple(log_ids)
+        ))
+
+    def _add(self, pending):
+        if len(self._pending) >= self.max_pending:
+            if not self._full:
+                self._full = True
+                logging.warning('Log write buffer full at {} writes; dropping new writes until the database '
+                                'recovers.'.format(len(self._pending)))
+            self.dropped += 1
+            return
+        self._pending.append(pending)
+        if self._failures:
+            return
+        if len(self._pending) >= self.max_batch_size:
+            self._schedule_flush()
+        elif self._flush_timer is None:
+            self._flush_timer = self.loop.call_later(self.max_batch_age, self._schedule_flush)
+
+    @asyncio.coroutine
+    def flush(self):
+        """
+        Write every pending line and roll to the database in a single transaction.
+
+        :return: Number of lines and rolls written.
+        """
+        with (yield from self._flush_lock):
+            self._cancel_timer()
+            batch = self._pending
+            self._pending = list()
+            if not batch:
+                return 0
+            try:
+                yield from self.log_access.write_batch(*self._split(batch))
+            except Exception:
+                #  Put the batch back in front of anything queued meanwhile so ordering is kept.
+                self._pending[:0] = batch
+                self._schedule_retry()
+                raise
+            if self._failures:
+                logging.info('Buffered log writes recovered after {} failed flushes.'.format(self._failures))
+                self._failures = 0
+            self._full = False
+            if self._pending and self._flush_timer is None:
+                #  Writes that queued up while this flush ran are flushed on the usual schedule.
+                self._flush_timer = self.loop.call_later(self.max_batch_age, self._schedule_flush)
+        logging.debug('Flushed %d buffered writes.', len(batch))
+        return len(batch)
+
+    def drain(self):
+        """
+        Synchronously write out anything still pending. Only for use once the event loop has stopped.
+
+        :return: Number of lines and rolls written.
+        """
+        self._cancel_timer()
+        batch = self._pending
+        self._pending = list()
+        if batch:
+            self.log_access.write_batch_sync(*self._split(batch))
+            logging.info('Drained {} buffered writes.'.format(len(batch)))
+        return len(batch)
+
+    @staticmethod
+    def _split(batch):
+        pending_texts = [pending for pending in batch if isinstance(pending, PendingText)]
+        pending_rolls = [pending for pending in batch if isinstance(pending, PendingRoll)]
+        return pending_texts, pending_rolls
+
+    def _schedule_flush(self):
+        self._cancel_timer()
+        asyncio.ensure_future(self._background_flush(), loop=self.loop)
+
+    def _schedule_retry(self):
+        delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** self._failures)
+        self._failures += 1
+        self._cancel_timer()
+        self._flush_timer = self.loop.call_later(delay, self._schedule_flush)
+        logging.warning('Retrying {} buffered writes in {:.1f}s.'.format(len(self._pending), delay))
+
+    @asyncio.coroutine
+    def _background_flush(self):
+        try:
+            yield from self.flush()
+        except Exception:
+            logging.exception('Buffered log flush failed; writes kept for the retry.')
+
+    def _cancel_timer(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
@@ -0,0 +1,13 @@
+"""
+discord.py extensions holding the bot's commands, one cog each.
+
+Each module imports its heavy dependencies itself, so they are only loaded along with the cog.
+"""
+
+STATUS_EXTENSION = 'toastbot.cogs.status'
+DICEROLLER_EXTENSION = 'toastbot.cogs.diceroller'
+LOGBOT_EXTENSION = 'toastbot.cogs.logbot'
+DEFAULT_EXTENSIONS = (STATUS_EXTENSION, DICEROLLER_EXTENSION, LOGBOT_EXTENSION)
+
+#  Cog names, for looking one cog up from another with bot.get_cog.
+LOGBOT_COG = 'LogBot'
@@ -0,0 +1,30 @@
+"""
+Message and settings helpers shared by the cogs.
+"""
+import toastbot.configuration as botconf
+
+
+def monospace_message(str):
+    msg = "`{str}`".format(str=str)
+    return msg
+
+
+def message_scope(message):
+    guild_id = message.server.id if message.server is not None else None
+    return guild_id, message.channel.id
+
+
+def character_name(author):
+    try:
+        return author.nick if author.nick is not None else author.name
+    except AttributeError:
+        return author.name
+
+
+def current_settings(bot):
+    """
+    :return: The bot's current configuration.Settings, from its settings watcher if it has one.
+    """
+    if bot.settings_watcher is not None:
+        return bot.settings_watcher.current
+    return botconf.Settings.from_config(bot.config)
@@ -0,0 +1,199 @@
+"""
+Dice commands: !roll, !seed and !odds.
+"""
+import asyncio
+import logging
+
+import discord.ext.commands as commands
+
+import toastbot.botfunctions.diceroller as diceroller
+import toastbot.cogs as cogs
+from toastbot.cogs import common
+
+DEFAULT_DICE_SECTION = 'dice'
+DEFAULT_ROLL_BACKEND_VALUE_NAME = 'RollBackend'
+DEFAULT_RNG_SCOPE_VALUE_NAME = 'RngScope'
+RNG_SCOPE_GUILD = 'guild'
+RNG_SCOPE_USER = 'user'
+DEFAULT_RNG_SCOPE = RNG_SCOPE_USER
+
+HELP_ROLL = ("- Roll dice: !roll <i>d<j>[+-][k] - type !help roll for more details.\n"
+             "i = # of dice\n"
+             "j = # of sides per die\n"
+             "k = # to add or subtract from each die\n"
+             "Elements in square brackets are optional.\n"
+             "Ex. !roll 2d10+5, or !roll 1d20\n"
+             "Expressions add up several groups: !roll 4d6kh3 + 2d8 - 1\n"
+             "After a group: kh<n>/kl<n> keep highest/lowest n, dh<n>/dl<n> drop highest/lowest n,\n"
+             "! explodes on the highest face, r<n> rerolls dice showing n or less once."
+             )
+
+HELP_SEED = ("- Seed dice: !seed <value>\n"
+             "Makes the following rolls reproducible. Only your own rolls are affected,\n"
+             "or everyone's in this server if the bot is configured with guild-wide dice."
+             )
+
+HELP_ODDS = ("- Exact odds for a roll: !odds <roll>\n"
+             "Takes anything !roll does except exploding dice, and reports the mean,\n"
+             "variance and percentiles of the total.\n"
+             "Ex. !odds 4d6kh3, or !odds 1d20+5"
+             )
+
+
+def _create_roll_response(roll_results, author_name):
+    if isinstance(roll_results, diceroller.DiceResults) and len(roll_results.raw_rolls) > 10:
+        msg_template = _create_long_roll_response(roll_results, author_name)
+    else:
+        msg_template = _create_simple_roll_response(roll_results, author_name)
+    return msg_template
+
+
+def _create_simple_roll_response(roll_results, author_name):
+    msg_template = "\nAuthor: {author}\n" \
+                   "{roll_results}".format(author=author_name, roll_results=str(roll_results))
+    return msg_template
+
+
+def _create_long_roll_response(roll_results, author_name):
+    histogram = roll_results.histogram()
+
+    values = [len(str(x)) for row in histogram for x in row]
+    pad_len = max(values)
+
+    results_table = [
+        '{mod_val} ({raw_val}): {count}'.format(
+            mod_val=str(mod).ljust(pad_len, ' '),
+            raw_val=str(raw).ljust(pad_len, ' '),
+            count=str(count).ljust(pad_len, ' ')
+        )
+        for mod, raw, count
+        in histogram
+        ]
+
+    formatted_colnames = "Value (Unmodified): Count"
+    msg_base = [
+        "\nAuthor: {author}".format(author=author_name),
+        formatted_colnames
+    ]
+    result_msg = '\n'.join(msg_base + results_table)
+    return result_msg
+
+
+def _create_odds_response(distribution, raw_command, author_name):
+    summary = distribution.summary()
+    pad_len = max(len(name) for name, value in summary)
+
+    results_table = [
+        '{name}: {value}'.format(name=name.ljust(pad_len, ' '), value=value)
+        for name, value
+        in summary
+        ]
+
+    msg_base = [
+        "\nAuthor: {author}".format(author=author_name),
+        "Odds: {command}".format(command=raw_command),
+    ]
+    result_msg = '\n'.join(msg_base + results_table)
+    return result_msg
+
+
+def roll_backend_from_config(config):
+    backend_name = diceroller.DEFAULT_ROLL_BACKEND
+    if config.has_section(DEFAULT_DICE_SECTION):
+        backend_name = config[DEFAULT_DICE_SECTION].get(DEFAULT_ROLL_BACKEND_VALUE_NAME, backend_name)
+    roll_backend = diceroller.create_roll_backend(backend_name)
+    logging.info('Dice roll backend: {}'.format(roll_backend.name))
+    return roll_backend
+
+
+def rng_scope_from_config(config):
+    rng_scope = DEFAULT_RNG_SCOPE
+    if config.has_section(DEFAULT_DICE_SECTION):
+        rng_scope = config[DEFAULT_DICE_SECTION].get(DEFAULT_RNG_SCOPE_VALUE_NAME, rng_scope).lower()
+    if rng_scope not in (RNG_SCOPE_GUILD, RNG_SCOPE_USER):
+        raise ValueError('Unsupported RngScope: {}. Use {} or {}.'.format(rng_scope, RNG_SCOPE_GUILD, RNG_SCOPE_USER))
+    logging.info('Dice random streams scoped per {}.'.format(rng_scope))
+    return rng_scope
+
+
+def _rng_stream_key(message, rng_scope):
+    guild_id = message.server.id if message.server is not None else None
+    if rng_scope == RNG_SCOPE_GUILD and guild_id is not None:
+        return guild_id
+    return guild_id, message.author.id
+
+
+class DiceRoller:
+    def __init__(self, bot, dice, rng_scope):
+        self.bot = bot
+        self.dice = dice
+        self.rng_scope = rng_scope
+        if bot.settings_watcher is not None:
+            bot.settings_watcher.subscribe(self._settings_reloaded)
+
+    def _settings_reloaded(self, old, new):
+        if new.dice_limits != old.dice_limits:
+            self.dice.command_parser.reconfigure(new.command_parser_config())
+            logging.info('Dice limits now {} dice, {} sides, modifier {}.'.format(*new.dice_limits))
+
+    @commands.command(pass_context=True, help=HELP_ROLL)
+    @asyncio.coroutine
+    def roll(self, context):
+        author = context.message.author
+        logging.debug('Bot received roll command from %s.', author)
+        try:
+            results = self.dice.roll(context.message.content, _rng_stream_key(context.message, self.rng_scope))
+            msg_text = _create_roll_response(results, author.display_name)
+            log_cog = self.bot.get_cog(cogs.LOGBOT_COG)
+            if log_cog is not None:
+                log_cog.record_roll(context.message, results)
+        except diceroller.DiceRollFormatError:
+            msg_text = "Valid dice roll command not found. Command: {}\nType !help roll for dice-rolling help.".format(
+                context.message.content
+            )
+        except diceroller.DiceRollError as error:
+            msg_text = str(error)
+        msg_text = common.monospace_message(msg_text)
+        logging.debug('Bot responded to roll command.')
+        yield from self.bot.say(content=msg_text)
+
+    @commands.command(pass_context=True, help=HELP_SEED)
+    @asyncio.coroutine
+    def seed(self, context):
+        try:
+            seed_value = context.message.content.split(' ', 1)[1].strip()
+        except IndexError:
+            yield from self.bot.say('Please specify a seed value.')
+        else:
+            msg_text = self.dice.set_seed(seed_value, _rng_stream_key(context.message, self.rng_scope))
+            yield from self.bot.say(content=common.monospace_message(msg_text))
+
+    @commands.command(pass_context=True, help=HELP_ODDS)
+    @asyncio.coroutine
+    def odds(self, context):
+        author = context.message.author
+        logging.info('Bot received odds command from {}.'.format(author))
+        try:
+            #  Large distributions take a moment to build; keep them off the event loop.
+            distribution = yield from self.bot.loop.run_in_executor(None, self.dice.odds, context.message.content)
+            msg_text = _create_odds_response(distribution, context.message.content, author.display_name)
+        except diceroller.DiceRollFormatError:
+            msg_text = "Valid dice roll command not found. Command: {}\nType !help odds for help.".format(
+                context.message.content
+            )
+        except diceroller.DiceRollError as error:
+            msg_text = str(error)
+        msg_text = common.monospace_message(msg_text)
+        logging.info('Bot responded to odds command.')
+        yield from self.bot.say(content=msg_text)
+
+    def __unload(self):
+        if self.bot.settings_watcher is not None:
+            self.bot.settings_watcher.unsubscribe(self._settings_reloaded)
+
+
+def setup(bot):
+    logging.info('Initializing Dicebot...')
+    command_parser = diceroller.CommandParser(common.current_settings(bot).command_parser_config())
+    dice = diceroller.Dicebot(command_parser=command_parser, roll_backend=roll_backend_from_config(bot.config))
+    bot.add_cog(DiceRoller(bot, dice, rng_scope_from_config(bot.config)))
@@ -0,0 +1,517 @@
+"""
+Log commands (!startlog, !endlog, !getlog, !searchlog, !rollstats) and the listener that records chat.
+
+SQLAlchemy and the export formats are imported with this extension, so a bot without it never
+loads them.
+"""
+import asyncio
+import datetime
+import functools
+import logging
+import time
+
+import discord
+import discord.ext.commands as commands
+
+import toastbot.defaultlogger as defaultlogger
+import toastbot.botfunctions.logarchive as logarchive
+import toastbot.botfunctions.logbot as logbot
+import toastbot.botfunctions.logaccess as logaccess
+import toastbot.botfunctions.logexport as logexport
+import toastbot.botfunctions.logsessions as logsessions
+import toastbot.botfunctions.logwriter as logwriter
+import toastbot.botfunctions.writebuffer as writebuffer
+import toastbot.configuration as botconf
+import toastbot.sharding as sharding
+from toastbot.cogs import common
+
+DEFAULT_DATABASE_SECTION = botconf.DEFAULT_DATABASE_SECTION
+DEFAULT_SESSION_LEAK_VALUE_NAME = 'SessionLeakSeconds'
+
+DEFAULT_LOGS_SECTION = 'logs'
+DEFAULT_ACTIVE_LOGS_PATH_VALUE_NAME = 'ActiveLogsPath'
+DEFAULT_EXPORT_DIRECTORY_VALUE_NAME = 'ExportDirectory'
+
+DEFAULT_ARCHIVE_SECTION = 'archive'
+DEFAULT_ARCHIVE_ENABLED_VALUE_NAME = 'ArchiveEndedLogs'
+DEFAULT_ARCHIVE_DIRECTORY_VALUE_NAME = 'Directory'
+DEFAULT_ARCHIVE_SEGMENT_SIZE_VALUE_NAME = 'MaxSegmentBytes'
+
+#  Most messages per logged channel fetched from history after a reconnect.
+DEFAULT_BACKFILL_LIMIT = 500
+
+HELP_STARTLOG = (
+    "- Start logging: !startlog <log name>[-<Name 1>-<Name 2>-...-<Name N>]\n"
+    "Start logging this channel by naming the log. Add the displayed names of players\n"
+    "to log only their messages; with no names, everyone in the channel is logged.\n"
+    "The log name will be used to end the log at the end of the event."
+)
+
+HELP_ENDLOG = (
+    "- End logging: !endlog <log name>-<Name 1>-<Name 2>-...-<Name N>\n"
+    "End the log with this command."
+)
+
+HELP_GETLOG = (
+    "- Get log: !getlog <log name> [format]\n"
+    "Sends the log to you as messages, or as a file if a format is given.\n"
+    "Formats: {}".format(', '.join(sorted(logexport.EXPORT_FORMATS)))
+)
+
+HELP_SEARCHLOG = (
+    "- Search logs: !searchlog <words> [by:<name>] [log:<log name>] [from:YYYY-MM-DD] [to:YYYY-MM-DD]\n"
+    "Finds logged lines containing all the words, best matches first. End a word with * to match\n"
+    "anything starting with it. The filters limit results to a character, a log, or a range of days.\n"
+    "Logs that have been moved to the archive are not searched."
+)
+
+SEARCH_FILTER_CHARACTER = 'by'
+SEARCH_FILTER_LOG = 'log'
+SEARCH_FILTER_FROM = 'from'
+SEARCH_FILTER_TO = 'to'
+SEARCH_DATE_FORMAT = '%Y-%m-%d'
+
+HELP_ROLLSTATS = ("- Roll stats: !rollstats [log name]\n"
+                  "Your roll count, averages and critical/fumble rates across all your rolls,\n"
+                  "or for every roll made during the named log."
+                  )
+
+
+def _create_rollstats_response(summary, subject):
+    stats = [
+        ('Rolls', str(summary.roll_count)),
+        ('Dice rolled', str(summary.dice_count)),
+        ('Average total', '{:.2f}'.format(summary.average_total)),
+        ('Average die', '{:.2f}'.format(summary.average_die)),
+        ('Criticals', '{} ({:.2%})'.format(summary.critical_count, summary.critical_rate)),
+        ('Fumbles', '{} ({:.2%})'.format(summary.fumble_count, summary.fumble_rate)),
+    ]
+    pad_len = max(len(name) for name, value in stats)
+
+    results_table = [
+        '{name}: {value}'.format(name=name.ljust(pad_len, ' '), value=value)
+        for name, value
+        in stats
+        ]
+
+    msg_base = [
+        "\nRoll stats: {subject}".format(subject=subject),
+    ]
+    result_msg = '\n'.join(msg_base + results_table)
+    return result_msg
+
+
+def parse_search_command(arguments):
+    """
+    Split !searchlog arguments into search words and filters.
+
+    :param arguments: Words following the command.
+    :return: (words, dict of logbot.search_text keyword arguments).
+    :raises ValueError: If a date filter is not a YYYY-MM-DD date.
+    """
+    words = list()
+    filters = dict()
+    for argument in arguments:
+        name, separator, value = argument.partition(':')
+        if not separator or not value:
+            words.append(argument)
+        elif name == SEARCH_FILTER_CHARACTER:
+            filters['character_name'] = value
+        elif name == SEARCH_FILTER_LOG:
+            filters['log_name'] = value
+        elif name in (SEARCH_FILTER_FROM, SEARCH_FILTER_TO):
+            try:
+                day = datetime.datetime.strptime(value, SEARCH_DATE_FORMAT)
+            except ValueError:
+                raise ValueError('Dates must be written as YYYY-MM-DD, not {}.'.format(value))
+            if name == SEARCH_FILTER_FROM:
+                filters['since'] = day
+            else:
+                #  The to: day is included.
+                filters['until'] = day + datetime.timedelta(days=1)
+        else:
+            words.append(argument)
+    return words, filters
+
+
+def _create_search_response(results, words):
+    msg_base = [
+        "Results for {}:".format(' '.join(words)),
+    ]
+    return '\n'.join(msg_base + [str(result) for result in results])
+
+
+def session_leak_threshold_from_config(config):
+    if not config.has_section(DEFAULT_DATABASE_SECTION):
+        return logbot.DEFAULT_SESSION_LEAK_SECONDS
+    return config[DEFAULT_DATABASE_SECTION].getfloat(
+        DEFAULT_SESSION_LEAK_VALUE_NAME, logbot.DEFAULT_SESSION_LEAK_SECONDS
+    )
+
+
+def archive_from_config(config):
+    """
+    :return: (logarchive.LogArchive, whether ended logs are moved into it).
+    """
+    directory = logarchive.DEFAULT_ARCHIVE_DIRECTORY
+    max_segment_bytes = logarchive.DEFAULT_MAX_SEGMENT_BYTES
+    enabled = False
+    if config.has_section(DEFAULT_ARCHIVE_SECTION):
+        archive_config = config[DEFAULT_ARCHIVE_SECTION]
+        directory = archive_config.get(DEFAULT_ARCHIVE_DIRECTORY_VALUE_NAME, directory)
+        max_segment_bytes = archive_config.getint(DEFAULT_ARCHIVE_SEGMENT_SIZE_VALUE_NAME, max_segment_bytes)
+        enabled = archive_config.getboolean(DEFAULT_ARCHIVE_ENABLED_VALUE_NAME, enabled)
+    logging.info('Log archive at {}; ended logs {}archived.'.format(directory, '' if enabled else 'not '))
+    return logarchive.LogArchive(directory, max_segment_bytes), enabled
+
+
+def log_paths_from_config(config):
+    """
+    :return: (active logs state file, export cache directory).
+    """
+    active_logs_path = logsessions.DEFAULT_ACTIVE_LOGS_PATH
+    export_directory = logexport.DEFAULT_EXPORT_CACHE_DIRECTORY
+    if config.has_section(DEFAULT_LOGS_SECTION):
+        logs_config = config[DEFAULT_LOGS_SECTION]
+        active_logs_path = logs_config.get(DEFAULT_ACTIVE_LOGS_PATH_VALUE_NAME, active_logs_path)
+        export_directory = logs_config.get(DEFAULT_EXPORT_DIRECTORY_VALUE_NAME, export_directory)
+    return active_logs_path, export_directory
+
+
+class LogBot:
+    def __init__(self, bot, log_access, text_buffer, log_exporter, log_index, archive_ended_logs=False):
+        """
+        :param archive_ended_logs: Move logs into log_access's archive once they end, and on load
+            archive any ended logs still in the database.
+        """
+        self.bot = bot
+        self.log_access = log_access
+        self.text_buffer = text_buffer
+        self.log_exporter = log_exporter
+        self.log_index = log_index
+        self._log_heard_message = defaultlogger.SampledLog(logging.DEBUG, 'Heard message from %s.')
+        #  Channel id -> id of the newest message logged there, where a backfill resumes from.
+        self._last_message_ids = {}
+        #  Ids of messages heard live while a backfill runs, so the backfill skips them.
+        self._heard_during_backfill = None
+        self._session_watch = asyncio.ensure_future(
+            log_access.watch_sessions(log_access.session_leak_threshold), loop=bot.loop
+        )
+        self.archive_ended_logs = archive_ended_logs
+        self._archiving = None
+        #  A shard cannot tell which other shards' logs are still running, so only unsharded bots
+        #  sweep up ended logs on load.
+        self._ending_untracked = None
+        if bot.log_writer_queues is None:
+            self._ending_untracked = asyncio.ensure_future(self._end_untracked_logs(), loop=bot.loop)
+        if archive_ended_logs and bot.log_writer_queues is None:
+            self._archiving = asyncio.ensure_future(self._archive_ended_logs(), loop=bot.loop)
+        if bot.settings_watcher is not None:
+            bot.settings_watcher.subscribe(self._settings_reloaded)
+
+    def _settings_reloaded(self, old, new):
+        if new.database_tuning != old.database_tuning:
+            logbot.retune_engine(self.log_access.engine, new.database_settings)
+
+    def record_roll(self, message, roll_results):
+        """
+        Queue a roll for the roll history, tagged with the logs running where it was made.
+        """
+        author = message.author
+        if message.channel.id in self.log_index.active_channels:
+            guild_id, channel_id = common.message_scope(message)
+            log_ids = self.log_index.logs_for(guild_id, channel_id, common.character_name(author))
+        else:
+            log_ids = ()
+        self.text_buffer.add_roll(message.timestamp, author.id, author.display_name, roll_results, log_ids)
+
+    @asyncio.coroutine
+    def on_message(self, message):
+        if message.channel.id not in self.log_index.active_channels:
+            return
+        if self._heard_during_backfill is not None:
+            self._heard_during_backfill.add(message.id)
+        self._log_message(message)
+
+    @asyncio.coroutine
+    def on_reconnect(self, downtime):
+        """
+        Log what was said in logged channels while the bot was disconnected.
+        """
+        self._heard_during_backfill = set()
+        try:
+            for channel_id in list(self.log_index.active_channels):
+                yield from self._backfill_channel(channel_id)
+        finally:
+            self._heard_during_backfill = None
+
+    @asyncio.coroutine
+    def _backfill_channel(self, channel_id):
+        last_message_id = self._last_message_ids.get(channel_id)
+        channel = self.bot.get_channel(channel_id)
+        if last_message_id is None or channel is None:
+            return
+        history = self.bot.logs_from(
+            channel, limit=DEFAULT_BACKFILL_LIMIT, after=discord.Object(id=last_message_id), reverse=True
+        )
+        recovered = 0
+        while True:
+            #  LogsFromIterator.iterate raises QueueEmpty once the history is exhausted.
+            try:
+                message = yield from history.iterate()
+            except asyncio.QueueEmpty:
+                break
+            if message.id in self._heard_during_backfill:
+                continue
+            self._log_message(message)
+            recovered += 1
+        if recovered:
+            logging.info('Recovered {} messages in channel {} after reconnecting.'.format(recovered, channel_id))
+
+    def _log_message(self, message):
+        start = time.perf_counter()
+        channel_id = message.channel.id
+        last_message_id = self._last_message_ids.get(channel_id)
+        #  Snowflakes only grow, and a backfill may finish after newer live messages were logged.
+        if last_message_id is None or int(message.id) > int(last_message_id):
+            self._last_message_ids[channel_id] = message.id
+        author_name = common.character_name(message.author)
+        self._log_heard_message(author_name)
+        guild_id, channel_id = common.message_scope(message)
+        for log_id in self.log_index.logs_for(guild_id, channel_id, author_name):
+            self.text_buffer.add_text(
+                timestamp=message.timestamp,
+                character_name=author_name,
+                username=message.author.name,
+                text=message.content,
+                log_id=log_id
+            )
+        self.bot.metrics.observe_listener('log_text', time.perf_counter() - start)
+
+    @commands.command(pass_context=True, help=HELP_STARTLOG)
+    @asyncio.coroutine
+    def startlog(self, context):
+        logging.info('Initializing log...')
+        command = context.message.content
+        split_command = command.split(' ')
+        try:
+            command_contents = split_command[1]
+            command_params = command_contents.split('-')
+            command_log_name = command_params[0]
+            command_characters = command_params[1:]
+        except IndexError:
+            error_msg = 'Error: Not all parameters specified for log start. Use !help startlog for more info.'
+            yield from self.bot.say(content=error_msg)
+        else:
+            log_initialized_timestamp = context.message.timestamp
+
+            initialized_info_string = 'Started log {} at {}\nCharacters: {}.'.format(
+                command_log_name, log_initialized_timestamp,
+                '; '.join(command_characters) if command_characters else 'everyone in this channel')
+            logging.info(initialized_info_string)
+            log_id = yield from self.log_access.start_log(
+                command_log_name, log_initialized_timestamp, command_characters
+            )
+            guild_id, channel_id = common.message_scope(context.message)
+            self.log_index.start_log(logsessions.ActiveLog(
+                log_id, command_log_name, guild_id, channel_id, command_characters
+            ))
+            yield from self.bot.say(content=initialized_info_string)
+
+    @commands.command(pass_context=True, help=HELP_ENDLOG)
+    @asyncio.coroutine
+    def endlog(self, context):
+        try:
+            log_name = context.message.content.split(' ')[1]
+        except IndexError:
+            yield from self.bot.say('Please specify name of log to end.')
+        else:
+            guild_id, channel_id = common.message_scope(context.message)
+            active_log = self.log_index.find(guild_id, log_name)
+            if active_log is None:
+                yield from self.bot.say('No running log named {}.'.format(log_name))
+                return
+            self.log_index.end_log(active_log.log_id)
+            yield from self.text_buffer.flush()
+            yield from self.log_access.end_log(active_log.log_id, context.message.timestamp)
+            self.log_exporter.invalidate(active_log.log_id)
+            ended_info_string = 'Ended log {name}.'.format(name=log_name)
+            logging.info(ended_info_string)
+            yield from self.bot.say(ended_info_string)
+            if self.archive_ended_logs:
+                self._archiving = asyncio.ensure_future(
+                    self._archive_after(self._archiving, active_log.log_id), loop=self.bot.loop
+                )
+
+    @asyncio.coroutine
+    def _archive_after(self, previous, log_id):
+        """
+        Archive a log in the background once the archiving before it has finished.
+        """
+        if previous is not None:
+            yield from asyncio.wait([previous], loop=self.bot.loop)
+        try:
+            yield from self.log_access.archive_log(log_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception('Could not archive log {}.'.format(log_id))
+
+    @commands.command(pass_context=True, help=HELP_GETLOG)
+    @asyncio.coroutine
+    def getlog(self, context):
+        requestor = context.message.author
+        split_command = context.message.content.split(' ')
+        try:
+            log_name = split_command[1]
+            export_format = logexport.get_export_format(split_command[2]) if len(split_command) > 2 else None
+        except IndexError:
+            yield from self.bot.say('Please specify log to receive.')
+        except ValueError as error:
+            yield from self.bot.say(str(error))
+        else:
+            yield from self.text_buffer.flush()
+            log_id = yield from self.log_access.get_log_id(log_name)
+            if log_id is None:
+                yield from self.bot.say('Log {} not found.'.format(log_name))
+                return
+            #  Not self.log_index: a shard only knows of the logs running in its own guilds.
+            ended = yield from self.log_access.is_log_ended(log_id)
+            if export_format is None:
+                messages_sent = yield from self.log_exporter.send_messages(
+                    log_id, log_name, ended, functools.partial(self.bot.send_message, requestor)
+                )
+                if messages_sent == 0:
+                    yield from self.bot.send_message(requestor, 'Log {} is empty.'.format(log_name))
+            else:
+                yield from self.log_exporter.send_file(
+                    log_id, log_name, export_format, ended,
+                    lambda path, filename: self.bot.send_file(requestor, path, filename=filename)
+                )
+
+    @commands.command(pass_context=True, help=HELP_SEARCHLOG)
+    @asyncio.coroutine
+    def searchlog(self, context):
+        try:
+            words, filters = parse_search_command(context.message.content.split()[1:])
+        except ValueError as error:
+            yield from self.bot.say(str(error))
+            return
+        if not words:
+            yield from self.bot.say('Please specify words to search for.')
+            return
+        yield from self.text_buffer.flush()
+        try:
+            results = yield from self.log_access.search_text(words, **filters)
+        except logbot.SearchUnavailable as error:
+            yield from self.bot.say(str(error))
+            return
+        if not results:
+            yield from self.bot.say('No logged lines match {}.'.format(' '.join(words)))
+            return
+        yield from self.bot.say(_create_search_response(results, words))
+
+    @commands.command(pass_context=True, help=HELP_ROLLSTATS)
+    @asyncio.coroutine
+    def rollstats(self, context):
+        author = context.message.author
+        split_command = context.message.content.split(' ')
+        if len(split_command) > 1:
+            log_name = split_command[1]
+            log_id = yield from self.log_access.get_log_id(log_name)
+            if log_id is None:
+                yield from self.bot.say('Log {} not found.'.format(log_name))
+                return
+            kind, key, subject = logbot.ROLL_SUMMARY_LOG, log_id, 'log {}'.format(log_name)
+        else:
+            kind, key, subject = logbot.ROLL_SUMMARY_USER, author.id, author.display_name
+        yield from self.text_buffer.flush()
+        summary = yield from self.log_access.get_roll_summary(kind, key)
+        if summary is None:
+            yield from self.bot.say('No rolls recorded for {}.'.format(subject))
+            return
+        yield from self.bot.say(content=common.monospace_message(_create_rollstats_response(summary, subject)))
+
+    @asyncio.coroutine
+    def _end_untracked_logs(self):
+        #  Logs from before ends were recorded in the database, or whose end was never recorded.
+        try:
+            ended = yield from self.log_access.end_untracked_logs(
+                self.log_index.log_ids(), datetime.datetime.utcnow()
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception('Could not mark ended logs.')
+        else:
+            if ended:
+                logging.info('Marked {} logs as ended.'.format(ended))
+
+    @asyncio.coroutine
+    def _archive_ended_logs(self):
+        try:
+            archived = yield from self.log_access.archive_ended_logs(self.log_index.log_ids())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception('Could not archive ended logs.')
+        else:
+            if archived:
+                logging.info('Archived {} ended logs.'.format(archived))
+
+    def __unload(self):
+        if self.bot.settings_watcher is not None:
+            self.bot.settings_watcher.unsubscribe(self._settings_reloaded)
+        if not self.bot.loop.is_closed():
+            self._session_watch.cancel()
+            if self._ending_untracked is not None:
+                self._ending_untracked.cancel()
+            if self._archiving is not None:
+                #  Archiving is safe to interrupt: a log is only moved once its transaction commits.
+                self._archiving.cancel()
+        logging.info('Flushing buffered log text...')
+        self.text_buffer.drain()
+        self.log_access.shutdown()
+
+
+def setup(bot):
+    engine = logbot.initialize_engine(common.current_settings(bot).database_settings)
+    active_logs_path, export_directory = log_paths_from_config(bot.config)
+    archive, archive_ended_logs = archive_from_config(bot.config)
+    access_options = dict(
+        loop=bot.loop, bot_metrics=bot.metrics,
+        session_leak_threshold=session_leak_threshold_from_config(bot.config), archive=archive
+    )
+    if bot.log_writer_queues is None:
+        log_access = logaccess.AsyncLogbot(engine, **access_options)
+        log_index = logsessions.ActiveLogIndex(active_logs_path)
+    else:
+        #  One of several shards: writes go to the writer process, and this shard keeps only the
+        #  running logs of its own guilds.
+        shard_id, shard_count = bot.shard_id, bot.shard_count
+        log_writer = logwriter.LogWriterClient(shard_id, *bot.log_writer_queues)
+        log_access = logwriter.ShardedLogbot(engine, log_writer, **access_options)
+        log_index = logsessions.ActiveLogIndex(
+            sharding.shard_path(active_logs_path, shard_id),
+            owns_guild=lambda guild_id: sharding.shard_for_guild(guild_id, shard_count) == shard_id,
+            fallback_path=active_logs_path
+        )
+    text_buffer = writebuffer.LogWriteBuffer(log_access, loop=bot.loop)
+    log_exporter = logexport.LogExporter(log_access, logexport.ExportCache(export_directory))
+    log_index.load()
+    bot.metrics.track_queue_depth('write_buffer', lambda: len(text_buffer))
+    bot.metrics.registry.gauge(
+        'toastbot_log_writes_dropped', 'Log writes dropped because the write buffer was full.',
+        lambda: text_buffer.dropped
+    )
+    bot.metrics.track_queue_depth('log_db_calls', lambda: log_access.pending_calls)
+    bot.metrics.track_queue_depth('active_logs', lambda: len(log_index))
+    bot.metrics.registry.gauge(
+        'toastbot_db_sessions_open', 'Log database sessions created and not yet closed.',
+        lambda: len(log_access.open_sessions)
+    )
+    bot.metrics.registry.gauge(
+        'toastbot_getlog_coalesced', 'Log exports served by joining an identical export already in progress.',
+        lambda: log_exporter.coalesced
+    )
+    bot.add_cog(LogBot(bot, log_access, text_buffer, log_exporter, log_index, archive_ended_logs))
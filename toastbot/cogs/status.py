@@ -0,0 +1,96 @@
+"""
+Status commands (!test, !stats) and the periodic metrics file.
+"""
+import asyncio
+import logging
+
+import discord.ext.commands as commands
+
+import toastbot.metrics as metrics
+import toastbot.sharding as sharding
+from toastbot.cogs import common
+
+DEFAULT_METRICS_SECTION = 'metrics'
+DEFAULT_METRICS_PATH_VALUE_NAME = 'DumpPath'
+DEFAULT_METRICS_INTERVAL_VALUE_NAME = 'DumpIntervalSeconds'
+
+HELP_STATS = "- Bot stats (server administrators only): !stats"
+
+
+def _create_stats_response(rows):
+    pad_len = max(len(name) for name, value in rows)
+
+    results_table = [
+        '{name}: {value}'.format(name=name.ljust(pad_len, ' '), value=value)
+        for name, value
+        in rows
+        ]
+
+    msg_base = [
+        "\nBot stats",
+    ]
+    result_msg = '\n'.join(msg_base + results_table)
+    return result_msg
+
+
+def _is_admin(author):
+    try:
+        return author.server_permissions.administrator
+    except AttributeError:
+        #  Direct messages come from a User, which has no server permissions.
+        return False
+
+
+def metrics_dump_from_config(config):
+    """
+    :return: (path, interval in seconds) for the Prometheus metrics file.
+    """
+    if not config.has_section(DEFAULT_METRICS_SECTION):
+        return metrics.DEFAULT_DUMP_PATH, metrics.DEFAULT_DUMP_INTERVAL
+    metrics_config = config[DEFAULT_METRICS_SECTION]
+    path = metrics_config.get(DEFAULT_METRICS_PATH_VALUE_NAME, metrics.DEFAULT_DUMP_PATH)
+    interval = metrics_config.getfloat(DEFAULT_METRICS_INTERVAL_VALUE_NAME, metrics.DEFAULT_DUMP_INTERVAL)
+    logging.info('Metrics written to {} every {}s'.format(path, interval))
+    return path, interval
+
+
+class Status:
+    def __init__(self, bot, metrics_path, metrics_interval):
+        self.bot = bot
+        self.metrics_path = metrics_path
+        self._metrics_dump = asyncio.ensure_future(
+            bot.metrics.registry.dump_periodically(metrics_path, metrics_interval, loop=bot.loop), loop=bot.loop
+        )
+
+    @commands.command(pass_context=True)
+    @asyncio.coroutine
+    def test(self, context):
+        author = context.message.author
+        logging.info('Bot received test command from {}'.format(author))
+
+        msg_text = "\nAuthor: {author}\nBot is online.".format(author=author.display_name)
+        msg_text = common.monospace_message(msg_text)
+        logging.info('Bot responded to test command.')
+        yield from self.bot.say(content=msg_text)
+
+    @commands.command(pass_context=True, help=HELP_STATS)
+    @asyncio.coroutine
+    def stats(self, context):
+        if not _is_admin(context.message.author):
+            yield from self.bot.say('Only server administrators can view bot stats.')
+            return
+        rows = self.bot.startup_report() + self.bot.metrics.summary_rows()
+        yield from self.bot.say(content=common.monospace_message(_create_stats_response(rows)))
+
+    def __unload(self):
+        #  The loop is already closed when the bot shuts down after run() returns.
+        if not self.bot.loop.is_closed():
+            self._metrics_dump.cancel()
+        self.bot.metrics.registry.write_textfile(self.metrics_path)
+
+
+def setup(bot):
+    metrics_path, metrics_interval = metrics_dump_from_config(bot.config)
+    if bot.shard_count is not None and bot.shard_count > 1:
+        metrics_path = sharding.shard_path(metrics_path, bot.shard_id)
+    bot.add_cog(Status(bot, metrics_path, metrics_interval))
@@ -1 +1,2 @@
-from .configuration import *
\ No newline at end of file
+from .configuration import *
+from .settings import *
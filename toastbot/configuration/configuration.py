@@ -8,27 +8,84 @@ Config file has format:
 bot_token = <Bot token>
 
 #####
+
+Each file is parsed once and cached; ConfigFile.reload parses it again after it has changed.
 """
 
 import configparser
 import sys
 import os
 import logging
+import threading
+
+_root_path = None
+#  Absolute path -> ConfigFile.
+_config_files = dict()
+_config_files_lock = threading.Lock()
 
 
 def _get_path_to_config(config_location):
-    logging.info('Retrieving configuration...')
-    main_path = os.path.abspath(sys.modules['__main__'].__file__)
-    root_path = os.path.dirname(main_path)
-    config_path = os.path.join(root_path, config_location)
-    logging.info('Full path found.')
-    return config_path
+    global _root_path
+    if os.path.isabs(config_location):
+        #  Processes started by multiprocessing have no __main__ file to resolve against.
+        return config_location
+    if _root_path is None:
+        logging.info('Retrieving configuration...')
+        _root_path = os.path.dirname(os.path.abspath(sys.modules['__main__'].__file__))
+        logging.info('Full path found.')
+    return os.path.join(_root_path, config_location)
+
+
+class ConfigFile:
+    """
+    A configuration file and its most recently parsed contents.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.config = None
+        self.reload()
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def changed(self):
+        return self._stat() != self.mtime
+
+    def parse(self):
+        """
+        Parse the file again, without replacing the current contents.
+
+        :return: The new ConfigParser.
+        """
+        #  Taken first, so a failed parse is not retried until the file changes again.
+        self.mtime = self._stat()
+        config = configparser.ConfigParser()
+        config.read(self.path)
+        return config
+
+    def reload(self):
+        self.config = self.parse()
+        return self.config
+
+
+def config_file(config_location):
+    """
+    :param config_location: Path, relative to the __main__ script unless absolute.
+    :return: The cached ConfigFile for it, parsed on first use.
+    """
+    path = _get_path_to_config(config_location)
+    with _config_files_lock:
+        cached = _config_files.get(path)
+        if cached is None:
+            logging.info('Reading API configuration from file...')
+            cached = _config_files[path] = ConfigFile(path)
+            logging.info('Configuration successfully read.')
+    return cached
 
 
 def read_api_configuration(config_location):
-    logging.info('Reading API configuration from file...')
-    config_location = _get_path_to_config(config_location)
-    config = configparser.ConfigParser()
-    config.read(config_location)
-    logging.info('Configuration successfully read.')
-    return config
+    return config_file(config_location).config
@@ -0,0 +1,194 @@
+"""
+Typed settings read from the configuration file, reloaded when the file changes.
+
+Only settings that can safely change while the bot runs are here: the log level, dice limits and
+database tuning. Everything else is read from the parsed configuration once, at startup.
+"""
+import asyncio
+import collections
+import configparser
+import logging
+
+import toastbot.defaultlogger as defaultlogger
+import toastbot.botfunctions.diceroller as diceroller
+import toastbot.botfunctions.logbot as logbot
+
+DEFAULT_RELOAD_INTERVAL = 5.0
+
+DEFAULT_LOGGING_SECTION = 'logging'
+DEFAULT_LOG_LEVEL_VALUE_NAME = 'LogLevel'
+DEFAULT_LOG_LEVEL = 'INFO'
+
+DEFAULT_DICE_SECTION = 'dice'
+DEFAULT_MAX_DICE_VALUE_NAME = 'MaxDice'
+DEFAULT_MAX_SIDES_VALUE_NAME = 'MaxSides'
+DEFAULT_MAX_MODIFIER_VALUE_NAME = 'MaxModifier'
+
+DEFAULT_DATABASE_SECTION = 'database'
+DEFAULT_DATABASE_PRESET_VALUE_NAME = 'Preset'
+DEFAULT_DATABASE_PRESET = 'default'
+#  Config value names in the database section, mapped to their logbot.DatabaseSettings arguments.
+DATABASE_SETTING_VALUE_NAMES = {
+    'Path': 'path',
+    'JournalMode': 'journal_mode',
+    'Synchronous': 'synchronous',
+    'CacheSizeKiB': 'cache_size_kib',
+    'MmapSize': 'mmap_size',
+    'BusyTimeoutMs': 'busy_timeout_ms',
+    'PoolSize': 'pool_size',
+}
+#  Config value names of the database section's tuning values, in DatabaseTuning order.
+DATABASE_TUNING_VALUE_NAMES = ('Preset', 'JournalMode', 'Synchronous', 'CacheSizeKiB', 'MmapSize', 'BusyTimeoutMs')
+
+DiceLimits = collections.namedtuple('DiceLimits', 'max_num_dice max_num_sides max_modifier')
+
+#  As written in the database section, None where unset; the log cog resolves them against the preset.
+DatabaseTuning = collections.namedtuple(
+    'DatabaseTuning', 'preset journal_mode synchronous cache_size_kib mmap_size busy_timeout_ms'
+)
+
+
+def database_settings_from_config(config):
+    """
+    :return: logbot.DatabaseSettings for the database section.
+    :raises ValueError: If a value is unknown or not a number where one is expected.
+    """
+    if not config.has_section(DEFAULT_DATABASE_SECTION):
+        logging.info('No database section in configuration; using defaults.')
+        return logbot.DatabaseSettings()
+    database_config = config[DEFAULT_DATABASE_SECTION]
+    preset = database_config.get(DEFAULT_DATABASE_PRESET_VALUE_NAME, DEFAULT_DATABASE_PRESET)
+    overrides = {
+        setting_name: database_config[value_name]
+        for value_name, setting_name in DATABASE_SETTING_VALUE_NAMES.items()
+        if value_name in database_config
+    }
+    logging.info('Database preset: {}'.format(preset))
+    return logbot.DatabaseSettings.from_preset(preset, **overrides)
+
+
+class Settings:
+    """
+    Settings parsed from one version of the configuration file. Never modified; a reload makes a new one.
+    """
+    def __init__(self, config, log_level_name, dice_limits, database_tuning, database_settings):
+        """
+        :param config: The configparser.ConfigParser the settings were read from.
+        :param database_tuning: DatabaseTuning as written, to tell whether the tuning changed.
+        :param database_settings: logbot.DatabaseSettings the tuning resolves to.
+        """
+        self.config = config
+        self.log_level_name = log_level_name
+        self.log_level = defaultlogger.LOG_LEVEL_MAP[log_level_name]
+        self.dice_limits = dice_limits
+        self.database_tuning = database_tuning
+        self.database_settings = database_settings
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Read and validate every reloadable setting, so that a bad file is rejected as a whole.
+
+        :raises ValueError: If a value is not of its expected type, is out of range, or is unknown.
+        """
+        log_level_name = DEFAULT_LOG_LEVEL
+        if config.has_section(DEFAULT_LOGGING_SECTION):
+            log_level_name = config[DEFAULT_LOGGING_SECTION].get(DEFAULT_LOG_LEVEL_VALUE_NAME, log_level_name).upper()
+        if log_level_name not in defaultlogger.LOG_LEVEL_MAP:
+            raise ValueError('Unknown log level: {}. Available: {}'.format(
+                log_level_name, ', '.join(sorted(defaultlogger.LOG_LEVEL_MAP))))
+
+        dice_limits = DiceLimits(
+            diceroller.DEFAULT_MAX_DICE, diceroller.DEFAULT_MAX_SIDES, diceroller.DEFAULT_MAX_MODIFIER
+        )
+        if config.has_section(DEFAULT_DICE_SECTION):
+            dice_config = config[DEFAULT_DICE_SECTION]
+            dice_limits = DiceLimits(
+                dice_config.getint(DEFAULT_MAX_DICE_VALUE_NAME, dice_limits.max_num_dice),
+                dice_config.getint(DEFAULT_MAX_SIDES_VALUE_NAME, dice_limits.max_num_sides),
+                dice_config.getint(DEFAULT_MAX_MODIFIER_VALUE_NAME, dice_limits.max_modifier)
+            )
+        if dice_limits.max_num_dice < 1 or dice_limits.max_num_sides < 1 or dice_limits.max_modifier < 0:
+            raise ValueError('Dice limits must allow at least one die with one side, and a modifier of 0 or more: '
+                             '{} dice, {} sides, modifier {}.'.format(*dice_limits))
+
+        database_tuning = DatabaseTuning(*(None for value_name in DATABASE_TUNING_VALUE_NAMES))
+        if config.has_section(DEFAULT_DATABASE_SECTION):
+            database_config = config[DEFAULT_DATABASE_SECTION]
+            database_tuning = DatabaseTuning(*(
+                database_config.get(value_name) for value_name in DATABASE_TUNING_VALUE_NAMES
+            ))
+        database_settings = database_settings_from_config(config)
+        return cls(config, log_level_name, dice_limits, database_tuning, database_settings)
+
+    def command_parser_config(self):
+        return diceroller.CommandParserConfig(
+            max_num_dice=self.dice_limits.max_num_dice,
+            max_num_sides=self.dice_limits.max_num_sides,
+            max_modifier=self.dice_limits.max_modifier
+        )
+
+
+class SettingsWatcher:
+    """
+    The current Settings of a configuration file, replaced whenever the file changes.
+
+    Each change is parsed and validated in full before anything sees it, then handed to every
+    subscriber in turn; a file that fails to parse is ignored and the current settings kept.
+    """
+    def __init__(self, config_file):
+        """
+        :param config_file: configuration.ConfigFile to watch.
+        """
+        self.config_file = config_file
+        self.current = Settings.from_config(config_file.config)
+        self.reloads = 0
+        self._subscribers = list()
+
+    def subscribe(self, callback):
+        """
+        :param callback: Called with (old Settings, new Settings) after each reload, on the watching thread.
+        """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def check(self):
+        """
+        Reload the settings if the file has changed since it was last read.
+
+        :return: The new Settings, or None if there were none.
+        """
+        if not self.config_file.changed():
+            return None
+        try:
+            settings = Settings.from_config(self.config_file.parse())
+        except (ValueError, configparser.Error) as error:
+            logging.error('Configuration {} not reloaded; keeping the current settings: {}'.format(
+                self.config_file.path, error))
+            return None
+        except Exception:
+            logging.exception('Configuration {} not reloaded; keeping the current settings.'.format(
+                self.config_file.path))
+            return None
+        self.config_file.config = settings.config
+        old, self.current = self.current, settings
+        self.reloads += 1
+        logging.info('Configuration {} reloaded.'.format(self.config_file.path))
+        for callback in tuple(self._subscribers):
+            try:
+                callback(old, settings)
+            except Exception:
+                logging.exception('Could not apply reloaded settings.')
+        return settings
+
+    @asyncio.coroutine
+    def watch(self, interval=DEFAULT_RELOAD_INTERVAL, loop=None):
+        """
+        Check the file for changes every interval seconds, forever.
+        """
+        while True:
+            yield from asyncio.sleep(interval, loop=loop)
+            self.check()
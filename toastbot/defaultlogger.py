@@ -1,8 +1,24 @@
+"""
+Logging setup for the bot.
+
+Records are handed to a queue on the calling thread and written to the console by a background
+listener, so a slow terminal never stalls the event loop. Hot paths should pass %-style arguments
+rather than pre-formatted strings, so that nothing is formatted unless the level is enabled, and
+use SampledLog for events that happen once per message.
+"""
+import atexit
+import itertools
 import logging
+import logging.handlers
+import queue
 import sys
 
 
 MIN_LOGGING_LEVEL = logging.DEBUG
+DEFAULT_LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+#  Unbounded, so put_nowait never blocks or drops; the listener keeps up with any realistic rate.
+DEFAULT_QUEUE_SIZE = -1
+DEFAULT_SAMPLE_EVERY = 100
 
 
 LOG_LEVEL_MAP = {
@@ -14,7 +30,113 @@ LOG_LEVEL_MAP = {
     'CRITICAL': logging.CRITICAL
 }
 
+_listener = None
+
+
+class EventFields:
+    """
+    Key=value fields of a structured event, only rendered if the record is actually emitted.
+    """
+    __slots__ = ('fields',)
+
+    def __init__(self, fields):
+        self.fields = fields
 
-def init_logging(out=sys.stdout, err=sys.stderr, level=logging.WARNING):
+    def __str__(self):
+        return ' '.join('{}={}'.format(key, self.fields[key]) for key in sorted(self.fields))
+
+
+def log_event(level, event, **fields):
+    """
+    Log a structured event as "<event> key=value ...", skipping all work when the level is disabled.
+
+    :param level: Logging level, e.g. logging.DEBUG.
+    :param event: Short, fixed event name.
+    """
     logger = logging.getLogger()
+    if logger.isEnabledFor(level):
+        logger.log(level, '%s %s', event, EventFields(fields))
+
+
+class SampledLog:
+    """
+    Log only every Nth occurrence of a frequent event, with a count of how many it stands for.
+
+    Nothing is counted or formatted while the level is disabled.
+    """
+    def __init__(self, level, msg, every=DEFAULT_SAMPLE_EVERY):
+        self.level = level
+        self.msg = msg
+        self.every = max(1, every)
+        self._counter = itertools.count(1)
+
+    def __call__(self, *args):
+        logger = logging.getLogger()
+        if not logger.isEnabledFor(self.level):
+            return
+        occurrence = next(self._counter)
+        if (occurrence - 1) % self.every == 0:
+            logger.log(self.level, self.msg + ' (sampled 1 in %d, %d so far)', *(args + (self.every, occurrence)))
+
+
+class _LevelRangeFilter(logging.Filter):
+    """
+    Pass records with min_level <= level < max_level.
+
+    QueueListener ignores handler levels before Python 3.5, so levels are enforced with filters.
+    """
+    def __init__(self, min_level, max_level):
+        super().__init__()
+        self.min_level = min_level
+        self.max_level = max_level
+
+    def filter(self, record):
+        return self.min_level <= record.levelno < self.max_level
+
+
+def init_logging(out=sys.stdout, err=sys.stderr, level=logging.WARNING, queue_size=DEFAULT_QUEUE_SIZE):
+    """
+    Route records at `level` and above through a queue: warnings and errors to `err`, the rest to `out`.
+
+    Calling this again replaces the previous handlers and listener.
+
+    :return: The running QueueListener.
+    """
+    global _listener
+    shutdown_logging()
+    formatter = logging.Formatter(DEFAULT_LOG_FORMAT)
+
+    out_handler = logging.StreamHandler(out)
+    out_handler.addFilter(_LevelRangeFilter(MIN_LOGGING_LEVEL, logging.WARNING))
+    err_handler = logging.StreamHandler(err)
+    err_handler.addFilter(_LevelRangeFilter(logging.WARNING, logging.CRITICAL + 1))
+    for handler in (out_handler, err_handler):
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(queue_size)
+    logger = logging.getLogger()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
     logger.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(log_queue, out_handler, err_handler)
+    _listener.start()
+    return _listener
+
+
+def set_level(level):
+    logging.getLogger().setLevel(level)
+
+
+def shutdown_logging():
+    """
+    Stop the listener after writing out every queued record.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
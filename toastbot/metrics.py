@@ -0,0 +1,281 @@
+"""
+In-process metrics: counters, gauges and latency histograms, exported in Prometheus text format.
+
+Observations are a bucket search and a couple of additions under a lock, so they are cheap enough
+to make on every command and message. Gauges for queue depths are read through callbacks only
+when metrics are rendered, so they cost nothing in between.
+"""
+import asyncio
+import bisect
+import collections
+import logging
+import os
+import threading
+
+#  Latency bucket upper bounds in seconds, from 1ms to 10s.
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DEFAULT_DUMP_PATH = 'data/metrics.prom'
+DEFAULT_DUMP_INTERVAL = 60.0
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels
+    ))
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Gauge:
+    """
+    A value read from `read` whenever metrics are rendered.
+    """
+    def __init__(self, read):
+        self.read = read
+
+    @property
+    def value(self):
+        return self.read()
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        #  One count per bucket plus a final overflow (+Inf) bucket; counts are not cumulative.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, fraction):
+        """
+        Estimate a quantile as the upper bound of the bucket it falls in.
+
+        :return: Upper bound in seconds; inf if it falls past the last bucket, 0.0 with no observations.
+        """
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            cumulative += bucket_count
+            if cumulative >= target:
+                return bound
+        return float('inf')
+
+    def samples(self, name, labels):
+        samples = list()
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            cumulative += bucket_count
+            samples.append(('{}_bucket'.format(name), labels + (('le', repr(bound)),), cumulative))
+        samples.append(('{}_bucket'.format(name), labels + (('le', '+Inf'),), self.count))
+        samples.append(('{}_sum'.format(name), labels, self.sum))
+        samples.append(('{}_count'.format(name), labels, self.count))
+        return samples
+
+
+class MetricFamily:
+    """
+    All series of one metric name, one per distinct set of label values.
+    """
+    def __init__(self, name, kind, help_text, label_names, factory):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._factory = factory
+        self._series = dict()
+        self._lock = threading.Lock()
+
+    def labels(self, *label_values):
+        """
+        :return: The series for these label values, created on first use.
+        """
+        series = self._series.get(label_values)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(label_values, self._factory())
+        return series
+
+    def items(self):
+        return sorted(self._series.items())
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help_text),
+            '# TYPE {} {}'.format(self.name, self.kind),
+        ]
+        for label_values, series in self.items():
+            labels = tuple(zip(self.label_names, label_values))
+            for sample_name, sample_labels, value in series.samples(self.name, labels):
+                lines.append('{}{} {}'.format(sample_name, _format_labels(sample_labels), value))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._families = dict()
+
+    def _family(self, name, kind, help_text, label_names, factory):
+        family = self._families.get(name)
+        if family is None:
+            family = MetricFamily(name, kind, help_text, label_names, factory)
+            self._families[name] = family
+        elif family.kind != kind:
+            raise ValueError('Metric {} already registered as a {}.'.format(name, family.kind))
+        return family
+
+    def counter(self, name, help_text, label_names=()):
+        return self._family(name, 'counter', help_text, label_names, Counter)
+
+    def histogram(self, name, help_text, label_names=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        return self._family(name, 'histogram', help_text, label_names, lambda: Histogram(buckets))
+
+    def gauge(self, name, help_text, read):
+        """
+        Register an unlabelled gauge whose value is read from `read()` at render time.
+
+        Registering a name again, as a reloaded cog does, replaces its callback, so the gauge
+        never keeps reading the state of an unloaded cog.
+        """
+        family = self._family(name, 'gauge', help_text, (), lambda: Gauge(read))
+        family.help_text = help_text
+        family.labels().read = read
+        return family
+
+    def get(self, name):
+        return self._families.get(name)
+
+    def families(self):
+        return [self._families[name] for name in sorted(self._families)]
+
+    def render(self):
+        """
+        :return: All metrics in Prometheus text exposition format.
+        """
+        lines = list()
+        for family in self.families():
+            lines.extend(family.render())
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path=DEFAULT_DUMP_PATH):
+        """
+        Atomically replace `path` with the current metrics, for the node exporter's textfile collector.
+        """
+        temp_path = '{}.tmp'.format(path)
+        with open(temp_path, 'w', encoding='utf-8') as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(temp_path, path)
+
+    @asyncio.coroutine
+    def dump_periodically(self, path=DEFAULT_DUMP_PATH, interval=DEFAULT_DUMP_INTERVAL, loop=None):
+        """
+        Write the metrics file every `interval` seconds until cancelled.
+        """
+        while True:
+            yield from asyncio.sleep(interval, loop=loop)
+            try:
+                self.write_textfile(path)
+            except OSError:
+                logging.exception('Could not write metrics to %s.', path)
+
+
+class BotMetrics:
+    """
+    The bot's own metrics, registered on one MetricsRegistry.
+    """
+    def __init__(self, registry=None):
+        self.registry = registry if registry is not None else MetricsRegistry()
+        self.commands = self.registry.counter(
+            'toastbot_commands_total', 'Commands invoked, by command and outcome.', ('command', 'outcome')
+        )
+        self.command_latency = self.registry.histogram(
+            'toastbot_command_seconds', 'Time to handle a command.', ('command',)
+        )
+        self.listener_latency = self.registry.histogram(
+            'toastbot_listener_seconds', 'Time spent in message listeners per message.', ('listener',)
+        )
+        self.db_latency = self.registry.histogram(
+            'toastbot_db_call_seconds', 'Time per log database call, including commit.', ('call',)
+        )
+
+    def observe_listener(self, listener_name, elapsed):
+        self.listener_latency.labels(listener_name).observe(elapsed)
+
+    def observe_db_call(self, call_name, elapsed):
+        self.db_latency.labels(call_name).observe(elapsed)
+
+    def track_queue_depth(self, queue_name, read):
+        """
+        :param read: Callable returning the queue's current depth.
+        """
+        self.registry.gauge('toastbot_{}_depth'.format(queue_name), 'Items waiting in the {}.'.format(
+            queue_name.replace('_', ' ')), read)
+
+    def summary_rows(self):
+        """
+        :return: List of (name, formatted value) for a short human-readable report.
+        """
+        rows = list()
+        for (command_name,), histogram in self.command_latency.items():
+            outcomes = collections.Counter()
+            for (name, outcome), counter in self.commands.items():
+                if name == command_name:
+                    outcomes[outcome] += counter.value
+            summary = _latency_summary(histogram, outcomes['error'])
+            if outcomes['limited']:
+                summary += ' limited={}'.format(outcomes['limited'])
+            rows.append(('!{}'.format(command_name), summary))
+        for (listener_name,), histogram in self.listener_latency.items():
+            rows.append(('listener {}'.format(listener_name), _latency_summary(histogram)))
+        for (call_name,), histogram in self.db_latency.items():
+            rows.append(('db {}'.format(call_name), _latency_summary(histogram)))
+        for family in self.registry.families():
+            if family.kind == 'gauge':
+                rows.append((family.name[len('toastbot_'):], str(family.labels().value)))
+        return rows
+
+
+def _latency_summary(histogram, errors=None):
+    summary = 'n={} mean={:.1f}ms p50<={} p99<={}'.format(
+        histogram.count, histogram.mean * 1000,
+        _format_bound(histogram.quantile(0.5)), _format_bound(histogram.quantile(0.99))
+    )
+    if errors:
+        summary += ' errors={}'.format(errors)
+    return summary
+
+
+def _format_bound(seconds):
+    if seconds == float('inf'):
+        return 'inf'
+    return '{:g}ms'.format(seconds * 1000)
@@ -0,0 +1,117 @@
+"""
+Bounded queue of outgoing messages, merging bursts of short replies.
+
+Messages are sent one at a time per destination, in the order queued. While one is being sent,
+further text-only messages to the same destination wait; when the send completes, as many of them
+as fit in one Discord message are joined with newlines and sent in a single API call. A reply
+that arrives when nothing is queued is sent straight away, so merging adds no latency.
+
+Queued messages across all destinations are capped; once the cap is reached, callers wait for
+room rather than piling up sends the API would only rate limit.
+"""
+import asyncio
+import collections
+import logging
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+DEFAULT_MAX_QUEUED = 256
+
+PendingMessage = collections.namedtuple('PendingMessage', 'content options future')
+
+
+class Outbox:
+    def __init__(self, send, loop, max_queued=DEFAULT_MAX_QUEUED, limit=DISCORD_MESSAGE_LIMIT):
+        """
+        :param send: Coroutine function sending one message: send(destination, content, **options).
+        :param max_queued: Most messages waiting or being sent at once.
+        :param limit: Longest message that merged replies may add up to.
+        """
+        self._send = send
+        self.loop = loop
+        self.limit = limit
+        self.queued = 0
+        self.sends = 0
+        self.merged = 0
+        self._room = asyncio.Semaphore(max_queued, loop=loop)
+        #  Destination ID -> deque of PendingMessage, for destinations with a sender running.
+        self._pending = dict()
+        self._senders = dict()
+
+    @asyncio.coroutine
+    def send(self, destination, content=None, **options):
+        """
+        Queue a message and wait until it has been sent.
+
+        :param options: Further send_message arguments; messages with any set are never merged.
+        :return: The discord.Message the content went out in, which merged replies share.
+        """
+        yield from self._room.acquire()
+        future = asyncio.Future(loop=self.loop)
+        self.queued += 1
+        self._pending.setdefault(destination.id, collections.deque()).append(
+            PendingMessage(content, options, future)
+        )
+        if destination.id not in self._senders:
+            self._senders[destination.id] = asyncio.ensure_future(self._drain(destination), loop=self.loop)
+        result = yield from asyncio.shield(future, loop=self.loop)
+        return result
+
+    def _mergeable(self, message):
+        return isinstance(message.content, str) and len(message.content) <= self.limit \
+            and not any(message.options.values())
+
+    def _take_batch(self, pending):
+        """
+        :return: List of PendingMessage to send as one: the first queued, and the mergeable ones behind it.
+        """
+        batch = [pending.popleft()]
+        if not self._mergeable(batch[0]):
+            return batch
+        length = len(batch[0].content)
+        while pending and self._mergeable(pending[0]) and length + 1 + len(pending[0].content) <= self.limit:
+            length += 1 + len(pending[0].content)
+            batch.append(pending.popleft())
+        return batch
+
+    @asyncio.coroutine
+    def _drain(self, destination):
+        pending = self._pending[destination.id]
+        batch = list()
+        try:
+            while pending:
+                batch = self._take_batch(pending)
+                if len(batch) > 1:
+                    content = '\n'.join(message.content for message in batch)
+                    self.merged += len(batch) - 1
+                else:
+                    content = batch[0].content
+                try:
+                    result = yield from self._send(destination, content, **batch[0].options)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as error:
+                    logging.warning('Sending to {} failed: {!r}'.format(destination.id, error))
+                    self._settle(batch, error=error)
+                else:
+                    self._settle(batch, result=result)
+                batch = list()
+                self.sends += 1
+        except asyncio.CancelledError:
+            self._settle(batch + list(pending), error=asyncio.CancelledError())
+            pending.clear()
+            raise
+        finally:
+            del self._pending[destination.id]
+            del self._senders[destination.id]
+
+    def _settle(self, batch, result=None, error=None):
+        for message in batch:
+            self.queued -= 1
+            self._room.release()
+            if message.future.done():
+                continue
+            if error is not None:
+                message.future.set_exception(error)
+            else:
+                message.future.set_result(result)
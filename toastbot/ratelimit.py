@@ -0,0 +1,165 @@
+"""
+Token-bucket rate limiting of commands, per user and per channel.
+
+Each user and each channel has a bucket of tokens that refills at a steady rate up to a burst
+size. A command takes its cost in tokens from both the author's and the channel's bucket, and is
+refused if either has too few, so one user cannot monopolize the bot and a busy channel cannot
+crowd out the others.
+"""
+import time
+
+import discord.ext.commands as commands
+
+DEFAULT_USER_RATE = 0.5
+DEFAULT_USER_BURST = 5.0
+DEFAULT_CHANNEL_RATE = 2.0
+DEFAULT_CHANNEL_BURST = 10.0
+
+#  Command name -> tokens it takes; other commands take one. Exports read and render whole logs.
+DEFAULT_COMMAND_COSTS = {'getlog': 4.0, 'searchlog': 2.0, 'rollstats': 2.0}
+
+#  Buckets are kept for at most this many users and channels; full ones are dropped first.
+DEFAULT_MAX_BUCKETS = 10000
+
+
+class RateLimited(commands.CheckFailure):
+    """
+    Raised from the bot's global check when a command was over its author's or channel's limit.
+    """
+    def __init__(self, command_name, retry_after, first):
+        """
+        :param retry_after: Seconds until the command would be allowed.
+        :param first: Whether this is the first refusal since the bucket last allowed a command.
+        """
+        super().__init__('Command {} rate limited; retry in {:.1f}s.'.format(command_name, retry_after))
+        self.retry_after = retry_after
+        self.first = first
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity, now):
+        """
+        :param rate: Tokens added per second.
+        :param capacity: Most tokens the bucket holds, i.e. the burst allowed after a quiet spell.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        #  Whether a command has been refused since the last one was allowed.
+        self.limited = False
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, cost):
+        """
+        :return: Seconds until the bucket holds cost tokens; 0 if it does now.
+        """
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost):
+        self.tokens -= cost
+        self.limited = False
+
+    @property
+    def full(self):
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """
+    Per-user and per-channel token buckets, with a cost for each command.
+    """
+    def __init__(self, user_rate=DEFAULT_USER_RATE, user_burst=DEFAULT_USER_BURST,
+                 channel_rate=DEFAULT_CHANNEL_RATE, channel_burst=DEFAULT_CHANNEL_BURST,
+                 command_costs=None, max_buckets=DEFAULT_MAX_BUCKETS, clock=time.monotonic):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.command_costs = dict(DEFAULT_COMMAND_COSTS if command_costs is None else command_costs)
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self.limited = 0
+        self._user_buckets = dict()
+        self._channel_buckets = dict()
+
+    def cost(self, command_name):
+        return self.command_costs.get(command_name, 1.0)
+
+    def acquire(self, user_id, channel_id, command_name):
+        """
+        Take the command's cost from both buckets, or from neither if either is short.
+
+        :return: None if the command may run, else a RateLimited error for it.
+        """
+        now = self.clock()
+        cost = self.cost(command_name)
+        buckets = (
+            self._bucket(self._user_buckets, user_id, self.user_rate, self.user_burst, now),
+            self._bucket(self._channel_buckets, channel_id, self.channel_rate, self.channel_burst, now),
+        )
+        #  A command costing more than a bucket holds is still allowed once the bucket is full.
+        retry_after = max(bucket.wait_for(min(cost, bucket.capacity)) for bucket in buckets)
+        if retry_after > 0:
+            self.limited += 1
+            first = not any(bucket.limited for bucket in buckets)
+            for bucket in buckets:
+                bucket.limited = True
+            return RateLimited(command_name, retry_after, first)
+        for bucket in buckets:
+            bucket.take(cost)
+        return None
+
+    def charge(self, command, context):
+        """
+        Take the cost of a command that is about to run, noting on the context whether it was refused.
+
+        Called once per invocation, as the command is dispatched and before its checks run.
+        """
+        message = context.message
+        context.rate_limited = self.acquire(message.author.id, message.channel.id, command.qualified_name)
+
+    def check(self, context):
+        """
+        Global command check for commands.Bot.add_check.
+
+        Takes no tokens itself, as the help command runs every global check for each command it lists.
+
+        :raises RateLimited: If charge refused the command being invoked.
+        """
+        error = getattr(context, 'rate_limited', None)
+        if error is not None:
+            raise error
+        return True
+
+    @property
+    def bucket_count(self):
+        return len(self._user_buckets) + len(self._channel_buckets)
+
+    def _bucket(self, buckets, key, rate, capacity, now):
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.max_buckets:
+                self._prune(buckets, now)
+            bucket = buckets[key] = TokenBucket(rate, capacity, now)
+        else:
+            bucket.refill(now)
+        return bucket
+
+    def _prune(self, buckets, now):
+        """
+        Drop buckets that have refilled, which behave exactly like new ones; failing that, the stalest half.
+        """
+        for key, bucket in list(buckets.items()):
+            bucket.refill(now)
+            if bucket.full:
+                del buckets[key]
+        if len(buckets) >= self.max_buckets:
+            by_age = sorted(buckets, key=lambda key: buckets[key].updated)
+            for key in by_age[:len(by_age) // 2]:
+                del buckets[key]
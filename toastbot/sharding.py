@@ -0,0 +1,33 @@
+"""
+Assignment of guilds to gateway shards, and per-shard file names.
+"""
+import os
+
+DEFAULT_SHARDING_SECTION = 'sharding'
+DEFAULT_SHARD_COUNT_VALUE_NAME = 'ShardCount'
+
+
+def shard_for_guild(guild_id, shard_count):
+    """
+    The shard Discord delivers a guild's events to. Direct messages, with no guild, go to shard 0.
+    """
+    if guild_id is None:
+        return 0
+    return (int(guild_id) >> 22) % shard_count
+
+
+def shard_path(path, shard_id):
+    """
+    :return: The path with the shard id inserted before the extension, e.g. data/metrics.shard1.prom.
+    """
+    root, extension = os.path.splitext(path)
+    return '{}.shard{}{}'.format(root, shard_id, extension)
+
+
+def shard_count_from_config(config):
+    """
+    :return: Number of gateway shards to run; 1 runs the bot as a single process.
+    """
+    if not config.has_section(DEFAULT_SHARDING_SECTION):
+        return 1
+    return max(1, config[DEFAULT_SHARDING_SECTION].getint(DEFAULT_SHARD_COUNT_VALUE_NAME, 1))
@@ -0,0 +1,92 @@
+"""
+Sharded mode: one process per gateway shard, plus one process that writes the log database.
+
+Processes are started with the spawn method, so no event loop, thread pool or database
+connection is ever inherited from the launcher.
+"""
+import logging
+import multiprocessing
+import signal
+
+import toastbot.configuration as botconf
+import toastbot.defaultlogger as logger
+import toastbot.botfunctions.logbot as logbot
+import toastbot.botfunctions.logwriter as logwriter
+import toastbot.cogs.logbot as logbot_cog
+
+#  Seconds to wait for the writer to open and migrate the database before giving up.
+WRITER_START_TIMEOUT = 120
+#  How often the launcher checks that the writer is still running.
+WRITER_CHECK_INTERVAL = 1.0
+
+
+def run_writer(config_location, requests, replies, ready, log_level):
+    """
+    Writer process: own the log database and perform the shards' writes until told to stop.
+    """
+    #  Interrupts stop the shards; the writer keeps going until they have drained their buffers.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger.init_logging(level=log_level)
+    config = botconf.read_api_configuration(config_location)
+    engine = logbot.initialize_engine(botconf.database_settings_from_config(config))
+    archive, _ = logbot_cog.archive_from_config(config)
+    ready.set()
+    logging.info('Log writer ready.')
+    try:
+        logwriter.LogWriter(engine, replies, archive).serve(requests)
+    finally:
+        engine.dispose()
+        archive.close()
+        logger.shutdown_logging()
+
+
+def run_sharded(config_location, shard_count, shard_target, log_level):
+    """
+    Run shard_count shards and the writer, until every shard has exited.
+
+    :param shard_target: Picklable function run in each shard process, taking the shard id, the
+        shard count and the (request queue, reply queue) of the writer.
+    """
+    context = multiprocessing.get_context('spawn')
+    requests = context.Queue()
+    replies = [context.Queue() for shard_id in range(shard_count)]
+    ready = context.Event()
+    writer = context.Process(
+        target=run_writer, args=(config_location, requests, replies, ready, log_level), name='log-writer'
+    )
+    writer.start()
+    if not ready.wait(WRITER_START_TIMEOUT):
+        writer.terminate()
+        raise RuntimeError('Log writer did not start within {}s.'.format(WRITER_START_TIMEOUT))
+
+    shards = [
+        context.Process(
+            target=shard_target, args=(shard_id, shard_count, (requests, replies[shard_id])),
+            name='shard-{}'.format(shard_id)
+        )
+        for shard_id in range(shard_count)
+    ]
+    for shard in shards:
+        shard.start()
+    logging.info('Started {} shards.'.format(shard_count))
+    try:
+        _wait_for_shards(shards, writer)
+    finally:
+        requests.put(logwriter.STOP)
+        writer.join()
+    logging.info('All shards stopped.')
+
+
+def _wait_for_shards(shards, writer):
+    while any(shard.is_alive() for shard in shards):
+        try:
+            for shard in shards:
+                shard.join(WRITER_CHECK_INTERVAL)
+                if not writer.is_alive():
+                    logging.error('Log writer exited unexpectedly; stopping shards.')
+                    for running_shard in shards:
+                        running_shard.terminate()
+                    return
+        except KeyboardInterrupt:
+            #  The shards got the interrupt too, and are shutting down.
+            logging.info('Interrupted; waiting for shards to stop...')
@@ -1,11 +1,333 @@
+import discord
 import discord.ext.commands as commands
+import aiohttp
 import asyncio
+import collections
+import configparser
 import logging
+import math
+import random
+import time
+
+import websockets
+
+import toastbot.metrics as metrics
+import toastbot.outbox as outbox
+import toastbot.ratelimit as ratelimit
+
+DEFAULT_RECONNECT_BASE_DELAY = 1.0
+DEFAULT_RECONNECT_MAX_DELAY = 60.0
+#  A connection that stayed up this long counts as recovered, and the backoff starts over.
+DEFAULT_STABLE_CONNECTION_SECONDS = 60.0
+
+#  Errors that mean the network or gateway is unavailable, as opposed to e.g. a bad token.
+RECONNECT_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    aiohttp.ClientError,
+    websockets.InvalidHandshake,
+    websockets.WebSocketProtocolError,
+    discord.ConnectionClosed,
+    discord.GatewayNotFound,
+    discord.HTTPException,
+)
+
+
+class ExponentialBackoff:
+    """
+    Reconnect delays that double with each consecutive failure, up to a maximum.
+
+    Half of each delay is random, so clients dropped by the same outage do not all reconnect at once.
+    """
+    def __init__(self, base=DEFAULT_RECONNECT_BASE_DELAY, maximum=DEFAULT_RECONNECT_MAX_DELAY, rng=None):
+        self.base = base
+        self.maximum = maximum
+        self.failures = 0
+        self._random = rng if rng is not None else random.Random()
+
+    def next_delay(self):
+        delay = min(self.maximum, self.base * 2 ** self.failures)
+        self.failures += 1
+        return delay / 2 + self._random.uniform(0, delay / 2)
+
+    def reset(self):
+        self.failures = 0
+
+
+class ConnectionStats:
+    """
+    Reconnect count and time spent disconnected.
+    """
+    def __init__(self):
+        self.reconnects = 0
+        self.last_downtime = 0.0
+        self._completed_downtime = 0.0
+        self._down_since = None
+
+    @property
+    def connected(self):
+        return self._down_since is None
+
+    @property
+    def downtime(self):
+        """
+        Total seconds disconnected, including the current outage.
+        """
+        if self._down_since is None:
+            return self._completed_downtime
+        return self._completed_downtime + time.monotonic() - self._down_since
+
+    def disconnected(self):
+        if self._down_since is None:
+            self._down_since = time.monotonic()
+
+    def reconnected(self):
+        """
+        :return: Seconds the outage that just ended lasted, or None if there was none.
+        """
+        if self._down_since is None:
+            return None
+        self.last_downtime = time.monotonic() - self._down_since
+        self._completed_downtime += self.last_downtime
+        self._down_since = None
+        self.reconnects += 1
+        return self.last_downtime
 
 
 class ToastBot(commands.Bot):
-    def __init__(self, command_prefix, formatter=None, description=None, pm_help=False, **options):
+    def __init__(self, command_prefix, formatter=None, description=None, pm_help=False, bot_metrics=None,
+                 config=None, started_at=None, startup_budget=None, backoff=None,
+                 stable_connection_seconds=DEFAULT_STABLE_CONNECTION_SECONDS, log_writer_queues=None,
+                 rate_limiter=None, max_queued_sends=outbox.DEFAULT_MAX_QUEUED, settings_watcher=None, **options):
+        """
+        :param config: Parsed configuration the extensions read their settings from.
+        :param started_at: time.perf_counter() value at process start, for the startup report.
+        :param startup_budget: Seconds from start to ready before startup is reported as too slow.
+        :param backoff: ExponentialBackoff for reconnect delays.
+        :param log_writer_queues: When running as one of several shards (shard_id and shard_count
+            options), the (request queue, reply queue) of the process that writes the log database.
+        :param rate_limiter: ratelimit.RateLimiter applied to every command, or None for no limit.
+        :param max_queued_sends: Most outgoing messages queued at once; see outbox.Outbox.
+        :param settings_watcher: configuration.SettingsWatcher reloading the configuration while
+            the bot runs; config then defaults to its current contents.
+        """
         super().__init__(command_prefix, formatter, description, pm_help, ** options)
+        self.log_writer_queues = log_writer_queues
+        self.rate_limiter = rate_limiter
+        if rate_limiter is not None:
+            self.add_check(rate_limiter.check)
+        self.outbox = outbox.Outbox(super().send_message, self.loop, max_queued_sends)
+        self.backoff = backoff if backoff is not None else ExponentialBackoff()
+        self.stable_connection_seconds = stable_connection_seconds
+        self.connection_stats = ConnectionStats()
+        self._connected_at = None
+        self._stopping = False
+        self.metrics = bot_metrics if bot_metrics is not None else metrics.BotMetrics()
+        self.settings_watcher = settings_watcher
+        if config is None:
+            config = settings_watcher.current.config if settings_watcher is not None else configparser.ConfigParser()
+        self.config = config
+        if settings_watcher is not None:
+            settings_watcher.subscribe(self._settings_reloaded)
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        self.startup_budget = startup_budget
+        #  Startup stage -> seconds it took; 'ready' is the total from started_at.
+        self.startup_timings = collections.OrderedDict()
+        self.metrics.registry.gauge(
+            'toastbot_startup_seconds', 'Seconds from process start until the bot was ready.',
+            lambda: self.startup_timings.get('ready', 0.0)
+        )
+        self.metrics.registry.gauge(
+            'toastbot_reconnects', 'Gateway reconnects since start.', lambda: self.connection_stats.reconnects
+        )
+        self.metrics.registry.gauge(
+            'toastbot_downtime_seconds', 'Seconds spent disconnected from the gateway since start.',
+            lambda: round(self.connection_stats.downtime, 3)
+        )
+        self.metrics.track_queue_depth('outbox', lambda: self.outbox.queued)
+        self.metrics.registry.gauge(
+            'toastbot_replies_merged', 'Replies sent as part of another reply to the same channel.',
+            lambda: self.outbox.merged
+        )
+
+    def _settings_reloaded(self, old, new):
+        #  Extensions loaded from now on read the new configuration.
+        self.config = new.config
+
+    def record_startup(self, stage, seconds):
+        self.startup_timings[stage] = seconds
+
+    def load_cogs(self, extensions):
+        """
+        Load each extension in turn, timing each for the startup report.
+        """
+        for extension in extensions:
+            start = time.perf_counter()
+            self.load_extension(extension)
+            self.record_startup('load {}'.format(extension.rsplit('.', 1)[-1]), time.perf_counter() - start)
+
+    def unload_cogs(self):
+        for extension in tuple(self.extensions):
+            try:
+                self.unload_extension(extension)
+            except:
+                pass
+
+        for cog in tuple(self.cogs):
+            try:
+                self.remove_cog(cog)
+            except:
+                pass
+
+    def startup_report(self):
+        """
+        :return: List of (stage, formatted seconds).
+        """
+        rows = [
+            ('startup {}'.format(stage), '{:.3f}s'.format(seconds))
+            for stage, seconds in self.startup_timings.items()
+        ]
+        if self.startup_budget is not None:
+            rows.append(('startup budget', '{:.3f}s'.format(self.startup_budget)))
+        return rows
+
+    def run(self, *args, **kwargs):
+        """
+        Run the bot until shut down, reconnecting whenever the connection drops.
+
+        Takes the same arguments as login. Unlike commands.Bot.run, the loop and the HTTP session
+        are kept across reconnects, and so is every cog's state. The configuration file is checked
+        for changes throughout.
+        """
+        if self.settings_watcher is not None:
+            asyncio.ensure_future(self.settings_watcher.watch(loop=self.loop), loop=self.loop)
+        try:
+            self.loop.run_until_complete(self.supervise(*args, **kwargs))
+        except KeyboardInterrupt:
+            self.loop.run_until_complete(self.shutdown())
+        finally:
+            self.unload_cogs()
+            pending = asyncio.Task.all_tasks(loop=self.loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                self.loop.run_until_complete(asyncio.wait(pending, loop=self.loop))
+            self.loop.close()
+
+    @asyncio.coroutine
+    def supervise(self, *args, **kwargs):
+        """
+        Log in and stay connected until shutdown, backing off exponentially between reconnects.
+
+        Login failures other than network errors, such as a rejected token, are raised.
+        """
+        while not self._stopping:
+            try:
+                if not self.is_logged_in:
+                    yield from self.login(*args, **kwargs)
+                yield from self.connect()
+            except RECONNECT_ERRORS as error:
+                logging.warning('Gateway connection lost: {!r}'.format(error))
+            if self._stopping:
+                break
+            self.connection_stats.disconnected()
+            if self._connected_at is not None and \
+                    time.monotonic() - self._connected_at >= self.stable_connection_seconds:
+                self.backoff.reset()
+            self._connected_at = None
+            delay = self.backoff.next_delay()
+            logging.warning('Reconnecting in {:.1f}s (attempt {}).'.format(delay, self.backoff.failures))
+            yield from asyncio.sleep(delay, loop=self.loop)
+            self._reopen()
+
+    def _reopen(self):
+        #  Undo what _disconnect did, so that connect() runs again on the same client.
+        self._closed.clear()
+        self._is_ready.clear()
+
+    @asyncio.coroutine
+    def _disconnect(self):
+        """
+        Drop the gateway connection only, keeping the HTTP session, login and cogs for reconnecting.
+        """
+        if self.ws is not None and self.ws.open:
+            yield from self.ws.close()
+        #  Ends the poll loop in connect(), which then returns or raises to the supervisor.
+        self._closed.set()
+
+    @asyncio.coroutine
+    def shutdown(self):
+        self._stopping = True
+        yield from self.close(force_close=True)
+
+    @asyncio.coroutine
+    def logout(self):
+        yield from self.shutdown()
+
+    @asyncio.coroutine
+    def on_ready(self):
+        self._connected_at = time.monotonic()
+        downtime = self.connection_stats.reconnected()
+        if downtime is not None:
+            logging.info('Reconnected after {:.1f}s.'.format(downtime))
+            self.dispatch('reconnect', downtime)
+        if 'ready' not in self.startup_timings:
+            self.record_startup('ready', time.perf_counter() - self.started_at)
+            for stage, seconds in self.startup_report():
+                logging.info('{}: {}'.format(stage, seconds))
+            ready = self.startup_timings['ready']
+            if self.startup_budget is not None and ready > self.startup_budget:
+                logging.warning('Startup took {:.2f}s, over the {:.2f}s budget.'.format(ready, self.startup_budget))
+        logging.info("Bot online!")
+
+    def handle_command(self, command, ctx):
+        """
+        Called from dispatch as each command is invoked, ahead of its checks.
+
+        Starts timing the command and charges it to the rate limiter. commands.Bot.process_commands
+        calls Command.invoke directly, so this, rather than an override of invoke, sees every command.
+        """
+        ctx.started_at = time.perf_counter()
+        if self.rate_limiter is not None:
+            self.rate_limiter.charge(command, ctx)
+
+    def handle_command_completion(self, command, ctx):
+        self._record_command_latency(ctx)
+
+    def handle_command_error(self, exception, ctx):
+        self._record_command_latency(ctx)
+
+    def _record_command_latency(self, ctx):
+        #  Unknown commands are reported as errors without ever being dispatched.
+        started_at = getattr(ctx, 'started_at', None)
+        if ctx.command is None or started_at is None:
+            return
+        self.metrics.command_latency.labels(ctx.command.qualified_name).observe(time.perf_counter() - started_at)
+
+    @asyncio.coroutine
+    def on_command_completion(self, command, ctx):
+        self.metrics.commands.labels(command.qualified_name, 'ok').inc()
+
+    @asyncio.coroutine
+    def on_command_error(self, exception, context):
+        command_name = context.command.qualified_name if context.command is not None else 'unknown'
+        if isinstance(exception, ratelimit.RateLimited):
+            self.metrics.commands.labels(command_name, 'limited').inc()
+            #  Only the first refused command says so; answering each would be a flood of its own.
+            if exception.first:
+                yield from self.send_message(context.message.channel, 'Slow down, {}: try again in {:.0f}s.'.format(
+                    context.message.author.display_name, math.ceil(exception.retry_after)))
+            return
+        self.metrics.commands.labels(command_name, 'error').inc()
+        yield from super().on_command_error(exception, context)
+
+    @asyncio.coroutine
+    def send_message(self, destination, content=None, *, tts=False, embed=None):
+        """
+        Wrapped up to send through the outbox, which merges bursts of short replies.
+        """
+        message = yield from self.outbox.send(destination, content, tts=tts, embed=embed)
+        return message
 
     @asyncio.coroutine
     def close(self, force_close: bool=False):
@@ -15,20 +337,10 @@ class ToastBot(commands.Bot):
         :param force_close: Bool; if True, then bot will not auto-recover.
         :return: None
         """
-        if force_close:
-            for extension in tuple(self.extensions):
-                try:
-                    self.unload_extension(extension)
-                except:
-                    pass
-
-            for cog in tuple(self.cogs):
-                try:
-                    self.remove_cog(cog)
-                except:
-                    pass
-
+        if force_close or self._stopping:
+            self._stopping = True
+            self.unload_cogs()
             yield from super().close()
         else:
             logging.warning('Connection closed; autorecovering...')
-            self.run()
+            yield from self._disconnect()